@@ -0,0 +1,116 @@
+""" Compare recall and latency of the LSH index against exact search
+
+Usage:
+    python benchmarks/ann_recall.py --vectors 100000 --dimensions 256
+    python benchmarks/ann_recall.py --settings 8x12 16x14 --no-probes
+
+Vectors are synthetic and clustered, normalized like movie feature vectors.
+Each setting is given as <tables>x<bits>. Results are printed as JSON.
+"""
+import argparse
+import json
+import tempfile
+import time
+
+import numpy as np
+
+from movie_recs.ann import LSHIndex
+
+
+def clustered_vectors(count: int, dimensions: int, clusters: int, seed: int) -> np.ndarray:
+    """ Normalized vectors scattered around random centres """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimensions))
+    vectors = np.empty((count, dimensions), dtype=np.float32)
+
+    for start in range(0, count, 10000):
+        stop = min(start + 10000, count)
+        chunk = centres[rng.integers(clusters, size=stop - start)]
+        chunk = chunk + 0.5 * rng.standard_normal(chunk.shape)
+        vectors[start:stop] = chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+
+    return vectors
+
+
+def exact_search(vectors: np.ndarray, queries: np.ndarray, k: int):
+    """ Brute force top k for every query, timing each one """
+    results = []
+    start = time.perf_counter()
+
+    for row in queries:
+        scores = vectors @ vectors[row]
+        scores[row] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        results.append(set(top.tolist()))
+
+    return results, (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    """ Measure exact search and every LSH setting, then print the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--settings", nargs="+", default=["4x10", "8x12", "8x14", "16x14"])
+    parser.add_argument("--no-probes", action="store_true", help="Disable multi-probe lookups")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = clustered_vectors(args.vectors, args.dimensions, args.clusters, args.seed)
+    queries = np.random.default_rng(args.seed + 1).choice(
+        args.vectors, size=args.queries, replace=False)
+
+    truth, exact_latency = exact_search(vectors, queries, args.k)
+    results = [{
+        "method": "exact",
+        "recall": 1.0,
+        "query_ms": round(exact_latency * 1000, 3),
+    }]
+
+    for setting in args.settings:
+        tables, bits = (int(value) for value in setting.split("x"))
+
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            planes = LSHIndex.make_planes(args.dimensions, tables, bits, args.seed)
+            index = LSHIndex.create(directory, "bench", planes, tables, not args.no_probes)
+            index.add(vectors)
+            index.candidates(vectors[0])
+            build_time = time.perf_counter() - start
+
+            found = 0
+            candidates = 0
+            start = time.perf_counter()
+            for row, expected in zip(queries, truth):
+                rows, _ = index.query(vectors[row], args.k, exclude=int(row))
+                found += len(set(rows.tolist()) & expected)
+            latency = (time.perf_counter() - start) / len(queries)
+
+            for row in queries:
+                candidates += len(index.candidates(vectors[row]))
+
+        results.append({
+            "method": "lsh",
+            "tables": tables,
+            "bits": bits,
+            "probes": not args.no_probes,
+            "recall": round(found / (args.k * len(queries)), 4),
+            "query_ms": round(latency * 1000, 3),
+            "speedup": round(exact_latency / latency, 2),
+            "mean_candidates": round(candidates / len(queries), 1),
+            "build_s": round(build_time, 2),
+        })
+
+    print(json.dumps({
+        "vectors": args.vectors,
+        "dimensions": args.dimensions,
+        "k": args.k,
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
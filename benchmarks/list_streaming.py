@@ -0,0 +1,117 @@
+""" Compare time to first byte and peak memory of the rendered and streamed movie list
+
+Usage:
+    python benchmarks/list_streaming.py --movies 20000 --db-host localhost
+    python benchmarks/list_streaming.py --movies 5000 --mock
+
+Each mode runs in its own process so that peak memory is measured
+independently. Results are printed as JSON.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from movie_recs import create_app
+from movie_recs.db import get_db
+
+BENCH_DB_NAME = "movie_recs_bench"
+PLOT = "A long plot that is only shown on the movie's own page. " * 20
+
+
+def seed_movies(count: int):
+    """ Fill the benchmark database with count movies, if it isn't already """
+    movies = get_db().movies
+
+    if movies.estimated_document_count() == count:
+        return
+
+    movies.drop()
+    for start in range(0, count, 1000):
+        movies.insert_many([
+            {
+                "Title": f"Movie {i}",
+                "slug": f"movie-{i}",
+                "Genre": "Drama, Mystery",
+                "Poster": f"https://example.com/posters/{i}.jpg",
+                "Synopsis": "A short synopsis for the movie list.",
+                "Plot": PLOT,
+            }
+            for i in range(start, min(start + 1000, count))
+        ])
+
+
+def run_mode(args: argparse.Namespace, stream: bool, results):
+    """ Request the full movie list once and record its timings and memory use """
+    with contextlib.ExitStack() as stack:
+        if args.mock:
+            import mongomock  # pylint: disable=import-outside-toplevel
+            stack.enter_context(mongomock.patch(servers=args.db_host))
+
+        app = create_app({
+            "DB_HOST": args.db_host,
+            "DB_PORT": args.db_port,
+            "DB_NAME": BENCH_DB_NAME,
+            "MOVIES_PAGE_SIZE": args.movies,
+            "MOVIES_MAX_PAGE_SIZE": args.movies,
+            "MOVIES_STREAM_LIST": stream,
+        })
+
+        with app.app_context():
+            seed_movies(args.movies)
+
+        client = app.test_client()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+
+        start = time.perf_counter()
+        response = client.get("/", buffered=False)
+        chunks = iter(response.response)
+        first_chunk = next(chunks)
+        ttfb = time.perf_counter() - start
+
+        size = len(first_chunk)
+        for chunk in chunks:
+            size += len(chunk)
+        total = time.perf_counter() - start
+        response.close()
+
+        _, peak_alloc = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    results.put({
+        "mode": "streamed" if stream else "rendered",
+        "movies": args.movies,
+        "ttfb_ms": round(ttfb * 1000, 2),
+        "total_ms": round(total * 1000, 2),
+        "bytes": size,
+        "peak_alloc_mb": round(peak_alloc / 2**20, 2),
+        "peak_rss_mb": round(rss_after / 1024, 2),
+        "rss_growth_mb": round((rss_after - rss_before) / 1024, 2),
+    })
+
+
+def main():
+    """ Run both modes and print the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", type=int, default=27017)
+    parser.add_argument("--mock", action="store_true", help="Use mongomock instead of mongod")
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    for stream in (False, True):
+        process = multiprocessing.Process(target=run_mode, args=(args, stream, results))
+        process.start()
+        process.join()
+
+    print(json.dumps([results.get() for _ in range(2)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+""" Measure throughput, latency percentiles and memory of the app's main pages under load
+
+Usage:
+    python benchmarks/load_test.py --db-host localhost --concurrency 1 8 32
+    python benchmarks/load_test.py --mock --requests 200 --output results.json
+    python benchmarks/load_test.py --db-host localhost --compare results.json
+
+The app is served over HTTP by a threaded werkzeug server in its own
+process, against --db-host (or mongomock with --mock) and a local stub
+standing in for the OMDB that answers after --latency seconds. --movies
+movies are seeded first. Each scenario is then driven with --requests
+requests at each concurrency level:
+
+* "list" requests the movie list
+* "movie" requests a random movie's page
+* "login" logs in, hashing the password
+* "add" adds a new movie while logged in, which queues a job or, with
+  --add-mode sync, asks the stub OMDB before responding
+
+Latencies are in milliseconds and memory is the server's resident set.
+Results are printed as JSON along with the commit they were measured at.
+With --compare, each result is matched with the same scenario and
+concurrency in an earlier run and the exit status is 1 if any p95 latency
+grew by more than --threshold percent.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from movie_recs import create_app
+from movie_recs.db import add_movies, clear_db, init_collections
+from omdb_clients import stub_server
+
+BENCH_DB_NAME = "movie_recs_load_test"
+USERNAME = "load-test"
+PASSWORD = "load-test-password"
+
+SCENARIOS = ("list", "movie", "login", "add")
+
+# Numbers the titles added by the "add" scenario so each one is new
+ADDED_TITLES = itertools.count()
+
+
+def seed_movies(count: int):
+    """ Replace the benchmark database's movies with count generated ones """
+    clear_db()
+    init_collections()
+
+    genres = ["Drama", "Mystery", "Comedy", "Western", "Romance", "Thriller"]
+    for start in range(0, count, 1000):
+        add_movies([
+            {
+                "Title": f"Load Test Movie {i}",
+                "slug": f"load-test-movie-{i}",
+                "Year": str(1920 + i % 80),
+                "Runtime": f"{80 + i % 90} min",
+                "Genre": ", ".join(random.Random(i).sample(genres, 2)),
+                "Director": f"Director {i % 50}",
+                "Actors": f"Actor {i % 200}, Actor {(i + 7) % 200}",
+                "Poster": f"https://example.com/posters/{i}.jpg",
+                "Synopsis": "A short synopsis for the movie list.",
+                "Plot": "A longer plot that is only shown on the movie's own page. " * 10,
+            }
+            for i in range(start, min(start + 1000, count))
+        ])
+
+
+def serve(args: argparse.Namespace, omdb_url: str, ready):
+    """ Seed the database and serve the app until the process is terminated """
+    with contextlib.ExitStack() as stack:
+        if args.mock:
+            import mongomock  # pylint: disable=import-outside-toplevel
+            stack.enter_context(mongomock.patch(servers=args.db_host))
+
+        app = create_app({
+            "SECRET_KEY": "load-test",
+            "DB_HOST": args.db_host,
+            "DB_PORT": args.db_port,
+            "DB_NAME": BENCH_DB_NAME,
+            "OMDB_API_KEY": "load-test",
+            "OMDB_URL": omdb_url,
+            "OMDB_CACHE_ENABLED": False,
+            "MOVIES_ADD_QUEUED": args.add_mode == "queued",
+            "RECS_UPDATE_ON_INSERT": False,
+        }, instance_path=stack.enter_context(tempfile.TemporaryDirectory()))
+
+        with app.app_context():
+            seed_movies(args.movies)
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        ready.put(server.server_port)
+        server.serve_forever()
+
+
+def memory_mb(pid: int) -> dict:
+    """ The current and peak resident set of a process, on Linux """
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as status:
+            for line in status:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    memory[name] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+
+    return {"rss_mb": memory.get("VmRSS"), "peak_rss_mb": memory.get("VmHWM")}
+
+
+def reset_peak_memory(pid: int):
+    """ Start measuring a process's peak resident set afresh, where Linux allows it """
+    with contextlib.suppress(OSError):
+        with open(f"/proc/{pid}/clear_refs", "w", encoding="ascii") as clear_refs:
+            clear_refs.write("5")
+
+
+def logged_in_session(base_url: str) -> requests.Session:
+    """ A session logged in as the benchmark user """
+    session = requests.Session()
+    session.post(f"{base_url}/auth/login", data={"username": USERNAME, "password": PASSWORD},
+                 allow_redirects=False).raise_for_status()
+    return session
+
+
+def scenario_request(scenario: str, base_url: str, movies: int):
+    """ Build a function that makes one request for a scenario in a given session """
+
+    def request(session: requests.Session) -> requests.Response:
+        if scenario == "list":
+            return session.get(f"{base_url}/")
+        if scenario == "movie":
+            return session.get(f"{base_url}/movie/load-test-movie-{random.randrange(movies)}")
+        if scenario == "login":
+            return session.post(f"{base_url}/auth/login", allow_redirects=False,
+                                data={"username": USERNAME, "password": PASSWORD})
+
+        return session.post(f"{base_url}/movies/add", allow_redirects=False,
+                            data={"movie_title": f"Added Movie {next(ADDED_TITLES)}"})
+
+    return request
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """ The value below which fraction of sorted_values fall """
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(scenario: str, concurrency: int, args: argparse.Namespace,
+                 base_url: str, server_pid: int) -> dict:
+    """ Drive one scenario at one concurrency level and summarize it """
+    request = scenario_request(scenario, base_url, args.movies)
+    sessions = threading.local()
+    latencies = []
+    errors = 0
+
+    def one(_):
+        if not hasattr(sessions, "session"):
+            sessions.session = logged_in_session(base_url)
+        start = time.perf_counter()
+        response = request(sessions.session)
+        return time.perf_counter() - start, response.status_code < 400
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(min(args.warmup, args.requests))))
+
+        reset_peak_memory(server_pid)
+        start = time.perf_counter()
+        for latency, ok in executor.map(one, range(args.requests)):
+            latencies.append(latency * 1000)
+            errors += not ok
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(args.requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(latencies[-1], 2),
+        **memory_mb(server_pid),
+    }
+
+
+def compare(results: list, baseline_path: str, threshold: float) -> list:
+    """ Match results with a baseline run, returning the p95 regressions over threshold """
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = {
+            (result["scenario"], result["concurrency"]): result
+            for result in json.load(baseline_file)["results"]
+        }
+
+    regressions = []
+    for result in results:
+        before = baseline.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+
+        change = (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+        result["baseline_p95_ms"] = before["p95_ms"]
+        result["p95_change_percent"] = round(change, 1)
+        if change > threshold:
+            regressions.append(result)
+
+    return regressions
+
+
+def commit() -> str:
+    """ The commit being measured, if this is a git checkout """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """ Serve the app, run every scenario at every concurrency level and print the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=500,
+                        help="Requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=50,
+                        help="Unmeasured requests before each measurement")
+    parser.add_argument("--movies", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds the stub OMDB takes to answer")
+    parser.add_argument("--add-mode", choices=("queued", "sync"), default="queued")
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", type=int, default=27017)
+    parser.add_argument("--mock", action="store_true", help="Use mongomock instead of mongod")
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--compare", help="Results from an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percent growth in p95 latency that counts as a regression")
+    args = parser.parse_args()
+
+    stub = stub_server(args.latency)
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(args, f"http://127.0.0.1:{stub.server_address[1]}/", ready),
+        daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{ready.get(timeout=600)}"
+
+    requests.post(f"{base_url}/auth/register",
+                  data={"username": USERNAME, "password": PASSWORD}).raise_for_status()
+
+    results = [
+        run_scenario(scenario, concurrency, args, base_url, server.pid)
+        for scenario in args.scenarios
+        for concurrency in args.concurrency
+    ]
+
+    server.terminate()
+    server.join()
+    stub.shutdown()
+
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "settings": {
+            "movies": args.movies,
+            "omdb_latency_ms": args.latency * 1000,
+            "add_mode": args.add_mode,
+            "database": "mongomock" if args.mock else f"{args.db_host}:{args.db_port}",
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
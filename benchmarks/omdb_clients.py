@@ -0,0 +1,152 @@
+""" Compare movies added per second with the blocking and asyncio OMDB clients
+
+Usage:
+    python benchmarks/omdb_clients.py --movies 200 --latency 0.05 --mock
+    python benchmarks/omdb_clients.py --movies 500 --concurrency 32 --db-host localhost
+
+A local stub server stands in for the OMDB, answering every title after
+--latency seconds. Each client looks up and adds the same titles with the
+OMDB cache disabled:
+
+* "serial" adds one movie at a time, as the add page does
+* "threads" uses init-db's thread pool with --concurrency workers
+* "async" uses the asyncio client with --concurrency titles in flight on one thread
+
+Results are printed as JSON.
+"""
+import argparse
+import contextlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from movie_recs import create_app
+from movie_recs.cli import fetch_movies, fetch_movies_async
+from movie_recs.db import add_movie, add_movies, clear_db, init_collections
+from movie_recs.omdb import get_movie_data
+
+BENCH_DB_NAME = "movie_recs_bench"
+
+
+def stub_server(latency: float) -> ThreadingHTTPServer:
+    """ Start an OMDB stand-in on a free local port """
+
+    class Handler(BaseHTTPRequestHandler):
+        """ Answers every title as if the OMDB had found it """
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """ Respond with a movie record for the requested title """
+            params = parse_qs(urlparse(self.path).query)
+            title = (params.get("t") or params.get("i"))[0]
+            plot = "A short plot." if params.get("plot") == ["short"] else "A full plot. " * 20
+            body = json.dumps({
+                "Response": "True", "Title": title, "Year": "1958", "Genre": "Drama",
+                "Director": "Someone", "Actors": "Someone Else", "Plot": plot,
+            }).encode("utf-8")
+
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_serially(titles, _concurrency):
+    """ Look up and add each title in turn """
+    for title in titles:
+        add_movie(get_movie_data(title))
+
+
+def add_fetched(fetch):
+    """ Build a runner that adds movies in batches as fetch yields them """
+
+    def run(titles, concurrency):
+        batch = []
+        for result in fetch(titles, concurrency):
+            batch.append(result.movie_data)
+            if len(batch) >= 50:
+                add_movies(batch)
+                batch = []
+        add_movies(batch)
+
+    return run
+
+
+CLIENTS = {
+    "serial": add_serially,
+    "threads": add_fetched(fetch_movies),
+    "async": add_fetched(fetch_movies_async),
+}
+
+
+def main():
+    """ Run every client against the stub server and print the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds the stub OMDB takes to answer")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--synopsis-mode", default="fetch", choices=("fetch", "derive"))
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", type=int, default=27017)
+    parser.add_argument("--mock", action="store_true", help="Use mongomock instead of mongod")
+    args = parser.parse_args()
+
+    server = stub_server(args.latency)
+    results = []
+
+    with contextlib.ExitStack() as stack:
+        if args.mock:
+            import mongomock  # pylint: disable=import-outside-toplevel
+            stack.enter_context(mongomock.patch(servers=args.db_host))
+
+        app = create_app({
+            "DB_HOST": args.db_host,
+            "DB_PORT": args.db_port,
+            "DB_NAME": BENCH_DB_NAME,
+            "OMDB_API_KEY": "bench",
+            "OMDB_URL": f"http://127.0.0.1:{server.server_address[1]}/",
+            "OMDB_POOL_SIZE": args.concurrency * 2,
+            "OMDB_CACHE_ENABLED": False,
+            "OMDB_SYNOPSIS_MODE": args.synopsis_mode,
+            "RECS_UPDATE_ON_INSERT": False,
+        })
+
+        for name, run in CLIENTS.items():
+            titles = [f"{name} movie {i}" for i in range(args.movies)]
+
+            with app.app_context():
+                clear_db()
+                init_collections()
+
+                start = time.perf_counter()
+                run(titles, args.concurrency)
+                elapsed = time.perf_counter() - start
+
+            results.append({
+                "client": name,
+                "movies": args.movies,
+                "concurrency": 1 if name == "serial" else args.concurrency,
+                "latency_ms": args.latency * 1000,
+                "synopsis_mode": args.synopsis_mode,
+                "seconds": round(elapsed, 3),
+                "movies_per_second": round(args.movies / elapsed, 1),
+            })
+
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
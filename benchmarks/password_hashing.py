@@ -0,0 +1,98 @@
+""" Measure password hashing throughput for a range of hashing settings
+
+Usage:
+    python benchmarks/password_hashing.py
+    python benchmarks/password_hashing.py --methods pbkdf2:sha256:100000 --workers 1 4
+
+For each method, hashes/sec is reported inline and on thread and process
+pools of each size, so the cost can be chosen for the available CPU.
+Results are printed as JSON.
+"""
+import argparse
+import json
+import time
+
+from werkzeug.security import generate_password_hash
+
+from movie_recs import create_app
+from movie_recs.passwords import get_executor, hash_password
+
+DEFAULT_METHODS = [
+    "pbkdf2:sha256:50000",
+    "pbkdf2:sha256:150000",
+    "pbkdf2:sha256:260000",
+    "pbkdf2:sha256:600000",
+    "pbkdf2:sha512:260000",
+]
+
+
+def measure(method: str, executor, workers: int, duration: float) -> dict:
+    """ Hash passwords with one set of settings for about duration seconds """
+    app = create_app({
+        "AUTH_HASH_METHOD": method,
+        "AUTH_HASH_EXECUTOR": executor,
+        "AUTH_HASH_WORKERS": workers,
+    })
+
+    with app.app_context():
+        hash_password("warm up the pool")
+
+        pool = get_executor()
+
+        hashes = 0
+        start = time.perf_counter()
+
+        while time.perf_counter() - start < duration:
+            if pool is None:
+                hash_password("correct horse battery staple")
+                hashes += 1
+            else:
+                # Keep every worker busy, as concurrent logins would
+                batch = [
+                    pool.submit(_hash, method, app.config["AUTH_SALT_LENGTH"])
+                    for _ in range(workers)
+                ]
+                for future in batch:
+                    future.result()
+                hashes += workers
+
+        elapsed = time.perf_counter() - start
+
+        if pool is not None:
+            pool.shutdown()
+
+    return {
+        "method": method,
+        "executor": executor or "inline",
+        "workers": workers if executor else 1,
+        "hashes_per_sec": round(hashes / elapsed, 2),
+        "ms_per_hash": round(elapsed / hashes * 1000, 2),
+    }
+
+
+def _hash(method: str, salt_length: int) -> str:
+    """ Hash a fixed password outside of an app context, as the pools do """
+    return generate_password_hash("correct horse battery staple", method, salt_length)
+
+
+def main():
+    """ Measure every combination of settings and print the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--methods", nargs="+", default=DEFAULT_METHODS)
+    parser.add_argument("--workers", nargs="+", type=int, default=[2, 4])
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="Seconds to spend on each setting")
+    args = parser.parse_args()
+
+    results = []
+    for method in args.methods:
+        results.append(measure(method, None, 1, args.duration))
+        for executor in ("thread", "process"):
+            for workers in args.workers:
+                results.append(measure(method, executor, workers, args.duration))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
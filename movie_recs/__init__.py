@@ -19,7 +19,85 @@ def create_app(test_config=None, instance_path=None):
         DB_HOST="mongo",
         DB_PORT=27017,
         DB_NAME="movie_recs",
+        DB_MAX_POOL_SIZE=50,
+        DB_MIN_POOL_SIZE=0,
+        DB_MAX_IDLE_TIME_MS=60000,
+        DB_CONNECT_TIMEOUT_MS=5000,
+        DB_SERVER_SELECTION_TIMEOUT_MS=10000,
+        DB_WAIT_QUEUE_TIMEOUT_MS=None,
+        DB_VERSION_TTL=1.0,
+        DB_ENSURE_INDEXES=True,
         SECRET_KEY='dev',
+        AUTH_HASH_METHOD="pbkdf2:sha256:260000",
+        AUTH_SALT_LENGTH=16,
+        AUTH_HASH_EXECUTOR=None,
+        AUTH_HASH_WORKERS=2,
+        AUTH_USER_CACHE_SIZE=1024,
+        AUTH_USER_CACHE_TTL=30,
+        AUTH_SESSION_CLAIMS=False,
+        OMDB_URL="http://www.omdbapi.com/",
+        OMDB_POOL_SIZE=10,
+        OMDB_CONNECT_TIMEOUT=3.05,
+        OMDB_READ_TIMEOUT=10,
+        OMDB_RETRIES=3,
+        OMDB_BACKOFF_FACTOR=0.5,
+        OMDB_SYNOPSIS_MODE="derive",
+        OMDB_SYNOPSIS_LENGTH=200,
+        OMDB_DEFERRED_WORKERS=2,
+        OMDB_CACHE_ENABLED=True,
+        OMDB_CACHE_PATH=None,
+        OMDB_CACHE_TTL=30 * 24 * 60 * 60,
+        OMDB_CACHE_MAX_ENTRIES=10000,
+        OMDB_CACHE_ONLY=False,
+        OMDB_RATE_LIMIT=None,
+        MOVIES_PAGE_SIZE=50,
+        MOVIES_MAX_PAGE_SIZE=200,
+        MOVIES_STREAM_LIST=False,
+        MOVIES_STREAM_BUFFER=20,
+        RECS_NEIGHBORS=10,
+        RECS_SHOWN=5,
+        RECS_MAX_FEATURES=5000,
+        RECS_BATCH_SIZE=512,
+        RECS_INDEX_DIR=None,
+        RECS_ANN_THRESHOLD=20000,
+        RECS_ANN_TABLES=8,
+        RECS_ANN_BITS=12,
+        RECS_ANN_PROBES=True,
+        RECS_ANN_SEED=0,
+        RECS_UPDATE_ON_INSERT=True,
+        RECS_CF_NEIGHBORS=20,
+        RECS_CF_MAX_USER_ITEMS=500,
+        RECS_CF_MAX_PAIRS=5_000_000,
+        RECS_PERSONAL_SHOWN=10,
+        SEARCH_RESULTS=20,
+        SEARCH_REFRESH_INTERVAL=30,
+        SEARCH_FACET_MATCHES=1000,
+        RANDOM_POOL_SIZE=5000,
+        RANDOM_POOL_REFRESH=300,
+        HTTP_CACHE_ENABLED=True,
+        HTTP_CACHE_MAX_AGE=60,
+        FRAGMENT_CACHE_ENABLED=True,
+        FRAGMENT_CACHE_SIZE=2048,
+        FRAGMENT_CACHE_TTL=300,
+        FRAGMENT_CACHE_PATH=None,
+        FRAGMENT_CACHE_SHARED_MAX_ENTRIES=50000,
+        MOVIES_ADD_QUEUED=False,
+        JOBS_LEASE_SECONDS=60,
+        JOBS_MAX_ATTEMPTS=5,
+        JOBS_RETRY_DELAY=5,
+        JOBS_POLL_INTERVAL=1.0,
+        JOBS_REFRESH_SECONDS=2,
+        JOBS_EXPIRE_SECONDS=24 * 60 * 60,
+        INIT_DB_WORKERS=8,
+        INIT_DB_BATCH_SIZE=50,
+        INIT_DB_ASYNC=False,
+        INIT_DB_INCREMENTAL=False,
+        INIT_DB_MAX_AGE=30 * 24 * 60 * 60,
+        IMPORT_CHUNK_SIZE=500,
+        METRICS_ENABLED=True,
+        METRICS_SERVER_TIMING=False,
+        METRICS_ALLOWED_NETWORKS=("127.0.0.1/32", "::1/128"),
+        METRICS_TOKEN=None,
     )
 
     if test_config is None:
@@ -32,9 +110,27 @@ def create_app(test_config=None, instance_path=None):
     except OSError:
         pass
 
+    from .metrics import init_app as init_metrics
+    init_metrics(app)
+
     from .db import init_app
     init_app(app)
 
+    from .recommend import init_app as init_recommendations
+    init_recommendations(app)
+
+    from .search import init_app as init_search
+    init_search(app)
+
+    from .titles import init_app as init_titles
+    init_titles(app)
+
+    from .fragments import init_app as init_fragments
+    init_fragments(app)
+
+    from .random_pool import init_app as init_random_pool
+    init_random_pool(app)
+
     from .cli import add_cli_commands
     add_cli_commands(app)
 
@@ -45,4 +141,7 @@ def create_app(test_config=None, instance_path=None):
     app.register_blueprint(movies.bp)
     app.add_url_rule("/", endpoint="index")
 
+    from . import api
+    app.register_blueprint(api.bp)
+
     return app
@@ -0,0 +1,223 @@
+""" Approximate nearest neighbour search over normalized vectors
+
+Vectors are hashed with random hyperplane locality sensitive hashing: each
+of several tables maps a vector to the signs of its projections onto a set
+of random hyperplanes, so vectors at a small angle to each other tend to
+land in the same bucket. A query only compares against vectors that share
+a bucket with it in some table (optionally also probing the buckets one bit
+away), then ranks those candidates exactly.
+
+Vectors are stored sparsely, as the three arrays of a CSR matrix, so a
+vector takes space for its non-zero values rather than for every
+dimension. Those arrays and the signatures are kept in flat files that are
+memory-mapped, so an index larger than memory can be opened without
+reading it in, and new vectors are appended in place.
+"""
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse
+
+INDPTR_FILE = "indptr-{generation}.i64"
+INDICES_FILE = "indices-{generation}.i32"
+DATA_FILE = "data-{generation}.f32"
+SIGNATURES_FILE = "signatures-{generation}.u64"
+
+FILES = (INDPTR_FILE, INDICES_FILE, DATA_FILE, SIGNATURES_FILE)
+
+# Buckets for rows added since the sorted tables were built are kept in
+# dicts until there are this many of them
+MAX_UNMERGED_ROWS = 4096
+
+
+def _open_rows(path: str, dtype, shape: Tuple[int, ...]) -> np.ndarray:
+    """ Memory-map the first shape[0] rows of a flat file """
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _append_rows(path: str, rows: np.ndarray, count: int, dtype):
+    """ Write rows, or single values, to a flat file immediately after its first count """
+    row_bytes = int(np.prod(rows.shape[1:], dtype=np.int64)) * np.dtype(dtype).itemsize
+
+    with open(path, "r+b" if os.path.exists(path) else "wb") as rows_file:
+        rows_file.truncate(count * row_bytes)
+        rows_file.seek(count * row_bytes)
+        rows_file.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+
+
+def as_rows(vectors: Union[np.ndarray, scipy.sparse.spmatrix]) -> scipy.sparse.csr_matrix:
+    """ Vectors as a sparse matrix with a row each; a single dense vector becomes one row """
+    if not scipy.sparse.issparse(vectors):
+        vectors = np.atleast_2d(vectors)
+    return scipy.sparse.csr_matrix(vectors, dtype=np.float32)
+
+
+def remove_generation(directory: str, generation: str):
+    """ Delete an index's files; processes that have them mapped can keep reading """
+    for name in FILES:
+        path = os.path.join(directory, name.format(generation=generation))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class LSHIndex:
+    """ Random hyperplane LSH over sparse vectors stored in memory-mapped files
+
+    An index's files are named after its generation, so a new index can be
+    written alongside one that other processes still have mapped. Vectors
+    can be given dense or sparse; self.vectors is a CSR matrix.
+    """
+
+    def __init__(self, directory: str, generation: str, planes: np.ndarray, tables: int,
+                 count: int, probes: bool = True):
+        self.directory = directory
+        self.generation = generation
+        self.planes = planes
+        self.tables = tables
+        self.bits = len(planes) // tables
+        self.dimensions = planes.shape[1]
+        self.count = count
+        self.probes = probes
+        self._powers = (np.uint64(1) << np.arange(self.bits, dtype=np.uint64))
+        self._sorted: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None
+        self._unmerged: List[Dict[int, List[int]]] = []
+        self._merged_count = 0
+        self._map_files()
+
+    @staticmethod
+    def make_planes(dimensions: int, tables: int, bits: int, seed: int) -> np.ndarray:
+        """ Draw the random hyperplanes for a new index """
+        if bits > 64:
+            raise ValueError("An LSH signature can have at most 64 bits")
+
+        rng = np.random.default_rng(seed)
+        return rng.standard_normal((tables * bits, dimensions)).astype(np.float32)
+
+    @classmethod
+    def create(cls, directory: str, generation: str, planes: np.ndarray, tables: int,
+               probes: bool = True) -> "LSHIndex":
+        """ Create a new, empty index in directory """
+        os.makedirs(directory, exist_ok=True)
+        index = cls(directory, generation, planes, tables, 0, probes)
+
+        for name in FILES:
+            with open(index._path(name), "wb"):
+                pass
+
+        return index
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name.format(generation=self.generation))
+
+    def remove_files(self):
+        """ Delete the index's files; processes that have them mapped can keep reading """
+        remove_generation(self.directory, self.generation)
+
+    def _map_files(self):
+        # Row offsets start with a 0 that's only written out with the first rows
+        self.indptr = (_open_rows(self._path(INDPTR_FILE), np.int64, (self.count + 1,))
+                       if self.count else np.zeros(1, dtype=np.int64))
+        values = int(self.indptr[-1])
+        self.indices = _open_rows(self._path(INDICES_FILE), np.int32, (values,))
+        self.data = _open_rows(self._path(DATA_FILE), np.float32, (values,))
+        self.vectors = scipy.sparse.csr_matrix(
+            (self.data, self.indices, self.indptr), shape=(self.count, self.dimensions),
+            copy=False)
+        self.signatures = _open_rows(
+            self._path(SIGNATURES_FILE), np.uint64, (self.count, self.tables))
+
+    def signatures_of(self, vectors: Union[np.ndarray, scipy.sparse.spmatrix]) -> np.ndarray:
+        """ Hash vectors to one signature per table """
+        vectors = as_rows(vectors)
+        above = np.asarray(vectors @ self.planes.T) > 0
+        above = above.reshape(vectors.shape[0], self.tables, self.bits).astype(np.uint64)
+        return (above * self._powers).sum(axis=2, dtype=np.uint64)
+
+    def add(self, vectors: Union[np.ndarray, scipy.sparse.spmatrix]):
+        """ Append vectors to the index; they are numbered in the order added
+
+        The rows are written after the first count rows of the files, so
+        processes sharing them must take turns adding and reopen the index
+        in between.
+        """
+        vectors = as_rows(vectors)
+        if vectors.shape[0] == 0:
+            return
+
+        # Stored rows must already be in canonical form, since mapped arrays can't be sorted
+        vectors.sum_duplicates()
+        values = int(self.indptr[-1])
+
+        signatures = self.signatures_of(vectors)
+        _append_rows(self._path(INDICES_FILE), vectors.indices, values, np.int32)
+        _append_rows(self._path(DATA_FILE), vectors.data, values, np.float32)
+        _append_rows(self._path(INDPTR_FILE), vectors.indptr[1:] + values, self.count + 1,
+                     np.int64)
+        _append_rows(self._path(SIGNATURES_FILE), signatures, self.count, np.uint64)
+
+        first_row = self.count
+        self.count += vectors.shape[0]
+        self._map_files()
+
+        if self._sorted is not None:
+            if self.count - self._merged_count > MAX_UNMERGED_ROWS:
+                self._sorted = None
+            else:
+                for row, row_signatures in enumerate(signatures.tolist(), start=first_row):
+                    for table, signature in enumerate(row_signatures):
+                        self._unmerged[table].setdefault(signature, []).append(row)
+
+    def _build_tables(self):
+        """ Sort every row by its signature in each table, for binary searching """
+        self._sorted = []
+        for table in range(self.tables):
+            column = np.asarray(self.signatures[:, table])
+            order = np.argsort(column, kind="stable")
+            self._sorted.append((column[order], order))
+
+        self._unmerged = [{} for _ in range(self.tables)]
+        self._merged_count = self.count
+
+    def _probe_signatures(self, signature: int) -> List[int]:
+        if not self.probes:
+            return [signature]
+        return [signature] + [signature ^ (1 << bit) for bit in range(self.bits)]
+
+    def candidates(self, vector: Union[np.ndarray, scipy.sparse.spmatrix]) -> np.ndarray:
+        """ The rows sharing a bucket with vector in any table """
+        if self._sorted is None:
+            self._build_tables()
+
+        found = []
+        for table, signature in enumerate(self.signatures_of(vector)[0].tolist()):
+            sorted_signatures, order = self._sorted[table]
+            for probe in self._probe_signatures(signature):
+                probe = np.uint64(probe)
+                start = np.searchsorted(sorted_signatures, probe, side="left")
+                end = np.searchsorted(sorted_signatures, probe, side="right")
+                found.append(order[start:end])
+                found.append(np.array(self._unmerged[table].get(int(probe), ()), dtype=np.int64))
+
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.unique(np.concatenate(found).astype(np.int64))
+
+    def query(self, vector: Union[np.ndarray, scipy.sparse.spmatrix], k: int,
+              exclude: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """ The approximate k nearest rows to vector and their cosine similarities """
+        vector = as_rows(vector)
+        rows = self.candidates(vector)
+        if exclude is not None:
+            rows = rows[rows != exclude]
+
+        scores = (self.vectors[rows] @ vector.T).toarray().ravel()
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[top], scores[top]
+
+        order = np.argsort(-scores, kind="stable")
+        return rows[order], scores[order]
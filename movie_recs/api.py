@@ -0,0 +1,69 @@
+""" Provides a blueprint with JSON routes """
+
+from flask import Blueprint, abort, jsonify, request
+
+from .db import get_movie_by_slug
+from .jobs import get_job
+from .movies import search_arguments
+from .recommend import get_similar_movies
+from .search import search_movies
+
+bp = Blueprint("api", __name__, url_prefix="/api")
+
+
+@bp.route("/movies/<string:slug>/similar")
+def similar_movies(slug: str):
+    """ List the movies most similar to a movie """
+    if get_movie_by_slug(slug) is None:
+        abort(404)
+
+    limit = request.args.get("limit", type=int)
+    similar = [
+        {
+            "slug": movie["slug"],
+            "title": movie["Title"],
+            "score": movie["score"],
+        }
+        for movie in get_similar_movies(slug, limit)
+    ]
+
+    return jsonify({"slug": slug, "similar": similar})
+
+
+@bp.route("/movies/search")
+def search_movies_api():
+    """ Search movie titles, optionally filtered by genre, year and director """
+    query, filters, limit = search_arguments()
+    result = search_movies(query, filters, limit)
+
+    return jsonify({
+        "query": query,
+        "filters": filters,
+        "total": result.total,
+        "results": [
+            {"slug": slug, "title": title}
+            for slug, title in zip(result.slugs, result.titles)
+        ],
+        "facets": {
+            facet: [{"value": value, "count": count} for value, count in values]
+            for facet, values in result.facets.items()
+        },
+    })
+
+
+@bp.route("/jobs/<string:job_id>")
+def job_status(job_id: str):
+    """ Report whether a queued job has run, for clients polling for it """
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify({
+        "id": job_id,
+        "type": job["type"],
+        "title": job.get("title"),
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "slug": job.get("slug"),
+        "error": job.get("error"),
+    })
@@ -1,15 +1,43 @@
 """ Provides authentication blueprint """
 import functools
 
-from flask import (Blueprint, flash, g, redirect, render_template, request,
-                   session, url_for)
+from flask import (Blueprint, current_app, flash, g, redirect,
+                   render_template, request, session, url_for)
 from pymongo.errors import DuplicateKeyError
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from .db import add_user, get_user_by_id, get_user_by_username
+from .cache import TTLCache
+from .db import (add_user, get_user_by_id, get_user_by_username,
+                 update_user_password_hash)
+from .passwords import hash_password, needs_rehash, verify_password
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
+USER_CACHE_EXTENSION_NAME = "movie_recs.user_cache"
+
+
+def get_user_cache() -> TTLCache:
+    """ Provides the cache of recently loaded users for the current app """
+    cache = current_app.extensions.get(USER_CACHE_EXTENSION_NAME)
+
+    if cache is None:
+        config = current_app.config
+        cache = current_app.extensions.setdefault(
+            USER_CACHE_EXTENSION_NAME,
+            TTLCache(config["AUTH_USER_CACHE_SIZE"], config["AUTH_USER_CACHE_TTL"])
+        )
+
+    return cache
+
+
+def get_user_cache_stats() -> dict:
+    """ Report hit/miss counters for the user cache """
+    return get_user_cache().stats()
+
+
+def invalidate_user(user_id: str):
+    """ Drop a user from the cache after they log out or their data changes """
+    get_user_cache().delete(user_id)
+
 
 @bp.route("/register", methods=("GET", "POST"))
 def register():
@@ -26,7 +54,7 @@ def register():
             error = "Password is required"
 
         if error is None:
-            password_hash = generate_password_hash(password)
+            password_hash = hash_password(password)
             try:
                 add_user(username, password_hash)
             except DuplicateKeyError:
@@ -51,12 +79,20 @@ def login():
 
         if user is None:
             error = "Incorrect username."
-        elif not check_password_hash(user["password_hash"], password):
+        elif not verify_password(user["password_hash"], password):
             error = "Incorrect password."
 
         if error is None:
+            if needs_rehash(user["password_hash"]):
+                user["password_hash"] = hash_password(password)
+                update_user_password_hash(user["_id"], user["password_hash"])
+                invalidate_user(user["_id"])
+
             session.clear()
             session["user_id"] = user["_id"]
+            if current_app.config["AUTH_SESSION_CLAIMS"]:
+                session["username"] = user["username"]
+            get_user_cache().set(user["_id"], user)
             g.user = user
 
             return redirect(url_for("index"))
@@ -69,6 +105,10 @@ def login():
 @bp.route("/logout")
 def logout():
     """ Log the current user out """
+    user_id = session.get("user_id")
+    if user_id is not None:
+        invalidate_user(user_id)
+
     session.clear()
     g.user = None
     return redirect(url_for("index"))
@@ -81,8 +121,20 @@ def load_logged_in_user():
 
     if user_id is None:
         g.user = None
+    elif current_app.config["AUTH_SESSION_CLAIMS"] and "username" in session:
+        # The session cookie is signed, so its claims can stand in for the user
+        g.user = {"_id": user_id, "username": session["username"]}
     else:
-        g.user = get_user_by_id(user_id)
+        cache = get_user_cache()
+        user = cache.get(user_id)
+
+        if user is None:
+            user = get_user_by_id(user_id)
+            if user is not None:
+                cache.set(user_id, user)
+
+        # Copy so changes made during a request don't leak into the cache
+        g.user = dict(user) if user is not None else None
 
 
 def login_required(view):
@@ -92,6 +144,6 @@ def login_required(view):
         if g.user is None:
             return redirect(url_for("auth.login"))
 
-        return view(**kwargs)
+        return current_app.ensure_sync(view)(**kwargs)
 
     return wrapped_view
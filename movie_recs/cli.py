@@ -1,32 +1,379 @@
 """ Sets up command line commands"""
+import datetime
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
 import click
-from flask import Flask
+from flask import Flask, current_app
 from flask.cli import with_appcontext
 
-from .db import add_movie, clear_db, init_collections
+from .collaborative import build_similarities
+from .db import (
+    add_movies, clear_db, get_db, init_collections, migrate_movies, refresh_movies, upsert_movies,
+)
+from .importer import (
+    FORMATS, ImportProgress, detect_format, import_movies, load_checkpoint, open_lines,
+    save_checkpoint,
+)
+from .jobs import run_worker
 from .movie_list import top_100_classic_movies
-from .omdb import get_movie_data
+from .omdb import defer_synopsis, get_movie_data, iter_movie_data, iterate_sync
+from .query_plans import QUERY_PLANS, check_query_plans
+from .recommend import build_index
+from .titles import index_all_titles, resolve_titles
+
+
+class FetchResult(NamedTuple):
+    """ The outcome of fetching a single title """
+    title: str
+    movie_data: Optional[dict]
+    error: Optional[Exception]
+
+
+class InitResult(NamedTuple):
+    """ Summary of an init-db run """
+    added: int
+    failures: List[Tuple[str, str]]
+    elapsed: float
+    refreshed: int = 0
+    unchanged: int = 0
+
+
+def fetch_movies(
+    titles: Iterable[str], workers: int, refresh: bool = False,
+) -> Iterator[FetchResult]:
+    """ Fetch movie data for titles using a bounded pool of worker threads
+
+    Results are yielded as they complete. At most twice as many titles as
+    there are workers are in flight at once, so titles can be streamed from
+    an arbitrarily large source. With refresh, every title is fetched from
+    the OMDB rather than the local cache.
+    """
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+
+    def fetch(title: str) -> dict:
+        with app.app_context():
+            return get_movie_data(title, refresh=refresh)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def collect(futures):
+            for future in futures:
+                title = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    yield FetchResult(title, future.result(), None)
+                else:
+                    yield FetchResult(title, None, error)
+
+        for title in titles:
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+
+            pending[executor.submit(fetch, title)] = title
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from collect(done)
+
+
+def fetch_movies_async(
+    titles: Iterable[str], concurrency: int, refresh: bool = False,
+) -> Iterator[FetchResult]:
+    """ Fetch movie data for titles with the asyncio OMDB client
+
+    Results are yielded as they complete, with at most concurrency titles
+    in flight at once on a single thread.
+    """
+    for title, movie_data, error in iterate_sync(iter_movie_data(titles, concurrency, refresh)):
+        yield FetchResult(title, movie_data, error)
+
+
+def plan_seed(titles: List[str], max_age: float) -> Tuple[List[str], Dict[str, str]]:
+    """ Find the titles that aren't stored yet and the stored ones fetched over max_age ago
+
+    Stale titles are returned with the slug of the movie they refer to.
+    """
+    resolved = resolve_titles(titles)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    fetched_at = {
+        movie["slug"]: movie.get("fetched_at")
+        for movie in get_db().movies.find(
+            {"slug": {"$in": list(set(resolved.values()))}}, {"_id": 0, "slug": 1, "fetched_at": 1})
+    }
+
+    missing = [
+        title for title in dict.fromkeys(titles) if resolved.get(title) not in fetched_at
+    ]
+    stale = {
+        title: slug for title, slug in resolved.items()
+        if slug in fetched_at and (fetched_at[slug] is None or fetched_at[slug] < cutoff)
+    }
+    return missing, stale
+
+
+def init_db(
+    workers: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    use_async: Optional[bool] = None,
+    incremental: Optional[bool] = None,
+) -> InitResult:
+    """ Add classic movies to the database
+
+    By default every collection is cleared first. An incremental run leaves
+    the database in place and only fetches the classic movies that are
+    missing, or that were fetched more than INIT_DB_MAX_AGE seconds ago.
+    """
+    config = current_app.config
+    workers = workers or config["INIT_DB_WORKERS"]
+    batch_size = batch_size or config["INIT_DB_BATCH_SIZE"]
+    if use_async is None:
+        use_async = config["INIT_DB_ASYNC"]
+    if incremental is None:
+        incremental = config["INIT_DB_INCREMENTAL"]
+    fetch = fetch_movies_async if use_async else fetch_movies
+
+    start = time.perf_counter()
+
+    if incremental:
+        init_collections()
+        missing, stale = plan_seed(top_100_classic_movies, config["INIT_DB_MAX_AGE"])
+    else:
+        clear_db()
+        init_collections()
+        build_index()
+        missing, stale = list(top_100_classic_movies), {}
+
+    added = 0
+    refreshed = 0
+    failures = []
+    batch = []
+    refresh_batch = []
+
+    def flush():
+        nonlocal added, refreshed
+        if incremental:
+            inserted = upsert_movies(batch)
+            added += len(inserted)
+        else:
+            inserted_count, batch_failures = add_movies(batch)
+            added += inserted_count
+            failures.extend((movie["Title"], message)
+                            for movie, message in batch_failures)
+
+            failed_slugs = {movie["slug"] for movie, _ in batch_failures}
+            inserted = [movie for movie in batch if movie["slug"] not in failed_slugs]
+
+        refreshed += refresh_movies(refresh_batch)
+
+        for movie_data in inserted + refresh_batch:
+            defer_synopsis(movie_data)
+
+        batch.clear()
+        refresh_batch.clear()
+
+    # Add the missing classic movies to the database and refresh the stale ones
+    # Stale movies are refetched past the cache, which may be as old as they are
+    results = itertools.chain(
+        fetch(missing, workers), fetch(stale, workers, refresh=True))
+    for result in results:
+        if result.error is not None:
+            failures.append((result.title, str(result.error)))
+            continue
+
+        if result.title in stale:
+            refresh_batch.append({**result.movie_data, "slug": stale[result.title]})
+        else:
+            batch.append(result.movie_data)
+
+        if len(batch) + len(refresh_batch) >= batch_size:
+            flush()
 
+    flush()
 
-def init_db():
-    """ Clear all collections from the database, then add classic movies"""
-    clear_db()
-    init_collections()
+    # Rebuild here rather than leave the new and refreshed movies to a worker
+    if not incremental or refreshed or added:
+        build_index()
 
-    # Add all top 100 classic movies to the database
-    for movie_title in top_100_classic_movies:
-        movie_data = get_movie_data(movie_title)
-        add_movie(movie_data)
+    return InitResult(
+        added, failures, time.perf_counter() - start, refreshed,
+        len(set(top_100_classic_movies)) - len(missing) - len(stale),
+    )
 
 
 @click.command("init-db")
+@click.option("--workers", type=click.IntRange(min=1), help="Number of concurrent OMDB fetches")
+@click.option("--batch-size", type=click.IntRange(min=1), help="Number of movies per insert")
+@click.option("--async/--threads", "use_async", default=None,
+              help="Fetch with the asyncio OMDB client instead of a thread pool")
+@click.option("--incremental/--reset", default=None,
+              help="Only fetch missing or stale movies instead of clearing the database")
 @with_appcontext
-def init_db_command():
+def init_db_command(workers, batch_size, use_async, incremental):
     """ CLI command to initialize database """
-    init_db()
+    result = init_db(workers, batch_size, use_async, incremental)
+
+    for title, message in result.failures:
+        click.echo(f"Failed to add \"{title}\": {message}", err=True)
+
+    throughput = (result.added + result.refreshed) / result.elapsed if result.elapsed else 0
+    click.echo(
+        f"Added {result.added} movies in {result.elapsed:.2f}s "
+        f"({throughput:.1f} movies/s), {len(result.failures)} failed"
+    )
+    if result.refreshed or result.unchanged:
+        click.echo(f"Refreshed {result.refreshed} stale movies, {result.unchanged} unchanged")
     click.echo("Initialized the database")
 
 
+@click.command("build-recommendations")
+@with_appcontext
+def build_recommendations_command():
+    """ CLI command to rebuild the recommendation index from scratch """
+    start = time.perf_counter()
+    index = build_index()
+    click.echo(
+        f"Indexed {len(index.slugs)} movies with {len(index.vocabulary)} features "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+
+@click.command("build-collaborative")
+@with_appcontext
+def build_collaborative_command():
+    """ CLI command to recompute movie similarities from users' watchlists and ratings """
+    start = time.perf_counter()
+    count = build_similarities()
+    click.echo(f"Found neighbours for {count} movies in {time.perf_counter() - start:.2f}s")
+
+
+@click.command("index-titles")
+@with_appcontext
+def index_titles_command():
+    """ CLI command to register the titles of every stored movie for local lookup """
+    click.echo(f"Indexed the titles of {index_all_titles()} movies")
+
+
+@click.command("import-movies")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(FORMATS),
+              help="The file's format, if its extension doesn't give it")
+@click.option("--workers", type=click.IntRange(min=1), help="Number of concurrent OMDB fetches")
+@click.option("--chunk-size", type=click.IntRange(min=1), help="Number of lines per bulk write")
+@click.option("--async/--threads", "use_async", default=None,
+              help="Fetch with the asyncio OMDB client instead of a thread pool")
+@click.option("--checkpoint", type=click.Path(dir_okay=False),
+              help="Where to record progress, by default PATH.checkpoint")
+@click.option("--restart", is_flag=True, help="Ignore any checkpoint and start from the top")
+@with_appcontext
+def import_movies_command(path, file_format, workers, chunk_size, use_async, checkpoint, restart):
+    """ CLI command to add every movie named in a file of titles or IMDb IDs
+
+    An interrupted import resumes from its checkpoint when run again.
+    """
+    config = current_app.config
+    workers = workers or config["INIT_DB_WORKERS"]
+    if use_async is None:
+        use_async = config["INIT_DB_ASYNC"]
+    checkpoint = checkpoint or f"{path}.checkpoint"
+    start = ImportProgress(0, 0, 0, 0) if restart else load_checkpoint(checkpoint)
+
+    if start.records:
+        click.echo(f"Resuming after {start.records} records")
+
+    started = time.perf_counter()
+    with click.progressbar(length=os.path.getsize(path), label="Importing") as progress_bar:
+
+        def on_chunk(progress, failures):
+            save_checkpoint(checkpoint, progress)
+            for title, message in failures:
+                click.echo(f"\nFailed to add \"{title}\": {message}", err=True)
+
+        result = import_movies(
+            open_lines(path, progress_bar.update),
+            file_format or detect_format(path),
+            fetch_movies_async if use_async else fetch_movies,
+            workers,
+            chunk_size,
+            start,
+            on_chunk,
+        )
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    click.echo(
+        f"Read {result.records} records in {time.perf_counter() - started:.2f}s: "
+        f"added {result.added}, skipped {result.skipped}, {result.failed} failed"
+    )
+
+
+@click.command("migrate-movies")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000,
+              help="Number of movies per bulk write")
+@with_appcontext
+def migrate_movies_command(batch_size):
+    """ CLI command to convert stored movies to the typed document schema """
+    start = time.perf_counter()
+    count = migrate_movies(batch_size)
+    click.echo(f"Migrated {count} movies in {time.perf_counter() - start:.2f}s")
+
+
+@click.command("check-query-plans")
+@with_appcontext
+def check_query_plans_command():
+    """ CLI command to check that every query is answered from an index """
+    problems = check_query_plans()
+
+    for problem in problems:
+        click.echo(
+            f"{problem.query} {problem.problem} ({' > '.join(problem.stages)})", err=True)
+
+    click.echo(f"Checked {len(QUERY_PLANS)} queries, {len(problems)} problems")
+    if problems:
+        raise SystemExit(1)
+
+
+def _run_worker_process(app: Flask, burst: bool):
+    with app.app_context():
+        run_worker(burst)
+
+
+@click.command("jobs-worker")
+@click.option("--processes", type=click.IntRange(min=1), default=1,
+              help="Number of worker processes to run")
+@click.option("--burst", is_flag=True, help="Stop once there are no jobs to run")
+@with_appcontext
+def jobs_worker_command(processes, burst):
+    """ CLI command to run queued jobs, such as adding movies """
+    if processes == 1:
+        click.echo(f"Ran {run_worker(burst)} jobs")
+        return
+
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    workers = [
+        multiprocessing.Process(target=_run_worker_process, args=(app, burst))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
 def add_cli_commands(app: Flask):
     """ Add all cli commands to app """
     app.cli.add_command(init_db_command)
+    app.cli.add_command(build_recommendations_command)
+    app.cli.add_command(build_collaborative_command)
+    app.cli.add_command(index_titles_command)
+    app.cli.add_command(import_movies_command)
+    app.cli.add_command(migrate_movies_command)
+    app.cli.add_command(check_query_plans_command)
+    app.cli.add_command(jobs_worker_command)
@@ -0,0 +1,201 @@
+""" Item-item collaborative filtering over users' watchlists, watched movies and ratings
+
+Every recorded movie counts as an interaction weighted by how strongly it
+suggests the user likes it. Two movies are similar when the same users
+interact with them, measured as the cosine between their columns of the
+sparse user x movie interaction matrix. The similarities are computed in a
+batch job and stored in the item_similarities collection, so personalizing
+a page only has to combine the stored neighbours of the user's own movies.
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from flask import current_app
+from pymongo import UpdateOne
+
+from .db import bump_version, get_db, get_movies_by_slugs, get_user_movies
+
+# How much each kind of interaction says about a user's taste
+STATUS_WEIGHTS = {
+    "watchlist": 0.5,
+    "watched": 1.0,
+}
+
+MAX_RATING = 5
+
+# A pair of movie columns is packed into one key as (low << PAIR_SHIFT) | high
+PAIR_SHIFT = 32
+
+
+def interaction_weight(record: dict) -> float:
+    """ The weight of a user's record for a movie; a rating outweighs its status """
+    if record.get("rating") is not None:
+        return record["rating"] / MAX_RATING
+    return STATUS_WEIGHTS.get(record.get("status"), 0.0)
+
+
+def _iter_user_interactions(max_items: int) -> Iterator[List[dict]]:
+    """ Yields the most recent interactions of each user in turn """
+    records = get_db().user_movies.find(
+        {}, {"_id": 0, "user_id": 1, "slug": 1, "status": 1, "rating": 1, "updated": 1}
+    ).sort([("user_id", 1), ("updated", 1)])
+
+    user_id, interactions = None, []
+    for record in records:
+        if record["user_id"] != user_id and interactions:
+            yield interactions[-max_items:]
+            interactions = []
+        user_id = record["user_id"]
+        interactions.append(record)
+
+    if interactions:
+        yield interactions[-max_items:]
+
+
+def _sum_pairs(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Combine the values of repeated keys, as building a COO matrix would """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    return unique_keys, np.bincount(inverse, weights=values, minlength=len(unique_keys))
+
+
+def _top_pairs(keys: np.ndarray, values: np.ndarray,
+               max_pairs: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Keep only the max_pairs pairs with the largest co-occurrence """
+    if len(keys) <= max_pairs:
+        return keys, values
+
+    keep = np.argpartition(-values, max_pairs - 1)[:max_pairs]
+    keep.sort()
+    return keys[keep], values[keep]
+
+
+def item_similarities(
+    users: Iterable[List[Tuple[str, float]]], neighbors: int,
+    max_pairs: int = 5_000_000, chunk_pairs: int = 1_000_000,
+) -> Dict[str, List[dict]]:
+    """ The most similar movies to each movie, given every user's weighted movies
+
+    Users are read one at a time. The co-occurrence matrix is only ever held
+    as its non-zero upper triangle: the pairs of each user are buffered
+    until there are chunk_pairs of them, then merged into the running sums.
+    Once those hold more than max_pairs pairs, the weakest are dropped, so
+    memory stays bounded however many users there are at the cost of
+    missing pairs that only a few users share.
+    """
+    columns: Dict[str, int] = {}
+    norms = defaultdict(float)
+    pair_keys = np.zeros(0, dtype=np.int64)
+    pair_values = np.zeros(0, dtype=np.float64)
+    chunk_keys, chunk_values = [], []
+    buffered = 0
+
+    def flush():
+        nonlocal pair_keys, pair_values, buffered
+        if chunk_keys:
+            pair_keys, pair_values = _top_pairs(*_sum_pairs(
+                np.concatenate([pair_keys] + chunk_keys),
+                np.concatenate([pair_values] + chunk_values),
+            ), max_pairs)
+            chunk_keys.clear()
+            chunk_values.clear()
+            buffered = 0
+
+    for interactions in users:
+        items = np.array(
+            [columns.setdefault(slug, len(columns)) for slug, _ in interactions], dtype=np.int64)
+        weights = np.array([weight for _, weight in interactions], dtype=np.float64)
+
+        for item, weight in zip(items.tolist(), weights.tolist()):
+            norms[item] += weight * weight
+
+        first, second = np.triu_indices(len(items), k=1)
+        low = np.minimum(items[first], items[second])
+        high = np.maximum(items[first], items[second])
+        chunk_keys.append((low << PAIR_SHIFT) | high)
+        chunk_values.append(weights[first] * weights[second])
+
+        buffered += len(first)
+        if buffered >= chunk_pairs:
+            flush()
+
+    flush()
+
+    count = len(columns)
+    if count == 0 or len(pair_keys) == 0:
+        return {}
+
+    norm = np.sqrt(np.array([norms[item] for item in range(count)]))
+    low, high = pair_keys >> PAIR_SHIFT, pair_keys & ((1 << PAIR_SHIFT) - 1)
+    scores = pair_values / (norm[low] * norm[high])
+
+    keep = scores > 0
+    rows = np.concatenate([low[keep], high[keep]])
+    others = np.concatenate([high[keep], low[keep]])
+    scores = np.concatenate([scores[keep], scores[keep]])
+
+    order = np.lexsort((-scores, rows))
+    rows, others, scores = rows[order], others[order], scores[order]
+
+    starts = np.searchsorted(rows, np.arange(count), side="left")
+    ranks = np.arange(len(rows)) - starts[rows]
+    top = ranks < neighbors
+
+    slugs = list(columns)
+    similar: Dict[str, List[dict]] = defaultdict(list)
+    for row, other, score in zip(rows[top].tolist(), others[top].tolist(), scores[top].tolist()):
+        similar[slugs[row]].append({"slug": slugs[other], "score": score})
+
+    return similar
+
+
+def build_similarities() -> int:
+    """ Recompute every movie's neighbours from all recorded interactions
+
+    Interactions are streamed from the database a user at a time. Returns
+    the number of movies with neighbours.
+    """
+    config = current_app.config
+    users = (
+        [(record["slug"], interaction_weight(record)) for record in interactions]
+        for interactions in _iter_user_interactions(config["RECS_CF_MAX_USER_ITEMS"])
+    )
+    similar = item_similarities(users, config["RECS_CF_NEIGHBORS"], config["RECS_CF_MAX_PAIRS"])
+
+    collection = get_db().item_similarities
+    operations = [
+        UpdateOne({"slug": slug}, {"$set": {"similar": neighbors}}, upsert=True)
+        for slug, neighbors in similar.items()
+    ]
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    collection.delete_many({"slug": {"$nin": list(similar)}})
+    bump_version("item_similarities")
+
+    return len(similar)
+
+
+def recommend_for_user(user_id: str, limit: Optional[int] = None) -> List[dict]:
+    """ Returns the movies the user is most likely to want, best first
+
+    Each stored neighbour of a movie the user has recorded is scored by its
+    similarity weighted by the user's interaction; movies the user has
+    already recorded are left out. Each movie has the fields needed to list
+    it plus its score.
+    """
+    if limit is None:
+        limit = current_app.config["RECS_PERSONAL_SHOWN"]
+
+    weights = {record["slug"]: interaction_weight(record) for record in get_user_movies(user_id)}
+    if not weights:
+        return []
+
+    scores = defaultdict(float)
+    for item in get_db().item_similarities.find({"slug": {"$in": list(weights)}}):
+        for neighbor in item["similar"]:
+            if neighbor["slug"] not in weights:
+                scores[neighbor["slug"]] += neighbor["score"] * weights[item["slug"]]
+
+    best = sorted(scores, key=lambda slug: (-scores[slug], slug))[:limit]
+
+    return [{**movie, "score": scores[movie["slug"]]} for movie in get_movies_by_slugs(best)]
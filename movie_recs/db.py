@@ -1,31 +1,241 @@
 """ Manages connection to a mongoDb database """
+import datetime
+import itertools
+import os
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
 
 from bson.objectid import ObjectId
 from flask import Flask, current_app, g
 import pymongo
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .metrics import CommandTimer, add_time, get_metrics
+from .schema import LISTING_FIELDS, normalize_movie
+
+EXTENSION_NAME = "movie_recs.db"
+LISTENERS_EXTENSION_NAME = "movie_recs.movie_listeners"
+VERSIONS_EXTENSION_NAME = "movie_recs.versions"
+
+# Fields used to render a movie in movies/list.html
+LIST_PROJECTION = {field: 1 for field in LISTING_FIELDS}
+
+
+class MoviePage(NamedTuple):
+    """ One page of movies along with the cursors of its neighbouring pages """
+    movies: List[dict]
+    next_cursor: Optional[str]
+    prev_cursor: Optional[str]
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """ Keeps running counts of connection pool events for a client """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkout_starts = threading.local()
+        self.stats = {
+            "checkout_wait_seconds": 0.0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checked_out": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "pools_cleared": 0,
+        }
+
+    def _add(self, key: str, amount: float = 1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def snapshot(self) -> dict:
+        """ Return a copy of the current counts """
+        with self._lock:
+            return dict(self.stats)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add("connections_closed")
+
+    def connection_check_out_started(self, event):
+        self._checkout_starts.start = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failures")
+        self._end_wait()
+
+    def connection_checked_out(self, event):
+        self._add("checkouts")
+        self._add("checked_out")
+        self._end_wait()
+
+    def _end_wait(self):
+        """ Count the time since this thread started checking out a connection as waiting """
+        start = getattr(self._checkout_starts, "start", None)
+        if start is None:
+            return
+
+        self._checkout_starts.start = None
+        wait = time.perf_counter() - start
+        self._add("checkout_wait_seconds", wait)
+        add_time("mongo", wait)
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+
+class _ClientState:
+    """ The process-wide client for an app, along with the process that owns it """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.client = None
+        self.pid = None
+        self.listener = None
+        self.indexed = False
+
+
+def _get_state(app: Flask) -> _ClientState:
+    return app.extensions.setdefault(EXTENSION_NAME, _ClientState())
+
+
+def _create_client(app: Flask, listener: PoolStatsListener) -> pymongo.MongoClient:
+    """ Build a new client using the pool settings from the app config
+
+    When metrics are enabled, its commands are timed too.
+    """
+    config = app.config
+    username = config["DB_USER"]
+    password = config["DB_PASSWORD"]
+    host = config["DB_HOST"]
+    port = config["DB_PORT"]
+    uri = f"mongodb://{username}:{password}@{host}:{port}"
+
+    listeners = [listener]
+    if config["METRICS_ENABLED"]:
+        listeners.append(CommandTimer(get_metrics(app)))
+
+    return pymongo.MongoClient(
+        uri,
+        maxPoolSize=config["DB_MAX_POOL_SIZE"],
+        minPoolSize=config["DB_MIN_POOL_SIZE"],
+        maxIdleTimeMS=config["DB_MAX_IDLE_TIME_MS"],
+        connectTimeoutMS=config["DB_CONNECT_TIMEOUT_MS"],
+        serverSelectionTimeoutMS=config["DB_SERVER_SELECTION_TIMEOUT_MS"],
+        waitQueueTimeoutMS=config["DB_WAIT_QUEUE_TIMEOUT_MS"],
+        event_listeners=listeners,
+    )
+
+
+def get_client() -> pymongo.MongoClient:
+    """ Provides the client shared by every request in this process
+
+    The client is created lazily on first use. A client inherited from a
+    parent process (e.g. a preloading gunicorn/uwsgi master) is discarded
+    and replaced, since pymongo clients are not fork-safe.
+    """
+    state = _get_state(current_app)
+    pid = os.getpid()
+
+    if state.client is None or state.pid != pid:
+        with state.lock:
+            if state.client is None or state.pid != pid:
+                state.listener = PoolStatsListener()
+                state.client = _create_client(current_app, state.listener)
+                state.pid = pid
+
+    return state.client
 
 
 def get_db() -> pymongo.database.Database:
     """Provides access to the database"""
 
     if "database" not in g:
-        username = current_app.config["DB_USER"]
-        password = current_app.config["DB_PASSWORD"]
-        host = current_app.config["DB_HOST"]
-        port = current_app.config["DB_PORT"]
-        uri = f"mongodb://{username}:{password}@{host}:{port}"
-        client = pymongo.MongoClient(uri)
-        g.database = client[current_app.config["DB_NAME"]]
+        g.database = get_client()[current_app.config["DB_NAME"]]
+        _ensure_indexes()
 
     return g.database
 
 
 def close_db(_=None):
-    """ Closes the database connection """
-    database: pymongo.database.Database = g.pop("database", None)
+    """ Releases the database for the current app context
+
+    The underlying client is shared by the whole process, so it is left open.
+    """
+    g.pop("database", None)
+
 
-    if database is not None:
-        database.client.close()
+def close_client(app: Flask):
+    """ Close the process-wide client for app, if one has been created """
+    state = _get_state(app)
+
+    with state.lock:
+        if state.client is not None and state.pid == os.getpid():
+            state.client.close()
+        state.client = None
+        state.pid = None
+
+
+def get_pool_stats() -> dict:
+    """ Report connection pool counters for the current process's client """
+    state = _get_state(current_app)
+    stats = {
+        "pid": os.getpid(),
+        "client_created": state.client is not None and state.pid == os.getpid(),
+        "max_pool_size": current_app.config["DB_MAX_POOL_SIZE"],
+    }
+
+    if state.listener is not None:
+        stats.update(state.listener.snapshot())
+
+    return stats
+
+
+def add_movie_listener(app: Flask, listener: Callable[[str, List[dict]], None]):
+    """ Register a function to call after movies are written
+
+    The listener is called with "added" and the new movie documents after an
+    insert, or "updated" and the changed fields (plus slug) after an update.
+    """
+    app.extensions.setdefault(LISTENERS_EXTENSION_NAME, []).append(listener)
+
+
+def _notify_movie_listeners(event: str, movies: List[dict]):
+    """ Pass a movie write on to every registered listener
+
+    The write has already happened, so a listener that fails is logged
+    rather than failing the caller.
+    """
+    if not movies:
+        return
+
+    for listener in current_app.extensions.get(LISTENERS_EXTENSION_NAME, ()):
+        try:
+            listener(event, movies)
+        except Exception:  # pylint: disable=broad-except
+            current_app.logger.exception(
+                "Movie listener %r failed on %s movies", listener, event)
+
+    bump_version("movies")
 
 
 def clear_db():
@@ -35,20 +245,283 @@ def clear_db():
     for collection in database.list_collection_names():
         database.drop_collection(collection)
 
-
-def init_collections():
-    """ Set up collections in database with indices """
+    current_app.extensions.pop(VERSIONS_EXTENSION_NAME, None)
+
+
+def get_version(name: str) -> str:
+    """ Returns a token that changes whenever the data called name is written
+
+    Tokens are read from the meta collection at most once every
+    DB_VERSION_TTL seconds per process, while this process's own writes are
+    seen immediately.
+    """
+    versions = current_app.extensions.setdefault(VERSIONS_EXTENSION_NAME, {})
+    version, fetched = versions.get(name, (None, None))
+
+    if fetched is None or time.monotonic() - fetched > current_app.config["DB_VERSION_TTL"]:
+        document = get_db().meta.find_one({"_id": name})
+        version = document["version"] if document is not None else "0"
+        versions[name] = (version, time.monotonic())
+
+    return version
+
+
+def bump_version(name: str):
+    """ Record that the data called name has been written """
+    version = str(ObjectId())
+    get_db().meta.update_one({"_id": name}, {"$set": {"version": version}}, upsert=True)
+    current_app.extensions.setdefault(VERSIONS_EXTENSION_NAME, {})[name] = (
+        version, time.monotonic())
+
+
+class IndexSpec(NamedTuple):
+    """ An index that a collection should have """
+    collection: str
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+    sparse: bool = False
+    # Seconds after the date in the indexed field that MongoDB removes a document
+    expire_after: Optional[int] = None
+
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# Every index the app's queries rely on. init_collections creates any that
+# are missing, and query_plans checks that the queries in QUERY_PLANS use them.
+INDEXES = [
+    IndexSpec("movies", [("slug", ASC)], unique=True),
+    IndexSpec("movies", [("imdbID", ASC)], sparse=True),
+    IndexSpec("movies", [("genres", ASC), ("year", DESC)]),
+    IndexSpec("movies", [("genre_keys", ASC), ("year", DESC)]),
+    IndexSpec("movies", [("year", DESC)]),
+    IndexSpec("movies", [("fetched_at", ASC)]),
+    IndexSpec("movies", [("updated_at", ASC)]),
+    IndexSpec("users", [("username", ASC)], unique=True),
+    IndexSpec("recommendations", [("slug", ASC)], unique=True),
+    IndexSpec("item_similarities", [("slug", ASC)], unique=True),
+    IndexSpec("aliases", [("key", ASC)], unique=True),
+    IndexSpec("aliases", [("key", ASC), ("slug", ASC)]),
+    IndexSpec("jobs", [("key", ASC)], unique=True),
+    IndexSpec("jobs", [("status", ASC), ("run_after", ASC)]),
+    IndexSpec("jobs", [("expires_at", ASC)], expire_after=0),
+    IndexSpec("user_movies", [("user_id", ASC), ("slug", ASC)], unique=True),
+    IndexSpec("user_movies", [("user_id", ASC), ("updated", ASC)]),
+]
+
+
+def init_collections() -> List[str]:
+    """ Set up collections in database with indices
+
+    Only the indexes in INDEXES that don't exist yet are created, so this is
+    cheap to run at every startup. An index whose keys exist with other
+    options is left alone and logged, since changing it means a rebuild.
+    Returns the names of the indexes created.
+    """
     database = get_db()
-
-    database.movies.create_index("slug", unique=True)
-    database.users.create_index("username", unique=True)
+    created = []
+
+    for collection_name, specs in itertools.groupby(INDEXES, key=lambda spec: spec.collection):
+        collection = database[collection_name]
+        existing = {
+            tuple(tuple(key) for key in info["key"]): info
+            for info in collection.index_information().values()
+        }
+
+        for spec in specs:
+            options = {"unique": spec.unique, "sparse": spec.sparse}
+            info = existing.get(tuple(spec.keys))
+
+            if info is None:
+                kwargs = {name: True for name, value in options.items() if value}
+                if spec.expire_after is not None:
+                    kwargs["expireAfterSeconds"] = spec.expire_after
+                created.append(collection.create_index(spec.keys, **kwargs))
+            elif (any(bool(info.get(name)) != value for name, value in options.items())
+                  or info.get("expireAfterSeconds") != spec.expire_after):
+                current_app.logger.warning(
+                    "Index %s on %s exists with different options, leaving it as it is",
+                    spec.keys, collection_name)
+
+    return created
+
+
+def _ensure_indexes():
+    """ Create missing indexes the first time this app uses the database """
+    state = _get_state(current_app)
+    if state.indexed or not current_app.config["DB_ENSURE_INDEXES"]:
+        return
+
+    state.indexed = True
+    try:
+        init_collections()
+    except PyMongoError as error:
+        state.indexed = False
+        current_app.logger.warning("Could not create indexes: %s", error)
+
+
+def _prepare(movie_data: dict, now: datetime.datetime) -> dict:
+    """ Normalize a movie for storage, recording when its OMDB data was fetched
+
+    The movie starts at revision 1. Every later write increments it, so
+    anything cached from a movie can be keyed by its slug and revision, and
+    sets updated_at, so other processes can find the movies changed since
+    they last looked.
+    """
+    movie = normalize_movie({
+        key: value for key, value in movie_data.items() if key not in ("_id", "revision")
+    })
+    movie.setdefault("fetched_at", now)
+    movie["revision"] = 1
+    movie["updated_at"] = now
+    return movie
 
 
 def add_movie(movie_data: dict):
     """ Adds a single movie to the database """
     database = get_db()
     movie_collection = database.movies
-    movie_collection.insert_one(movie_data)
+    movie = _prepare(movie_data, datetime.datetime.utcnow())
+    movie_collection.insert_one(movie)
+    _notify_movie_listeners("added", [movie])
+
+
+def add_movies(movies: List[dict]) -> Tuple[int, List[Tuple[dict, str]]]:
+    """ Adds a batch of movies, skipping any that fail to insert
+
+    Returns the number of movies inserted along with each movie that failed
+    and the reason it failed.
+    """
+    if not movies:
+        return 0, []
+
+    database = get_db()
+    now = datetime.datetime.utcnow()
+    prepared = [_prepare(movie, now) for movie in movies]
+
+    try:
+        result = database.movies.insert_many(prepared, ordered=False)
+    except BulkWriteError as error:
+        write_errors = error.details["writeErrors"]
+        failures = [
+            (movies[write_error["index"]], write_error["errmsg"])
+            for write_error in write_errors
+        ]
+        failed_indexes = {write_error["index"] for write_error in write_errors}
+        _notify_movie_listeners(
+            "added",
+            [movie for i, movie in enumerate(prepared) if i not in failed_indexes]
+        )
+        return error.details["nInserted"], failures
+
+    _notify_movie_listeners("added", prepared)
+    return len(result.inserted_ids), []
+
+
+def upsert_movies(movies: List[dict]) -> List[dict]:
+    """ Insert each movie whose slug isn't already stored, leaving stored ones untouched
+
+    Returns the movies that were inserted. Unlike add_movies, running this
+    twice, or alongside another writer, never fails on a duplicate slug.
+    """
+    if not movies:
+        return []
+
+    now = datetime.datetime.utcnow()
+    unique = list({movie["slug"]: _prepare(movie, now) for movie in movies}.values())
+    result = get_db().movies.bulk_write(
+        [
+            UpdateOne({"slug": movie["slug"]}, {"$setOnInsert": movie}, upsert=True)
+            for movie in unique
+        ],
+        ordered=False,
+    )
+
+    inserted = []
+    for index, movie_id in result.upserted_ids.items():
+        movie = unique[index]
+        movie["_id"] = movie_id
+        inserted.append(movie)
+
+    _notify_movie_listeners("added", inserted)
+    return inserted
+
+
+def refresh_movies(movies: List[dict]) -> int:
+    """ Overwrite stored movies with newly fetched data, matched by slug
+
+    Returns the number of movies that were stored. Fields the new data
+    doesn't have are left as they are.
+    """
+    if not movies:
+        return 0
+
+    now = datetime.datetime.utcnow()
+    refreshed = [_prepare(movie, now) | {"fetched_at": now} for movie in movies]
+    for movie in refreshed:
+        del movie["revision"]
+
+    result = get_db().movies.bulk_write(
+        [
+            UpdateOne({"slug": movie["slug"]}, {"$set": movie, "$inc": {"revision": 1}})
+            for movie in refreshed
+        ],
+        ordered=False,
+    )
+
+    _notify_movie_listeners("updated", refreshed)
+    return result.matched_count
+
+
+def update_movie(slug: str, fields: dict):
+    """ Set fields on the movie with the given slug """
+    database = get_db()
+    fields = normalize_movie(fields)
+    database.movies.update_one(
+        {"slug": slug},
+        {"$set": {**fields, "updated_at": datetime.datetime.utcnow()}, "$inc": {"revision": 1}},
+    )
+    _notify_movie_listeners("updated", [{**fields, "slug": slug}])
+
+
+def migrate_movies(batch_size: int = 1000) -> int:
+    """ Normalize movies stored before their fields were typed
+
+    Returns the number of movies that were changed. Movies that are already
+    normalized are left alone, so this is safe to run more than once.
+    """
+    database = get_db()
+    now = datetime.datetime.utcnow()
+    operations = []
+    migrated = []
+    count = 0
+
+    def flush():
+        if operations:
+            database.movies.bulk_write(operations, ordered=False)
+            _notify_movie_listeners("updated", migrated)
+        operations.clear()
+        migrated.clear()
+
+    for movie in database.movies.find({}):
+        normalized = normalize_movie(movie)
+        changed = {key: value for key, value in normalized.items() if movie.get(key) != value}
+        removed = {key: "" for key in movie if key not in normalized}
+        if not changed and not removed:
+            continue
+
+        update = {"$set": {**changed, "updated_at": now}, "$inc": {"revision": 1}}
+        if removed:
+            update["$unset"] = removed
+        operations.append(UpdateOne({"_id": movie["_id"]}, update))
+        migrated.append(normalized)
+        count += 1
+
+        if len(operations) >= batch_size:
+            flush()
+
+    flush()
+    return count
 
 
 def get_movies():
@@ -60,6 +533,79 @@ def get_movies():
     return list(movie_collection.find())
 
 
+class LazyMoviePage:
+    """ A forward page of movies that is read from the database as it's iterated
+
+    next_cursor and prev_cursor are only known once iteration has finished.
+    """
+
+    def __init__(self, cursor: pymongo.cursor.Cursor, limit: int, has_prev: bool):
+        self._cursor = cursor
+        self._limit = limit
+        self._has_prev = has_prev
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    def __iter__(self):
+        for count, movie in enumerate(self._cursor):
+            if count == self._limit:
+                self.next_cursor = str(last_id)
+                break
+
+            if count == 0 and self._has_prev:
+                self.prev_cursor = str(movie["_id"])
+
+            last_id = movie["_id"]
+            yield movie
+
+        self._cursor.close()
+
+
+def iter_movies_page(after: Optional[str] = None, limit: int = 50) -> LazyMoviePage:
+    """ Returns a lazily loaded page of movies in the order they were added """
+    database = get_db()
+    movie_collection = database.movies
+
+    query = {} if after is None else {"_id": {"$gt": ObjectId(after)}}
+    cursor = movie_collection.find(
+        query, LIST_PROJECTION
+    ).sort("_id", pymongo.ASCENDING).limit(limit + 1).batch_size(min(limit + 1, 100))
+
+    return LazyMoviePage(cursor, limit, has_prev=after is not None)
+
+
+def get_movies_page(
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = 50
+) -> MoviePage:
+    """ Returns a page of movies in the order they were added
+
+    Pages are keyed on _id rather than skipped over, so a page's contents
+    don't shift when other movies are added. Only the fields needed for the
+    movie list are loaded.
+    """
+    if before is None:
+        page = iter_movies_page(after, limit)
+        movies = list(page)
+        return MoviePage(movies, page.next_cursor, page.prev_cursor)
+
+    database = get_db()
+    movie_collection = database.movies
+
+    cursor = movie_collection.find(
+        {"_id": {"$lt": ObjectId(before)}}, LIST_PROJECTION
+    ).sort("_id", pymongo.DESCENDING).limit(limit + 1)
+    movies = list(cursor)
+    has_prev = len(movies) > limit
+    movies = movies[:limit][::-1]
+
+    next_cursor = str(movies[-1]["_id"]) if movies else None
+    prev_cursor = str(movies[0]["_id"]) if movies and has_prev else None
+
+    return MoviePage(movies, next_cursor, prev_cursor)
+
+
 def get_movie_by_slug(slug: str):
     """ Returns a list of movies"""
 
@@ -81,6 +627,15 @@ def add_user(username: str, password_hash: str):
     database.users.insert_one(user_data)
 
 
+def update_user_password_hash(user_id: str, password_hash: str):
+    """ Replace a user's password hash """
+    database = get_db()
+    database.users.update_one(
+        {"_id": ObjectId(user_id)},
+        {"$set": {"password_hash": password_hash}}
+    )
+
+
 def get_user_by_username(username: str):
     """ Look up a user using their username """
     database = get_db()
@@ -105,6 +660,52 @@ def get_user_by_id(user_id: str):
     return user
 
 
+def set_user_movie(user_id: str, slug: str, fields: dict):
+    """ Record a user's status or rating for a movie, creating the record if needed """
+    database = get_db()
+    database.user_movies.update_one(
+        {"user_id": ObjectId(user_id), "slug": slug},
+        {"$set": {**fields, "updated": datetime.datetime.utcnow()}},
+        upsert=True,
+    )
+    bump_version(f"user_movies:{user_id}")
+
+
+def remove_user_movie(user_id: str, slug: str):
+    """ Forget everything a user has recorded about a movie """
+    database = get_db()
+    database.user_movies.delete_one({"user_id": ObjectId(user_id), "slug": slug})
+    bump_version(f"user_movies:{user_id}")
+
+
+def get_user_movie(user_id: str, slug: str) -> Optional[dict]:
+    """ Look up what a user has recorded about a movie """
+    database = get_db()
+    return database.user_movies.find_one(
+        {"user_id": ObjectId(user_id), "slug": slug}, {"_id": 0, "user_id": 0})
+
+
+def get_user_movies(user_id: str, status: Optional[str] = None) -> List[dict]:
+    """ Returns everything a user has recorded, optionally only with one status """
+    database = get_db()
+    query = {"user_id": ObjectId(user_id)}
+    if status is not None:
+        query["status"] = status
+
+    return list(database.user_movies.find(query, {"_id": 0, "user_id": 0}))
+
+
+def get_movies_by_slugs(slugs: List[str]) -> List[dict]:
+    """ Returns the movies with the given slugs for listing, in the same order """
+    database = get_db()
+    movies = {
+        movie["slug"]: movie
+        for movie in database.movies.find({"slug": {"$in": slugs}}, LIST_PROJECTION)
+    }
+
+    return [movies[slug] for slug in slugs if slug in movies]
+
+
 def init_app(app: Flask):
     """ Register any necessary methods with the app """
     app.teardown_appcontext(close_db)
@@ -0,0 +1,134 @@
+""" Caches the rendered HTML of the parts of pages that only depend on one movie
+
+A fragment is a template rendered with a single movie, such as its card in
+the movie list. Fragments are keyed by the template, a hash of the
+template's source and the movie's slug and revision, so editing a template
+never serves stale markup, and neither does a write to the movie made by
+any process. They're kept in an in-process LRU and, optionally, a SQLite
+file shared by every process on the host, and fragments of old revisions
+simply age out. Anything that depends on the user, like the navigation bar,
+is left out of fragments and rendered as normal.
+"""
+import hashlib
+import threading
+import time
+from typing import Optional
+
+from flask import Flask, current_app
+from markupsafe import Markup
+
+from .cache import SqliteCache, TTLCache
+
+EXTENSION_NAME = "movie_recs.fragments"
+
+
+class FragmentCache:
+    """ The caches for an app's fragments along with how long rendering took """
+
+    def __init__(self, memory: TTLCache, shared: Optional[SqliteCache]):
+        self.memory = memory
+        self.shared = shared
+        self.versions = {}
+        self.renders = 0
+        self.render_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_render(self, seconds: float):
+        """ Count a fragment that had to be rendered """
+        with self._lock:
+            self.renders += 1
+            self.render_seconds += seconds
+
+
+def get_fragment_cache() -> FragmentCache:
+    """ Provides the fragment cache for the current app """
+    cache = current_app.extensions.get(EXTENSION_NAME)
+
+    if cache is None:
+        config = current_app.config
+        shared = None
+        if config["FRAGMENT_CACHE_PATH"] is not None:
+            shared = SqliteCache(
+                config["FRAGMENT_CACHE_PATH"],
+                config["FRAGMENT_CACHE_TTL"],
+                config["FRAGMENT_CACHE_SHARED_MAX_ENTRIES"],
+            )
+
+        cache = current_app.extensions.setdefault(
+            EXTENSION_NAME,
+            FragmentCache(
+                TTLCache(config["FRAGMENT_CACHE_SIZE"], config["FRAGMENT_CACHE_TTL"]), shared),
+        )
+
+    return cache
+
+
+def template_version(cache: FragmentCache, template_name: str) -> str:
+    """ A short hash of a template's source, worked out once per process """
+    version = cache.versions.get(template_name)
+
+    if version is None:
+        source, _, _ = current_app.jinja_env.loader.get_source(
+            current_app.jinja_env, template_name)
+        version = hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+        cache.versions[template_name] = version
+
+    return version
+
+
+def _key(cache: FragmentCache, template_name: str, movie: dict) -> str:
+    version = template_version(cache, template_name)
+    return f"{template_name}:{version}:{movie['slug']}:{movie.get('revision', 0)}"
+
+
+def render_fragment(template_name: str, movie: dict) -> Markup:
+    """ Render a template with a single movie, reusing earlier renders of it """
+    template = current_app.jinja_env.get_template(template_name)
+
+    if not current_app.config["FRAGMENT_CACHE_ENABLED"]:
+        return Markup(template.render(movie=movie))
+
+    cache = get_fragment_cache()
+    key = _key(cache, template_name, movie)
+
+    html = cache.memory.get(key)
+    if html is None and cache.shared is not None:
+        html = cache.shared.get(key)
+        if html is not None:
+            cache.memory.set(key, html)
+
+    if html is None:
+        start = time.perf_counter()
+        html = template.render(movie=movie)
+        cache.record_render(time.perf_counter() - start)
+
+        cache.memory.set(key, html)
+        if cache.shared is not None:
+            cache.shared.set(key, html)
+
+    return Markup(html)
+
+
+def get_fragment_cache_stats() -> dict:
+    """ Report hit/miss counters for the fragment caches and the render time they saved
+
+    The time saved is estimated from the average time taken by the renders
+    that missed.
+    """
+    cache = get_fragment_cache()
+    average = cache.render_seconds / cache.renders if cache.renders else 0.0
+    hits = cache.memory.hits + (cache.shared.hits if cache.shared is not None else 0)
+
+    return {
+        "enabled": current_app.config["FRAGMENT_CACHE_ENABLED"],
+        "memory": cache.memory.stats(),
+        "shared": cache.shared.stats() if cache.shared is not None else None,
+        "renders": cache.renders,
+        "render_seconds": cache.render_seconds,
+        "saved_seconds": hits * average,
+    }
+
+
+def init_app(app: Flask):
+    """ Make fragments available to templates """
+    app.jinja_env.globals["render_fragment"] = render_fragment
@@ -0,0 +1,76 @@
+""" Conditional GET support for pages built from rarely changing data
+
+A page's ETag is a hash of the versions of the data it is built from (see
+db.get_version), the request's arguments and who the page is rendered for.
+So a matching If-None-Match can be answered with a 304 before the page's
+own queries run or its template is rendered.
+
+Pages for anonymous visitors are marked public so a shared cache can serve
+them; pages for a logged in user include their name in the navigation bar
+and are marked private.
+"""
+import functools
+import hashlib
+from typing import Callable, Iterable
+
+from flask import current_app, g, make_response, request, session
+
+from .db import get_version
+
+
+def page_etag(versions: Iterable[str], *parts) -> str:
+    """ Hash the versions of a page's data with anything else the page depends on """
+    key = [get_version(name) for name in versions]
+    key.extend(str(part) for part in parts)
+    key.extend(sorted(f"{name}={value}" for name, value in request.args.items(multi=True)))
+
+    if g.user is not None:
+        key.extend(["user", g.user["_id"], g.user["username"]])
+
+    return hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest()
+
+
+def _set_cache_headers(response):
+    if g.user is None:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config["HTTP_CACHE_MAX_AGE"]
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    response.vary.add("Cookie")
+    return response
+
+
+def conditional(versions: Callable[..., Iterable[str]]):
+    """ Decorator for views that can be answered with a 304 when nothing has changed
+
+    versions is called with the view's arguments and returns the names of
+    the data the page is built from.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            # Pages showing flashed messages are only right once
+            if not current_app.config["HTTP_CACHE_ENABLED"] or "_flashes" in session:
+                return view(**kwargs)
+
+            names = list(versions(**kwargs))
+            if g.user is not None:
+                names.append(f"user_movies:{g.user['_id']}")
+
+            etag = page_etag(names, request.endpoint, *kwargs.values())
+
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            return _set_cache_headers(response)
+
+        return wrapped_view
+
+    return decorator
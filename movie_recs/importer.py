@@ -0,0 +1,190 @@
+""" Imports movies from files of titles or IMDb IDs too large to read into memory
+
+A file is read a line at a time and handled in chunks: the titles in a
+chunk that are already stored are skipped, the rest are fetched from the
+OMDB with bounded concurrency and the results are upserted in one bulk
+write. After every chunk, the number of records done is saved to a checkpoint
+file so an interrupted import can carry on where it stopped.
+
+Supported formats, picked by the file's extension unless given:
+
+* csv: a header row with a "title", "Title", "imdbID" or "imdb_id" column
+* jsonl: one JSON object per line with one of those keys, or one JSON string
+* txt: one title or IMDb ID per line
+"""
+import csv
+import json
+import os
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from flask import current_app
+
+from .db import get_db, upsert_movies
+from .omdb import IMDB_ID_PATTERN, defer_synopsis
+from .titles import add_alias_keys, title_key
+
+FORMATS = ("csv", "jsonl", "txt")
+
+# The columns or keys a title or IMDb ID is read from, in order of preference
+REFERENCE_FIELDS = ("imdbID", "imdb_id", "title", "Title")
+
+
+class ImportProgress(NamedTuple):
+    """ How far an import has got, as saved in its checkpoint """
+    records: int
+    added: int
+    skipped: int
+    failed: int
+
+
+def detect_format(path: str) -> str:
+    """ Pick a file's format from its extension """
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension in ("json", "ndjson"):
+        return "jsonl"
+    return extension if extension in FORMATS else "txt"
+
+
+def _reference(record) -> Optional[str]:
+    if isinstance(record, str):
+        return record.strip() or None
+    if isinstance(record, dict):
+        for field in REFERENCE_FIELDS:
+            if record.get(field):
+                return str(record[field]).strip()
+    return None
+
+
+def read_references(lines: Iterable[str], file_format: str) -> Iterator[Optional[str]]:
+    """ Yield the title or IMDb ID in each record, or None for a record without one
+
+    Exactly one value is yielded per record, so the number of values yielded
+    can be used as a checkpoint.
+    """
+    if file_format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield _reference(row)
+    elif file_format == "jsonl":
+        for line in lines:
+            try:
+                yield _reference(json.loads(line)) if line.strip() else None
+            except json.JSONDecodeError:
+                yield None
+    else:
+        for line in lines:
+            yield line.strip() or None
+
+
+def chunks(iterator: Iterable, size: int) -> Iterator[list]:
+    """ Group an iterator's values into lists of at most size """
+    chunk = []
+    for value in iterator:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def find_known(references: List[str]) -> set:
+    """ The references in a chunk that already refer to a stored movie """
+    database = get_db()
+    ids = [reference for reference in references if IMDB_ID_PATTERN.match(reference)]
+    keys = {title_key(reference): reference for reference in references if reference not in ids}
+
+    known = {
+        movie["imdbID"]
+        for movie in database.movies.find({"imdbID": {"$in": ids}}, {"_id": 0, "imdbID": 1})
+    }
+    known.update(
+        keys[alias["key"]]
+        for alias in database.aliases.find({"key": {"$in": list(keys)}}, {"_id": 0, "key": 1})
+    )
+    return known
+
+
+def load_checkpoint(path: str) -> ImportProgress:
+    """ Read how far an import got, or start from the beginning if it has no checkpoint """
+    if not os.path.exists(path):
+        return ImportProgress(0, 0, 0, 0)
+
+    with open(path, encoding="utf-8") as checkpoint_file:
+        return ImportProgress(**json.load(checkpoint_file))
+
+
+def save_checkpoint(path: str, progress: ImportProgress):
+    """ Record how far an import has got, replacing the checkpoint atomically """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(progress._asdict(), checkpoint_file)
+    os.replace(temporary_path, path)
+
+
+def import_movies(
+    lines: Iterable[str],
+    file_format: str,
+    fetch: Callable[[Iterable[str], int], Iterable],
+    concurrency: int,
+    chunk_size: Optional[int] = None,
+    start: ImportProgress = ImportProgress(0, 0, 0, 0),
+    on_chunk: Optional[Callable[[ImportProgress, List[Tuple[str, str]]], None]] = None,
+) -> ImportProgress:
+    """ Import the movies referred to by lines, starting after start.records of them
+
+    fetch is called with each chunk's new references and should yield
+    results like cli.fetch_movies. on_chunk is called after every chunk with
+    the progress so far and the chunk's (reference, error) failures.
+    """
+    chunk_size = chunk_size or current_app.config["IMPORT_CHUNK_SIZE"]
+    references = read_references(lines, file_format)
+    progress = start
+
+    for _ in range(start.records):
+        if next(references, StopIteration) is StopIteration:
+            return progress
+
+    for chunk in chunks(references, chunk_size):
+        wanted = [reference for reference in chunk if reference is not None]
+        known = find_known(wanted)
+        new = list(dict.fromkeys(reference for reference in wanted if reference not in known))
+
+        fetched = []
+        aliases = []
+        failures = []
+        for result in fetch(new, concurrency):
+            if result.error is None:
+                fetched.append(result.movie_data)
+                if not IMDB_ID_PATTERN.match(result.title):
+                    aliases.append((title_key(result.title), result.movie_data["slug"]))
+            else:
+                failures.append((result.title, str(result.error)))
+
+        inserted = upsert_movies(fetched)
+        for movie_data in inserted:
+            defer_synopsis(movie_data)
+        add_alias_keys(aliases)
+
+        added = len(inserted)
+        progress = ImportProgress(
+            progress.records + len(chunk),
+            progress.added + added,
+            progress.skipped + len(wanted) - len(new) + len(fetched) - added,
+            progress.failed + len(failures),
+        )
+
+        if on_chunk is not None:
+            on_chunk(progress, failures)
+
+    return progress
+
+
+def open_lines(path: str, on_read: Optional[Callable[[int], None]] = None) -> Iterator[str]:
+    """ Yield a UTF-8 file's lines, reporting how many bytes each one took up """
+    with open(path, "rb") as import_file:
+        for number, raw_line in enumerate(import_file):
+            if on_read is not None:
+                on_read(len(raw_line))
+            line = raw_line.decode("utf-8")
+            yield line.lstrip("\ufeff") if number == 0 else line
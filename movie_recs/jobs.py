@@ -0,0 +1,265 @@
+""" A job queue in the jobs collection for work that shouldn't happen inside a request
+
+With MOVIES_ADD_QUEUED, adding a movie is queued as a job and done by a
+worker process (see the jobs-worker command), so a slow or unreachable
+OMDB only delays the job rather than the request. A job no worker has
+claimed within JOBS_LEASE_SECONDS is run by the request checking on it.
+Jobs are deduplicated by the key of the title they add, so requesting the
+same movie again while it's queued or after it's failed reuses the
+existing job. Other modules can queue their own kinds of job with
+enqueue_job and register a function to run them with add_job_handler.
+Those jobs aren't reused, so once finished they're removed by a TTL index
+after JOBS_EXPIRE_SECONDS.
+
+A worker claims a job by marking it running with a lease. If the worker
+dies, the job becomes claimable again once the lease runs out. A job that
+fails because the OMDB couldn't be reached is retried with exponential
+backoff, up to JOBS_MAX_ATTEMPTS attempts.
+"""
+import datetime
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Optional
+
+from bson.objectid import ObjectId
+from flask import Flask, current_app
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from requests import RequestException
+
+from .db import add_movie, get_db
+from .omdb import defer_synopsis, get_movie_data
+from .titles import add_aliases, resolve_title, title_key
+
+HANDLERS_EXTENSION_NAME = "movie_recs.job_handlers"
+
+ADD_MOVIE = "add_movie"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+def enqueue_add_movie(movie_title: str, user_id: Optional[str] = None) -> dict:
+    """ Queue a job to add a movie, or return the job already queued for it
+
+    A job that has already finished, because it failed or because the movie
+    it added has since gone, is queued to run again.
+    """
+    jobs = get_db().jobs
+    key = title_key(movie_title)
+    now = _now()
+
+    try:
+        job = jobs.find_one_and_update(
+            {"key": key},
+            {"$setOnInsert": {
+                "type": ADD_MOVIE,
+                "title": movie_title,
+                "user_id": user_id,
+                "status": PENDING,
+                "attempts": 0,
+                "run_after": now,
+                "created": now,
+                "updated": now,
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Another request inserted the same job first
+        job = jobs.find_one({"key": key})
+
+    if job["status"] in (DONE, FAILED):
+        job = jobs.find_one_and_update(
+            {"_id": job["_id"], "status": job["status"]},
+            {"$set": {
+                "title": movie_title, "status": PENDING, "attempts": 0, "error": None,
+                "run_after": now, "updated": now,
+            }},
+            return_document=ReturnDocument.AFTER,
+        ) or jobs.find_one({"_id": job["_id"]})
+
+    return job
+
+
+def enqueue_job(job_type: str, **fields) -> dict:
+    """ Queue a job of job_type that isn't deduplicated with any other job """
+    now = _now()
+    job = {
+        "key": f"{job_type}:{uuid.uuid4().hex}",
+        "type": job_type,
+        "status": PENDING,
+        "attempts": 0,
+        "run_after": now,
+        "created": now,
+        "updated": now,
+        **fields,
+    }
+
+    get_db().jobs.insert_one(job)
+    return job
+
+
+def add_job_handler(app: Flask, job_type: str, handler: Callable[[dict], Optional[str]]):
+    """ Register the function that runs jobs of job_type
+
+    The handler is called with the claimed job and may return the slug of
+    the movie the job produced.
+    """
+    app.extensions.setdefault(HANDLERS_EXTENSION_NAME, {})[job_type] = handler
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """ Returns the job with the given id, or None if there isn't one """
+    if not ObjectId.is_valid(job_id):
+        return None
+    return get_db().jobs.find_one({"_id": ObjectId(job_id)})
+
+
+def claim_job(worker_id: str, job_id: Optional[ObjectId] = None) -> Optional[dict]:
+    """ Mark the next runnable job, or the job with job_id, as running for worker_id
+
+    Returns the claimed job, or None if there was nothing to claim.
+    """
+    now = _now()
+    lease = datetime.timedelta(seconds=current_app.config["JOBS_LEASE_SECONDS"])
+    query = {"$or": [
+        {"status": PENDING, "run_after": {"$lte": now}},
+        {"status": RUNNING, "locked_until": {"$lt": now}},
+    ]}
+    if job_id is not None:
+        query["_id"] = job_id
+
+    return get_db().jobs.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "status": RUNNING, "worker": worker_id,
+                "locked_until": now + lease, "updated": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_after", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _finish(job: dict, fields: dict):
+    now = _now()
+    if fields["status"] in (DONE, FAILED) and job["type"] != ADD_MOVIE:
+        expire_after = datetime.timedelta(seconds=current_app.config["JOBS_EXPIRE_SECONDS"])
+        fields = {**fields, "expires_at": now + expire_after}
+
+    get_db().jobs.update_one(
+        {"_id": job["_id"], "worker": job["worker"]},
+        {"$set": {**fields, "updated": now}, "$unset": {"locked_until": ""}},
+    )
+
+
+def _add_movie(job: dict) -> str:
+    """ Fetch and store the movie a job asks for, returning its slug """
+    slug = resolve_title(job["title"])
+    if slug is not None:
+        return slug
+
+    movie_data = get_movie_data(job["title"])
+    try:
+        add_movie(movie_data)
+    except DuplicateKeyError:
+        pass
+    else:
+        defer_synopsis(movie_data)
+
+    add_aliases(movie_data["slug"], [job["title"]])
+    return movie_data["slug"]
+
+
+def run_job(job: dict):
+    """ Do a claimed job and record how it went """
+    config = current_app.config
+    handlers = {ADD_MOVIE: _add_movie, **current_app.extensions.get(HANDLERS_EXTENSION_NAME, {})}
+    handler = handlers.get(job["type"])
+
+    if handler is None:
+        _finish(job, {"status": FAILED, "error": f"Unknown job type \"{job['type']}\""})
+        return
+
+    try:
+        slug = handler(job)
+    except LookupError as error:
+        message = str(error)
+        if job["type"] == ADD_MOVIE:
+            message = f"The movie \"{job['title']}\" was not found in the OMDB."
+        _finish(job, {"status": FAILED, "error": message})
+    except (RequestException, OSError) as error:
+        if job["attempts"] >= config["JOBS_MAX_ATTEMPTS"]:
+            _finish(job, {
+                "status": FAILED,
+                "error": "The OMDB could not be reached. Please try again later.",
+            })
+        else:
+            delay = config["JOBS_RETRY_DELAY"] * 2 ** (job["attempts"] - 1)
+            _finish(job, {
+                "status": PENDING,
+                "error": str(error),
+                "run_after": _now() + datetime.timedelta(seconds=delay),
+            })
+    except Exception as error:  # pylint: disable=broad-except
+        _finish(job, {"status": FAILED, "error": str(error)})
+    else:
+        _finish(job, {"status": DONE, "slug": slug, "error": None})
+
+
+def run_unclaimed_job(job: dict) -> dict:
+    """ Run a job in this process if no worker has picked it up within JOBS_LEASE_SECONDS
+
+    This keeps queued adds from waiting forever when no jobs-worker is
+    running. Returns the job as it now stands.
+    """
+    lease = datetime.timedelta(seconds=current_app.config["JOBS_LEASE_SECONDS"])
+    if job["status"] != PENDING or job["attempts"] or _now() - job["updated"] < lease:
+        return job
+
+    claimed = claim_job(worker_id(), job["_id"])
+    if claimed is not None:
+        run_job(claimed)
+
+    return get_db().jobs.find_one({"_id": job["_id"]})
+
+
+def worker_id() -> str:
+    """ Identifies this process in the jobs it claims """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def run_worker(burst: bool = False, max_jobs: Optional[int] = None) -> int:
+    """ Claim and run jobs until stopped, returning how many were run
+
+    With burst, returns as soon as there are no runnable jobs instead of
+    polling for more.
+    """
+    poll_interval = current_app.config["JOBS_POLL_INTERVAL"]
+    identity = worker_id()
+    count = 0
+
+    while max_jobs is None or count < max_jobs:
+        job = claim_job(identity)
+
+        if job is None:
+            if burst:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job)
+        count += 1
+
+    return count
@@ -0,0 +1,306 @@
+""" Times each request and the parts of it spent on MongoDB, the OMDB, hashing and rendering
+
+A request's time is split into phases:
+
+* "mongo": commands, timed by a pymongo command listener, and waiting for a
+  pooled connection, including connecting
+* "omdb": requests made by the OMDB client
+* "hashing": hashing and checking passwords
+* "render": rendering Jinja templates
+
+Phases can overlap. A query made while a template is rendering, like the
+lazily read movie list, counts towards both "mongo" and "render". /metrics
+exposes Prometheus histograms of request and phase durations per endpoint,
+MongoDB command durations and the counters kept by the caches and clients.
+
+Only trusted clients can read the measurements: those connecting from
+METRICS_ALLOWED_NETWORKS, or sending "Authorization: Bearer <METRICS_TOKEN>"
+when a token is set. With METRICS_SERVER_TIMING, responses to trusted
+clients also get a Server-Timing header with the phases they used, unless
+they're marked public, since a shared cache would pass it on to anyone.
+
+Measurements are kept per process. Recording a phase costs a context
+variable lookup and a clock read, so this is meant to stay on in
+production; METRICS_ENABLED turns it off.
+"""
+import bisect
+import contextlib
+import hmac
+import ipaddress
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask, Response, abort, current_app, request
+from jinja2 import Template
+from pymongo import monitoring
+
+EXTENSION_NAME = "movie_recs.metrics"
+
+PHASES = ("mongo", "omdb", "hashing", "render")
+
+# Upper bounds in seconds of the latency histograms' buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimings:
+    """ The time a request has spent so far in each phase """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.status = None
+
+
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+_active: ContextVar[frozenset] = ContextVar("active_phases", default=frozenset())
+
+
+def add_time(name: str, seconds: float):
+    """ Count seconds towards a phase of the current request, if there is one """
+    timings = _timings.get()
+    if timings is not None:
+        timings.phases[name] += seconds
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """ Count the time spent in the block towards a phase of the current request
+
+    Time in a phase nested within the same phase, like a fragment rendered
+    by a template, is only counted once.
+    """
+    active = _active.get()
+    if _timings.get() is None or name in active:
+        yield
+        return
+
+    token = _active.set(active | {name})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+        _active.reset(token)
+
+
+class Histogram:
+    """ A Prometheus histogram with a set of labels """
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        """ Record a value for a combination of label values """
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self) -> List[str]:
+        """ The histogram in the Prometheus text format """
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = {labels: ([*counts], total, count)
+                      for labels, (counts, total, count) in self._series.items()}
+
+        for labels, (counts, total, count) in sorted(series.items()):
+            label_text = ",".join(
+                f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            separator = "," if label_text else ""
+
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f'{self.name}_bucket{{{label_text}{separator}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+            lines.append(f"{self.name}_count{{{label_text}}} {count}")
+
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """ The histograms kept for an app """
+
+    def __init__(self):
+        self.requests = Histogram(
+            "movie_recs_request_duration_seconds", "Time taken to handle requests",
+            ("endpoint", "method", "status"))
+        self.phases = Histogram(
+            "movie_recs_request_phase_seconds", "Time requests spent in each phase",
+            ("endpoint", "phase"))
+        self.mongo_commands = Histogram(
+            "movie_recs_mongo_command_duration_seconds", "Time taken by MongoDB commands",
+            ("command",))
+
+
+def get_metrics(app: Flask) -> Metrics:
+    """ Provides the histograms for app """
+    return app.extensions.setdefault(EXTENSION_NAME, Metrics())
+
+
+class CommandTimer(monitoring.CommandListener):
+    """ Times the MongoDB commands run by a client """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        add_time("mongo", seconds)
+        self.metrics.mongo_commands.observe((event.command_name,), seconds)
+
+
+class TimedTemplate(Template):
+    """ A template that counts its rendering towards the "render" phase """
+
+    def render(self, *args, **kwargs) -> str:
+        with phase("render"):
+            return super().render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs) -> Iterator[str]:
+        """ Stream the template, timing each chunk as it's generated """
+        chunks = super().generate(*args, **kwargs)
+        while True:
+            with phase("render"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+
+def is_trusted_client() -> bool:
+    """ Whether the current request may see this process's measurements """
+    config = current_app.config
+
+    token = config["METRICS_TOKEN"]
+    scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+    if token and scheme.lower() == "bearer" and hmac.compare_digest(
+            given.strip().encode(), token.encode()):
+        return True
+
+    try:
+        address = ipaddress.ip_address(request.remote_addr or "")
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network) for network in config["METRICS_ALLOWED_NETWORKS"])
+
+
+def _start_request():
+    _timings.set(RequestTimings())
+
+
+def _add_server_timing(response: Response) -> Response:
+    timings = _timings.get()
+    if timings is None:
+        return response
+
+    timings.status = response.status_code
+    if (current_app.config["METRICS_SERVER_TIMING"] and not response.cache_control.public
+            and is_trusted_client()):
+        total = time.perf_counter() - timings.start
+        entries = [
+            f"{name};dur={seconds * 1000:.2f}"
+            for name, seconds in timings.phases.items() if seconds
+        ]
+        entries.append(f"total;dur={total * 1000:.2f}")
+        response.headers.add("Server-Timing", ", ".join(entries))
+
+    return response
+
+
+def _finish_request(error: Optional[BaseException] = None):
+    timings = _timings.get()
+    if timings is None:
+        return
+    _timings.set(None)
+
+    metrics = get_metrics(current_app)
+    endpoint = request.endpoint or "none"
+    status = timings.status if timings.status is not None else (500 if error else 200)
+
+    metrics.requests.observe(
+        (endpoint, request.method, str(status)), time.perf_counter() - timings.start)
+    for name, seconds in timings.phases.items():
+        metrics.phases.observe((endpoint, name), seconds)
+
+
+def _stat_lines(name: str, stats: Optional[dict]) -> List[str]:
+    """ Expose the numbers in a stats dict as gauges named after their keys """
+    lines = []
+    for key, value in (stats or {}).items():
+        if isinstance(value, dict):
+            lines.extend(_stat_lines(f"{name}_{key}", value))
+        elif isinstance(value, (bool, int, float)):
+            lines.append(f"# TYPE {name}_{key} gauge")
+            lines.append(f"{name}_{key} {float(value)}")
+    return lines
+
+
+def metrics_view() -> Response:
+    """ Expose this process's measurements in the Prometheus text format to trusted clients """
+    # pylint: disable=import-outside-toplevel
+    from .auth import get_user_cache_stats
+    from .db import get_pool_stats
+    from .fragments import get_fragment_cache_stats
+    from .omdb import get_cache_stats, get_client_stats
+
+    if not is_trusted_client():
+        abort(403)
+
+    metrics = get_metrics(current_app)
+    lines = [
+        *metrics.requests.expose(),
+        *metrics.phases.expose(),
+        *metrics.mongo_commands.expose(),
+        *_stat_lines("movie_recs_mongo_pool", get_pool_stats()),
+        *_stat_lines("movie_recs_omdb_client", get_client_stats()),
+        *_stat_lines("movie_recs_omdb_cache", get_cache_stats()),
+        *_stat_lines("movie_recs_fragment_cache", get_fragment_cache_stats()),
+        *_stat_lines("movie_recs_user_cache", get_user_cache_stats()),
+    ]
+
+    response = Response("\n".join(lines) + "\n", mimetype="text/plain")
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+def init_app(app: Flask):
+    """ Time every request and serve the measurements at /metrics """
+    if not app.config["METRICS_ENABLED"]:
+        return
+
+    get_metrics(app)
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start_request)
+    app.after_request(_add_server_timing)
+    app.teardown_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
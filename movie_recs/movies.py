@@ -1,35 +1,201 @@
 """ Provides a blueprint with routes and views for movies """
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for
+import httpx
+from bson.objectid import ObjectId
+from flask import (Blueprint, Response, abort, current_app, flash, g, redirect,
+                   render_template, request, stream_with_context, url_for)
 from pymongo.errors import DuplicateKeyError
 
 from .auth import login_required
-from .db import add_movie, get_movie_by_slug, get_movies
-from .omdb import get_movie_data
+from .collaborative import MAX_RATING, STATUS_WEIGHTS, recommend_for_user
+from .db import (add_movie, get_movie_by_slug, get_movies_by_slugs, get_movies_page,
+                 get_user_movie, get_user_movies, iter_movies_page, remove_user_movie,
+                 set_user_movie)
+from .http_cache import conditional
+from .jobs import DONE, enqueue_add_movie, get_job, run_unclaimed_job
+from .omdb import defer_synopsis, get_movie_data_async
+from .random_pool import pick_random_movie
+from .recommend import get_similar_movies
+from .search import FACETS, search_movies
+from .titles import add_aliases, resolve_title
 
 bp = Blueprint("movies", __name__)
 
 
+def stream_template(template_name: str, **context) -> Response:
+    """ Render a template as a streamed response, sending output as it's generated """
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    stream = template.stream(context)
+    stream.enable_buffering(app.config["MOVIES_STREAM_BUFFER"])
+
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+
 @bp.route("/")
+@conditional(lambda: ["movies", "item_similarities"])
 def list_movies():
-    """ Provide view of all movies"""
-    movies = get_movies()
+    """ Provide view of a page of movies"""
+    after = request.args.get("after")
+    before = request.args.get("before")
+
+    for cursor in (after, before):
+        if cursor is not None and not ObjectId.is_valid(cursor):
+            abort(400)
+
+    max_page_size = current_app.config["MOVIES_MAX_PAGE_SIZE"]
+    limit = request.args.get("limit", current_app.config["MOVIES_PAGE_SIZE"], type=int)
+    limit = min(max(limit, 1), max_page_size)
+
+    recommended = []
+    if g.user is not None and after is None and before is None:
+        recommended = recommend_for_user(g.user["_id"])
+
+    if current_app.config["MOVIES_STREAM_LIST"] and before is None:
+        page = iter_movies_page(after, limit)
+
+        return stream_template(
+            "movies/list.html",
+            movies=page,
+            page=page,
+            limit=request.args.get("limit", type=int),
+            recommended=recommended,
+        )
+
+    page = get_movies_page(after, before, limit)
+
+    return render_template(
+        "movies/list.html",
+        movies=page.movies,
+        page=page,
+        limit=request.args.get("limit", type=int),
+        recommended=recommended,
+    )
+
 
-    return render_template("movies/list.html", movies=movies)
+def search_arguments():
+    """ Read a search query, facet filters and result limit from the request's arguments """
+    query = request.args.get("q", "")
+    filters = {facet: request.args.get(facet) for facet in FACETS if request.args.get(facet)}
+    limit = request.args.get("limit", current_app.config["SEARCH_RESULTS"], type=int)
+    limit = min(max(limit, 1), current_app.config["MOVIES_MAX_PAGE_SIZE"])
+
+    return query, filters, limit
+
+
+@bp.route("/movies/search")
+def search():
+    """ Provide view of the movies matching a search """
+    query, filters, limit = search_arguments()
+    result = search_movies(query, filters, limit)
+
+    return render_template(
+        "movies/search.html",
+        query=query,
+        filters=filters,
+        result=result,
+        movies=get_movies_by_slugs(result.slugs),
+    )
+
+
+@bp.route("/movies/random")
+def random_movie():
+    """ Send the user to a random movie, optionally of a given genre and year """
+    genre = request.args.get("genre") or None
+    year = request.args.get("year", type=int)
+
+    slug = pick_random_movie(genre, year)
+    if slug is None:
+        flash("No movies match those filters.")
+        return redirect(url_for("movies.list_movies"))
+
+    response = redirect(url_for("movies.movie_details", slug=slug))
+    response.cache_control.no_store = True
+    return response
 
 
 @bp.route("/movie/<string:slug>")
+@conditional(lambda slug: ["movies", "recommendations"])
 def movie_details(slug: str):
     """ Provide view for a single movie """
     movie = get_movie_by_slug(slug)
+    if movie is None:
+        abort(404)
+
+    similar = get_similar_movies(slug, current_app.config["RECS_SHOWN"])
+    user_movie = get_user_movie(g.user["_id"], slug) if g.user is not None else None
 
-    return render_template("movies/movie.html", movie=movie)
+    return render_template(
+        "movies/movie.html", movie=movie, similar=similar, user_movie=user_movie)
+
+
+@bp.route("/movie/<string:slug>/status", methods=("POST",))
+@login_required
+def set_status(slug: str):
+    """ Put a movie on the user's watchlist or mark it watched, or clear both """
+    status = request.form.get("status", "")
+
+    if get_movie_by_slug(slug) is None:
+        abort(404)
+
+    if status == "":
+        remove_user_movie(g.user["_id"], slug)
+    elif status in STATUS_WEIGHTS:
+        set_user_movie(g.user["_id"], slug, {"status": status})
+    else:
+        abort(400)
+
+    return redirect(url_for("movies.movie_details", slug=slug))
+
+
+@bp.route("/movie/<string:slug>/rating", methods=("POST",))
+@login_required
+def rate(slug: str):
+    """ Record the user's rating of a movie, which also marks it watched """
+    rating = request.form.get("rating", type=int)
+
+    if get_movie_by_slug(slug) is None:
+        abort(404)
+
+    if rating is None or not 1 <= rating <= MAX_RATING:
+        abort(400)
+
+    set_user_movie(g.user["_id"], slug, {"status": "watched", "rating": rating})
+
+    return redirect(url_for("movies.movie_details", slug=slug))
+
+
+@bp.route("/watchlist")
+@login_required
+def watchlist():
+    """ Provide view of the movies on the user's watchlist """
+    slugs = [record["slug"] for record in get_user_movies(g.user["_id"], "watchlist")]
+
+    return render_template("movies/watchlist.html", movies=get_movies_by_slugs(slugs))
+
+
+@bp.route("/movies/jobs/<string:job_id>")
+@login_required
+def job_status(job_id: str):
+    """ Provide view of a queued job, which goes to the movie once it's added one """
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    job = run_unclaimed_job(job)
+    if job["status"] == DONE and job.get("slug"):
+        return redirect(url_for("movies.movie_details", slug=job["slug"]))
+
+    return render_template(
+        "movies/job.html", job=job, refresh=current_app.config["JOBS_REFRESH_SECONDS"])
 
 
 @bp.route("/movies/add", methods=("GET", "POST"))
 @login_required
-def add():
-    """ Log a user in """
+async def add():
+    """ Add a movie, looking it up with the asyncio OMDB client """
     movie_title = ""
     if request.method == "POST":
         movie_title = request.form["movie_title"]
@@ -39,19 +205,30 @@ def add():
         if not movie_title:
             error = "A movie title is required"
 
+        if error is None and resolve_title(movie_title) is not None:
+            error = f"The movie \"{movie_title}\" has already been added."
+
+        if error is None and current_app.config["MOVIES_ADD_QUEUED"]:
+            job = enqueue_add_movie(movie_title, g.user["_id"])
+            return redirect(url_for("movies.job_status", job_id=str(job["_id"])))
+
         if error is None:
             try:
-                movie_data = get_movie_data(movie_title)
+                movie_data = await get_movie_data_async(movie_title)
             except LookupError:
                 error = f"The movie \"{movie_title}\" was not found in the OMDB."
+            except httpx.HTTPError:
+                error = "The OMDB could not be reached. Please try again later."
 
         if error is None:
             try:
                 add_movie(movie_data)
             except DuplicateKeyError:
                 error = f"The movie \"{movie_title}\" has already been added."
+            add_aliases(movie_data["slug"], [movie_title])
 
         if error is None:
+            defer_synopsis(movie_data)
             return redirect(url_for("movies.movie_details", slug=movie_data["slug"]))
 
         flash(error)
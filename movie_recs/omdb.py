@@ -1,20 +1,255 @@
 """ Provides access to the Open Movie Database """
+import asyncio
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator, Optional, Tuple, TypeVar, Union
+
+import httpx
 import requests
-from flask import current_app
+from flask import Flask, current_app
+from requests.adapters import HTTPAdapter
 from slugify import slugify
+from urllib3.util.retry import Retry
 
+from .cache import SqliteCache
+from .db import update_movie
+from .metrics import phase
 
-def get_movie_data(movie_title: str) -> dict:
-    """ Get data for a movie title """
+CACHE_EXTENSION_NAME = "movie_recs.omdb_cache"
+RATE_LIMITER_EXTENSION_NAME = "movie_recs.omdb_rate_limiter"
+SESSION_EXTENSION_NAME = "movie_recs.omdb_session"
+STATS_EXTENSION_NAME = "movie_recs.omdb_stats"
+DEFERRED_EXTENSION_NAME = "movie_recs.omdb_deferred"
 
-    params = {
-        "apikey": current_app.config["OMDB_API_KEY"],
-        "t": movie_title,
-        "plot": "short"
-    }
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Errors the OMDB reports when there is no movie to return
+NOT_FOUND_ERRORS = ("Movie not found!", "Incorrect IMDb ID.")
+
+IMDB_ID_PATTERN = re.compile(r"^tt\d{7,}$")
+
+
+class RateLimiter:
+    """ Spaces out calls so no more than rate happen per second across threads """
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def reserve(self) -> float:
+        """ Claim the caller's next call, returning how many seconds it must wait to make it """
+        if not self.interval:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        return slot - now
+
+    def wait(self):
+        """ Block until the caller is allowed to make its next call """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_rate_limiter() -> RateLimiter:
+    """ Provides the limiter shared by all OMDB requests for the current app """
+    return current_app.extensions.setdefault(
+        RATE_LIMITER_EXTENSION_NAME,
+        RateLimiter(current_app.config["OMDB_RATE_LIMIT"])
+    )
+
+
+class ClientStats:
+    """ Running latency and error counts for requests made to the OMDB """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "retries": 0,
+            "total_seconds": 0.0,
+            "max_seconds": 0.0,
+        }
+
+    def record(self, elapsed: float, error: bool = False, timeout: bool = False, retries: int = 0):
+        """ Record the outcome of a single request """
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["errors"] += error
+            self.stats["timeouts"] += timeout
+            self.stats["retries"] += retries
+            self.stats["total_seconds"] += elapsed
+            self.stats["max_seconds"] = max(self.stats["max_seconds"], elapsed)
+
+    def snapshot(self) -> dict:
+        """ Return a copy of the current counts, including the mean latency """
+        with self._lock:
+            stats = dict(self.stats)
+
+        requests_made = stats["requests"]
+        stats["mean_seconds"] = stats["total_seconds"] / requests_made if requests_made else 0.0
+        return stats
+
+
+def _create_session(config) -> requests.Session:
+    """ Build a keep-alive session using the pool and retry settings from config """
+    retry = Retry(
+        total=config["OMDB_RETRIES"],
+        backoff_factor=config["OMDB_BACKOFF_FACTOR"],
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config["OMDB_POOL_SIZE"],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """ Provides the session shared by all OMDB requests in this process """
+    pid, session = current_app.extensions.get(SESSION_EXTENSION_NAME, (None, None))
+
+    if session is None or pid != os.getpid():
+        session = _create_session(current_app.config)
+        current_app.extensions[SESSION_EXTENSION_NAME] = (os.getpid(), session)
+
+    return session
+
+
+def get_client_stats() -> dict:
+    """ Report latency and error counts for requests made to the OMDB """
+    return current_app.extensions.setdefault(STATS_EXTENSION_NAME, ClientStats()).snapshot()
+
+
+def _request(params: dict) -> requests.Response:
+    """ Make a single rate limited, timed request to the OMDB """
+    config = current_app.config
+    stats = current_app.extensions.setdefault(STATS_EXTENSION_NAME, ClientStats())
+    timeout = (config["OMDB_CONNECT_TIMEOUT"], config["OMDB_READ_TIMEOUT"])
+
+    with phase("omdb"):
+        get_rate_limiter().wait()
+
+        start = time.perf_counter()
+        try:
+            response = get_session().get(config["OMDB_URL"], params=params, timeout=timeout)
+        except requests.Timeout:
+            stats.record(time.perf_counter() - start, error=True, timeout=True)
+            raise
+        except requests.RequestException:
+            stats.record(time.perf_counter() - start, error=True)
+            raise
 
-    response = requests.get("http://www.omdbapi.com/", params=params)
+        retry_history = getattr(getattr(response.raw, "retries", None), "history", ())
+        stats.record(
+            time.perf_counter() - start,
+            error=response.status_code >= 400,
+            retries=len(retry_history or ()),
+        )
+        return response
 
+
+def normalize_title(movie_title: str) -> str:
+    """ Reduce a title to the key used to look it up locally """
+    return slugify(movie_title)
+
+
+def get_cache() -> Optional[SqliteCache]:
+    """ Provides the response cache for the current app, or None if it's disabled """
+    config = current_app.config
+
+    if not config["OMDB_CACHE_ENABLED"]:
+        return None
+
+    cache = current_app.extensions.get(CACHE_EXTENSION_NAME)
+
+    if cache is None:
+        path = config["OMDB_CACHE_PATH"]
+        if path is None:
+            path = os.path.join(current_app.instance_path, "omdb_cache.sqlite3")
+
+        cache = current_app.extensions.setdefault(
+            CACHE_EXTENSION_NAME,
+            SqliteCache(path, config["OMDB_CACHE_TTL"], config["OMDB_CACHE_MAX_ENTRIES"])
+        )
+
+    return cache
+
+
+def get_cache_stats() -> dict:
+    """ Report hit/miss counters for the response cache """
+    cache = get_cache()
+
+    if cache is None:
+        return {"enabled": False}
+
+    return {"enabled": True, **cache.stats()}
+
+
+def get_movie_data(movie_title: str, refresh: bool = False) -> dict:
+    """ Get data for a movie title, using the local cache when possible
+
+    With refresh, the cache isn't read, so the OMDB is always asked and the
+    cached entry is replaced with its answer.
+    """
+
+    cache = get_cache()
+    key = normalize_title(movie_title)
+
+    if cache is not None and not refresh:
+        movie_data = cache.get(key)
+        if movie_data is not None:
+            return movie_data
+
+    if current_app.config["OMDB_CACHE_ONLY"]:
+        raise LookupError(f"Movie \"{movie_title}\" not found in the OMDB cache.")
+
+    movie_data = fetch_movie_data(movie_title)
+
+    if cache is not None:
+        cache.set(key, movie_data)
+        cache.set(normalize_title(movie_data["Title"]), movie_data)
+
+    return movie_data
+
+
+def derive_synopsis(plot: str, max_length: int) -> str:
+    """ Build a short synopsis from a full plot without asking the OMDB for one
+
+    The first sentence is used, shortened at a word boundary if it's longer
+    than max_length.
+    """
+    first_sentence = re.split(r"(?<=[.!?])\s", plot.strip(), maxsplit=1)[0]
+
+    if len(first_sentence) <= max_length:
+        return first_sentence
+
+    shortened = first_sentence[:max_length].rsplit(" ", 1)[0].rstrip(",;:")
+    return shortened + "..."
+
+
+def _parse_response(
+    response: Union[requests.Response, httpx.Response], movie_title: str,
+) -> dict:
+    """ Return the JSON body of an OMDB response, raising if it reports an error """
     content_type = response.headers.get("Content-Type", "plain/text")
     response_contains_json = content_type == "application/json"
 
@@ -22,18 +257,279 @@ def get_movie_data(movie_title: str) -> dict:
 
     if response.status_code >= 400 or response_json.get("Response", "False") == "False":
         if "Error" in response_json:
-            if response_json["Error"] == "Movie not found!":
+            if response_json["Error"] in NOT_FOUND_ERRORS:
                 raise LookupError(
                     f"Movie \"{movie_title}\" not found in OMDB.")
             raise Exception(response_json["Error"])
         raise Exception("An unknown error occurred")
 
-    synopsis = response_json["Plot"]
+    return response_json
+
+
+def lookup_params(movie_title: str) -> dict:
+    """ The OMDB parameters to look up a title, which may also be an IMDb ID like tt0052357 """
+    if IMDB_ID_PATTERN.match(movie_title.strip()):
+        return {"i": movie_title.strip()}
+    return {"t": movie_title}
+
+
+def fetch_movie_data(movie_title: str) -> dict:
+    """ Get data for a movie title or IMDb ID directly from the OMDB
+
+    The full record is always fetched first. How the short synopsis is
+    filled in depends on OMDB_SYNOPSIS_MODE:
+
+    * "fetch" makes a second request for the short plot
+    * "derive" builds it from the full plot
+    * "deferred" derives it now; defer_synopsis replaces it with the short plot later
+    """
+    config = current_app.config
+
+    params = {
+        "apikey": config["OMDB_API_KEY"],
+        **lookup_params(movie_title),
+        "plot": "full"
+    }
+
+    movie_data = _parse_response(_request(params), movie_title)
+
+    if config["OMDB_SYNOPSIS_MODE"] == "fetch":
+        params["plot"] = "short"
+        movie_data["Synopsis"] = _parse_response(_request(params), movie_title)["Plot"]
+    else:
+        movie_data["Synopsis"] = derive_synopsis(
+            movie_data["Plot"], config["OMDB_SYNOPSIS_LENGTH"])
 
-    params["plot"] = "full"
-    response = requests.get("http://www.omdbapi.com/", params=params)
-    movie_data = response.json()
-    movie_data["Synopsis"] = synopsis
     movie_data["slug"] = slugify(movie_data["Title"])
 
     return movie_data
+
+
+def _fetch_synopsis(app: Flask, movie_data: dict) -> Optional[str]:
+    """ Fetch the short plot for a stored movie and save it as its synopsis """
+    with app.app_context():
+        params = {
+            "apikey": app.config["OMDB_API_KEY"],
+            "t": movie_data["Title"],
+            "plot": "short"
+        }
+        synopsis = _parse_response(_request(params), movie_data["Title"])["Plot"]
+
+        update_movie(movie_data["slug"], {"Synopsis": synopsis})
+
+        cache = get_cache()
+        if cache is not None:
+            cached_data = {k: v for k, v in movie_data.items() if k not in ("_id", "fetched_at")}
+            cached_data["Synopsis"] = synopsis
+            cache.set(normalize_title(movie_data["Title"]), cached_data)
+
+        return synopsis
+
+
+def defer_synopsis(movie_data: dict) -> Optional[Future]:
+    """ Replace a stored movie's derived synopsis with the OMDB's short plot in the background
+
+    Does nothing unless OMDB_SYNOPSIS_MODE is "deferred". Should be called
+    once the movie has been added to the database.
+    """
+    if current_app.config["OMDB_SYNOPSIS_MODE"] != "deferred":
+        return None
+
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    executor = app.extensions.get(DEFERRED_EXTENSION_NAME)
+
+    if executor is None:
+        executor = app.extensions.setdefault(
+            DEFERRED_EXTENSION_NAME,
+            ThreadPoolExecutor(max_workers=app.config["OMDB_DEFERRED_WORKERS"])
+        )
+
+    return executor.submit(_fetch_synopsis, app, movie_data)
+
+
+# The asyncio client. Requests are made with httpx's non-blocking client, so a
+# coroutine waiting on the OMDB doesn't hold a thread: the full and short plots
+# are requested at the same time and many titles can be fetched at once from
+# a single thread. It shares the blocking client's rate limiter, stats and
+# cache. The cache is a local SQLite file and is read and written in place.
+
+T = TypeVar("T")
+
+
+def _async_transport(config) -> httpx.AsyncBaseTransport:
+    """ The transport async requests are sent with, pooled and retrying failed connections """
+    return httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=config["OMDB_POOL_SIZE"]),
+        retries=config["OMDB_RETRIES"],
+    )
+
+
+def create_async_session() -> httpx.AsyncClient:
+    """ Build a keep-alive async client using the pool and timeout settings from config
+
+    The client belongs to the event loop it's first used on, so one is made
+    for each loop, like the one an async view runs on, and closed with it:
+
+        async with create_async_session() as session:
+            movie_data = await get_movie_data_async(title, session)
+    """
+    config = current_app.config
+    return httpx.AsyncClient(
+        transport=_async_transport(config),
+        timeout=httpx.Timeout(config["OMDB_READ_TIMEOUT"], connect=config["OMDB_CONNECT_TIMEOUT"]),
+    )
+
+
+def _retry_delay(response: httpx.Response, retries: int, backoff_factor: float) -> float:
+    """ Seconds to wait before retrying a response, honouring its Retry-After header """
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return float(retry_after)
+    return backoff_factor * 2 ** retries
+
+
+async def _request_async(session: httpx.AsyncClient, params: dict) -> httpx.Response:
+    """ Make a single rate limited, timed request to the OMDB without blocking
+
+    Responses with a retryable status are retried with backoff, as the
+    blocking session's retry policy does.
+    """
+    config = current_app.config
+    stats = current_app.extensions.setdefault(STATS_EXTENSION_NAME, ClientStats())
+
+    delay = get_rate_limiter().reserve()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    start = time.perf_counter()
+    retries = 0
+    while True:
+        try:
+            response = await session.get(config["OMDB_URL"], params=params)
+        except httpx.TimeoutException:
+            stats.record(time.perf_counter() - start, error=True, timeout=True, retries=retries)
+            raise
+        except httpx.HTTPError:
+            stats.record(time.perf_counter() - start, error=True, retries=retries)
+            raise
+
+        if response.status_code not in RETRY_STATUSES or retries >= config["OMDB_RETRIES"]:
+            break
+
+        await asyncio.sleep(_retry_delay(response, retries, config["OMDB_BACKOFF_FACTOR"]))
+        retries += 1
+
+    stats.record(
+        time.perf_counter() - start, error=response.status_code >= 400, retries=retries)
+    return response
+
+
+async def fetch_movie_data_async(movie_title: str, session: httpx.AsyncClient) -> dict:
+    """ Get data for a movie title or IMDb ID directly from the OMDB
+
+    Works like omdb.fetch_movie_data, except that in the "fetch" synopsis
+    mode the full and short plots are requested concurrently.
+    """
+    config = current_app.config
+    params = {"apikey": config["OMDB_API_KEY"], **lookup_params(movie_title), "plot": "full"}
+
+    # Timed as a whole, since the two plots' requests overlap
+    with phase("omdb"):
+        if config["OMDB_SYNOPSIS_MODE"] == "fetch":
+            full, short = await asyncio.gather(
+                _request_async(session, params),
+                _request_async(session, {**params, "plot": "short"}),
+            )
+            movie_data = _parse_response(full, movie_title)
+            movie_data["Synopsis"] = _parse_response(short, movie_title)["Plot"]
+        else:
+            movie_data = _parse_response(await _request_async(session, params), movie_title)
+            movie_data["Synopsis"] = derive_synopsis(
+                movie_data["Plot"], config["OMDB_SYNOPSIS_LENGTH"])
+
+    movie_data["slug"] = slugify(movie_data["Title"])
+
+    return movie_data
+
+
+async def get_movie_data_async(
+    movie_title: str, session: Optional[httpx.AsyncClient] = None, refresh: bool = False,
+) -> dict:
+    """ Get data for a movie title, using the local cache when possible
+
+    Works like omdb.get_movie_data. Without a session, one is opened for
+    the call.
+    """
+    cache = get_cache()
+    key = normalize_title(movie_title)
+
+    if cache is not None and not refresh:
+        movie_data = cache.get(key)
+        if movie_data is not None:
+            return movie_data
+
+    if current_app.config["OMDB_CACHE_ONLY"]:
+        raise LookupError(f"Movie \"{movie_title}\" not found in the OMDB cache.")
+
+    if session is None:
+        async with create_async_session() as session:
+            movie_data = await fetch_movie_data_async(movie_title, session)
+    else:
+        movie_data = await fetch_movie_data_async(movie_title, session)
+
+    if cache is not None:
+        cache.set(key, movie_data)
+        cache.set(normalize_title(movie_data["Title"]), movie_data)
+
+    return movie_data
+
+
+async def iter_movie_data(
+    titles: Iterable[str], concurrency: int, refresh: bool = False,
+) -> AsyncIterator[Tuple[str, Optional[dict], Optional[Exception]]]:
+    """ Get data for many titles, at most concurrency at a time, over one session
+
+    Yields (title, movie data, None) or (title, None, error) as each title
+    completes. Titles are read as they're needed, so they can be streamed
+    from an arbitrarily large source.
+    """
+    pending = {}
+
+    def collect(tasks):
+        for task in tasks:
+            title = pending.pop(task)
+            error = task.exception()
+            yield (title, None, error) if error is not None else (title, task.result(), None)
+
+    async with create_async_session() as session:
+        for title in titles:
+            if len(pending) >= concurrency:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for result in collect(done):
+                    yield result
+
+            task = asyncio.ensure_future(get_movie_data_async(title, session, refresh))
+            pending[task] = title
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for result in collect(done):
+                yield result
+
+
+def iterate_sync(iterator: AsyncIterator[T]) -> Iterator[T]:
+    """ Consume an async iterator from blocking code, on an event loop of its own
+
+    Requests already in flight carry on while the caller handles the
+    previous item.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(iterator.aclose())
+        loop.close()
@@ -0,0 +1,80 @@
+""" Password hashing with a configurable method and optional offloading """
+import functools
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .metrics import phase
+
+EXECUTOR_EXTENSION_NAME = "movie_recs.hash_executor"
+
+EXECUTOR_TYPES = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+
+
+def get_executor() -> Optional[Executor]:
+    """ Provides the pool hashing is offloaded to, or None to hash in the calling thread
+
+    Keeping hashing on a small, separate pool bounds how much CPU a burst of
+    logins can take from other requests.
+    """
+    executor_type = current_app.config["AUTH_HASH_EXECUTOR"]
+
+    if executor_type is None:
+        return None
+
+    pid, executor = current_app.extensions.get(EXECUTOR_EXTENSION_NAME, (None, None))
+
+    if executor is None or pid != os.getpid():
+        executor = EXECUTOR_TYPES[executor_type](
+            max_workers=current_app.config["AUTH_HASH_WORKERS"])
+        current_app.extensions[EXECUTOR_EXTENSION_NAME] = (os.getpid(), executor)
+
+    return executor
+
+
+def _run(function, *args):
+    """ Call function on the hashing pool if there is one, otherwise call it directly """
+    executor = get_executor()
+
+    with phase("hashing"):
+        if executor is None:
+            return function(*args)
+
+        return executor.submit(function, *args).result()
+
+
+def hash_password(password: str) -> str:
+    """ Hash a password using the configured method and salt length """
+    config = current_app.config
+    return _run(
+        generate_password_hash, password, config["AUTH_HASH_METHOD"], config["AUTH_SALT_LENGTH"])
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """ Check a password against a stored hash """
+    return _run(check_password_hash, password_hash, password)
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_parameters(method: str, salt_length: int) -> tuple:
+    """ The method string and salt length werkzeug stores for these settings """
+    method_string, salt, _ = generate_password_hash("", method, salt_length).split("$", 2)
+    return method_string, len(salt)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """ Whether a stored hash was made with different settings than the current ones """
+    config = current_app.config
+    expected = _hash_parameters(config["AUTH_HASH_METHOD"], config["AUTH_SALT_LENGTH"])
+
+    if password_hash.count("$") < 2:
+        return True
+
+    method_string, salt, _ = password_hash.split("$", 2)
+    return (method_string, len(salt)) != expected
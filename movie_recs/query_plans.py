@@ -0,0 +1,131 @@
+""" Checks that the app's database queries are answered from indexes
+
+Each entry in QUERY_PLANS is the shape of a query made by db.py or one of
+the modules built on it, with sample values. check_query_plans runs
+explain() on each one and reports any whose winning plan scans a whole
+collection, sorts in memory or, for queries marked covered, reads documents
+when the index alone could have answered it. Queries that read every movie
+by design, like get_movies and build_index, aren't listed.
+
+mongomock can't explain queries, so this needs a real mongod. Run the
+check-query-plans command against one, or the query plan tests with
+MONGO_TEST_HOST pointing at one.
+"""
+import datetime
+from typing import Iterator, List, NamedTuple, Optional
+
+from bson.objectid import ObjectId
+
+from .db import LIST_PROJECTION, get_db, init_collections
+from .search import SEARCH_PROJECTION
+
+
+class QueryPlan(NamedTuple):
+    """ A query to explain and what its plan should look like """
+    name: str
+    collection: str
+    filter: dict
+    projection: Optional[dict] = None
+    sort: Optional[list] = None
+    covered: bool = False
+
+
+class PlanProblem(NamedTuple):
+    """ Something wrong with the winning plan for a query """
+    query: str
+    problem: str
+    stages: List[str]
+
+
+_SAMPLE_ID = ObjectId()
+_SAMPLE_TIME = datetime.datetime(2000, 1, 1)
+
+QUERY_PLANS = [
+    QueryPlan("db.get_movie_by_slug", "movies", {"slug": "vertigo"}),
+    QueryPlan("db.get_movies_by_slugs", "movies",
+              {"slug": {"$in": ["vertigo", "ikiru"]}}, LIST_PROJECTION),
+    QueryPlan("db.iter_movies_page", "movies",
+              {"_id": {"$gt": _SAMPLE_ID}}, LIST_PROJECTION, [("_id", 1)]),
+    QueryPlan("db.get_movies_page", "movies",
+              {"_id": {"$lt": _SAMPLE_ID}}, LIST_PROJECTION, [("_id", -1)]),
+    QueryPlan("db.get_user_by_username", "users", {"username": "someone"}),
+    QueryPlan("db.get_user_by_id", "users", {"_id": _SAMPLE_ID}),
+    QueryPlan("db.get_user_movie", "user_movies", {"user_id": _SAMPLE_ID, "slug": "vertigo"}),
+    QueryPlan("db.get_user_movies", "user_movies", {"user_id": _SAMPLE_ID, "status": "watched"}),
+    QueryPlan("db.get_version", "meta", {"_id": "movies"}),
+    QueryPlan("movies by genre and year", "movies",
+              {"genres": "Drama", "year": {"$gte": 1950}}, LIST_PROJECTION, [("year", -1)]),
+    QueryPlan("movies by year", "movies", {"year": 1958}, LIST_PROJECTION),
+    QueryPlan("titles.resolve_title alias", "aliases",
+              {"key": "vertigo"}, {"_id": 0, "slug": 1}, covered=True),
+    QueryPlan("titles.resolve_title slug", "movies",
+              {"slug": "vertigo"}, {"_id": 0, "slug": 1}, covered=True),
+    QueryPlan("importer.find_known ids", "movies",
+              {"imdbID": {"$in": ["tt0052357"]}}, {"_id": 0, "imdbID": 1}, covered=True),
+    QueryPlan("importer.find_known aliases", "aliases",
+              {"key": {"$in": ["vertigo"]}}, {"_id": 0, "key": 1}, covered=True),
+    QueryPlan("cli.plan_seed", "movies",
+              {"slug": {"$in": ["vertigo"]}}, {"_id": 0, "slug": 1, "fetched_at": 1}),
+    QueryPlan("random_pool.pick_random_movie genre", "movies",
+              {"genre_keys": "western"}, {"_id": 0, "slug": 1}),
+    QueryPlan("random_pool.pick_random_movie genre and year", "movies",
+              {"genre_keys": "western", "year": 1958}, {"_id": 0, "slug": 1}),
+    QueryPlan("search._load_changed_movies", "movies",
+              {"updated_at": {"$gte": _SAMPLE_TIME}}, SEARCH_PROJECTION),
+    QueryPlan("recommend.get_similar_movies", "recommendations", {"slug": "vertigo"}),
+    QueryPlan("collaborative.recommend_for_user", "item_similarities",
+              {"slug": {"$in": ["vertigo", "ikiru"]}}),
+    QueryPlan("collaborative._iter_user_interactions", "user_movies",
+              {}, sort=[("user_id", 1), ("updated", 1)]),
+    QueryPlan("jobs.enqueue_add_movie", "jobs", {"key": "vertigo"}),
+    QueryPlan("jobs.claim_job", "jobs", {"$or": [
+        {"status": "pending", "run_after": {"$lte": _SAMPLE_TIME}},
+        {"status": "running", "locked_until": {"$lt": _SAMPLE_TIME}},
+    ]}, sort=[("run_after", 1)]),
+]
+
+
+def plan_stages(plan) -> Iterator[str]:
+    """ Every stage in an explained plan, however deeply it's nested """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def plan_problems(query: QueryPlan, explanation: dict) -> List[PlanProblem]:
+    """ Compare the winning plan from an explain() with what a query expects """
+    stages = list(plan_stages(explanation["queryPlanner"]["winningPlan"]))
+    problems = []
+
+    if "COLLSCAN" in stages:
+        problems.append("scans the whole collection")
+    if query.sort and "SORT" in stages:
+        problems.append("sorts in memory")
+    if query.covered and "FETCH" in stages:
+        problems.append("isn't covered by an index")
+
+    return [PlanProblem(query.name, problem, stages) for problem in problems]
+
+
+def check_query_plans(queries: Optional[List[QueryPlan]] = None) -> List[PlanProblem]:
+    """ Explain every query against the database, returning each problem found
+
+    Missing indexes are created first, so the plans are the ones production
+    would get.
+    """
+    database = get_db()
+    init_collections()
+    problems = []
+
+    for query in QUERY_PLANS if queries is None else queries:
+        cursor = database[query.collection].find(query.filter, query.projection)
+        if query.sort:
+            cursor = cursor.sort(query.sort)
+        problems.extend(plan_problems(query, cursor.explain()))
+
+    return problems
@@ -0,0 +1,135 @@
+""" Picks random movies from an in-memory sample of the catalog
+
+Up to RANDOM_POOL_SIZE movies are sampled from the movies collection with
+$sample, along with their genres and year, and resampled every
+RANDOM_POOL_REFRESH seconds. Picking a movie, with or without genre and
+year filters, then only touches the pool. Movies added after the pool was
+sampled join it while it has room. A pick that matches nothing in the pool
+falls back to sampling the collection, since movies can be written by other
+processes or skip the pool once it's full. Genres are matched regardless of
+case: in the pool by their lower cased names, and in the collection by the
+genre_keys each movie stores, so the fallback can use an index even for a
+genre no movie has.
+"""
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable, List, Optional
+
+from flask import Flask, current_app
+
+from .db import add_movie_listener, get_db
+
+EXTENSION_NAME = "movie_recs.random_pool"
+
+# The fields read from each sampled movie
+POOL_PROJECTION = {"_id": 0, "slug": 1, "genres": 1, "year": 1}
+
+
+class RandomPool:
+    """ A sample of movies, indexed by genre and year so filtered picks are cheap """
+
+    def __init__(self, movies: Iterable[dict], size: int):
+        self.size = size
+        self.slugs = []
+        self.genres = {}
+        self.years = {}
+        self.by_genre = defaultdict(list)
+        self.by_year = defaultdict(list)
+        self.lock = threading.Lock()
+
+        for movie in movies:
+            self.add(movie)
+
+        self.sampled = time.monotonic()
+
+    def add(self, movie: dict):
+        """ Add a movie to the pool """
+        slug = movie["slug"]
+        genres = {genre.lower() for genre in movie.get("genres") or []}
+
+        self.slugs.append(slug)
+        self.genres[slug] = genres
+        for genre in movie.get("genres") or []:
+            self.by_genre[genre.lower()].append(slug)
+
+        if movie.get("year"):
+            self.years[slug] = movie["year"]
+            self.by_year[movie["year"]].append(slug)
+
+    def pick(self, genre: Optional[str] = None, year: Optional[int] = None) -> Optional[str]:
+        """ Returns a random slug from the pool that matches the filters, if any do """
+        if genre is None and year is None:
+            candidates = self.slugs
+        elif year is None:
+            candidates = self.by_genre.get(genre.lower(), [])
+        elif genre is None:
+            candidates = self.by_year.get(year, [])
+        else:
+            candidates = [
+                slug for slug in self.by_year.get(year, []) if genre.lower() in self.genres[slug]
+            ]
+
+        return random.choice(candidates) if candidates else None
+
+
+def sample_pool() -> RandomPool:
+    """ Sample a new pool from the movies collection """
+    size = current_app.config["RANDOM_POOL_SIZE"]
+    movies = get_db().movies.aggregate([
+        {"$sample": {"size": size}},
+        {"$project": POOL_PROJECTION},
+    ])
+
+    return RandomPool(movies, size)
+
+
+def get_random_pool() -> RandomPool:
+    """ Provides the current app's pool, resampling it once it's too old """
+    pool = current_app.extensions.get(EXTENSION_NAME)
+
+    if pool is None or time.monotonic() - pool.sampled > current_app.config["RANDOM_POOL_REFRESH"]:
+        pool = sample_pool()
+        current_app.extensions[EXTENSION_NAME] = pool
+
+    return pool
+
+
+def pick_random_movie(genre: Optional[str] = None, year: Optional[int] = None) -> Optional[str]:
+    """ Returns the slug of a random movie, or None if no movie matches the filters """
+    pool = get_random_pool()
+    slug = pool.pick(genre, year)
+
+    if slug is not None:
+        return slug
+
+    query = {}
+    if genre is not None:
+        query["genre_keys"] = genre.lower()
+    if year is not None:
+        query["year"] = year
+
+    sample = list(get_db().movies.aggregate([
+        {"$match": query},
+        {"$sample": {"size": 1}},
+        {"$project": {"_id": 0, "slug": 1}},
+    ]))
+    return sample[0]["slug"] if sample else None
+
+
+def _on_movies_changed(event: str, movies: List[dict]):
+    pool = current_app.extensions.get(EXTENSION_NAME)
+    if event != "added" or pool is None:
+        return
+
+    with pool.lock:
+        for movie in movies:
+            if len(pool.slugs) >= pool.size:
+                break
+            pool.add(movie)
+
+
+def init_app(app: Flask):
+    """ Add movies to the pool as they're written """
+    add_movie_listener(app, _on_movies_changed)
@@ -0,0 +1,598 @@
+""" Content-based movie recommendations from stored OMDB metadata
+
+Each movie is turned into a sparse feature vector made up of its genres,
+director, actors, decade, runtime and a TF-IDF weighting of the words in its
+plot and synopsis. A movie only has a few dozen of the RECS_MAX_FEATURES
+features, so its vector takes a few hundred bytes however large the
+vocabulary is. Every movie's nearest neighbours by cosine similarity are worked
+out ahead of time and stored in the recommendations collection, so serving
+a recommendation is a single lookup. Once the catalog is large, neighbours
+are found with an approximate LSH index instead of comparing every pair.
+
+New movies are added to the index by a queued job when MOVIES_ADD_QUEUED
+says a jobs-worker is running, and by the request that added them
+otherwise. The index is only ever built from the command line or by a
+worker.
+"""
+import contextlib
+import fcntl
+import json
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import scipy.sparse
+from flask import Flask, current_app
+from pymongo import UpdateOne
+
+from .ann import LSHIndex, as_rows, remove_generation
+from .db import LIST_PROJECTION, add_movie_listener, bump_version, get_db
+from .jobs import add_job_handler, enqueue_job
+
+EXTENSION_NAME = "movie_recs.recommendations"
+INDEX_FILE = "index.npz"
+LOCK_FILE = "index.lock"
+
+# The layout of INDEX_FILE; an index saved with another layout is rebuilt
+INDEX_FORMAT = 2
+
+INDEX_MOVIES = "index_movies"
+
+# The fields read from each movie document to build its features
+FEATURE_PROJECTION = {
+    "slug": 1, "genres": 1, "directors": 1, "actors": 1,
+    "year": 1, "runtime_minutes": 1, "Plot": 1, "Synopsis": 1,
+}
+
+# How much each kind of feature counts towards similarity
+FEATURE_WEIGHTS = {
+    "genre": 1.0,
+    "director": 0.6,
+    "actor": 0.4,
+    "decade": 0.3,
+    "runtime": 0.2,
+    "word": 1.0,
+}
+
+STOP_WORDS = frozenset("""
+    a about after against all also an and any are as at be been before being
+    between both but by can could did do does during each for from had has
+    have he her hers him his how however i if in into is it its just me more
+    most my no not of off on once one only or other our out over own same she
+    so some such than that the their them then there these they this those
+    through to too two under until up very was we were what when where which
+    while who whom why will with would you your
+""".split())
+
+
+def movie_terms(movie: dict) -> Counter:
+    """ Count the features of a single movie, keyed by "<kind>:<value>" """
+    terms = Counter()
+
+    for genre in movie.get("genres") or []:
+        terms[f"genre:{genre.lower()}"] += 1
+    for director in movie.get("directors") or []:
+        terms[f"director:{director.lower()}"] += 1
+    for actor in movie.get("actors") or []:
+        terms[f"actor:{actor.lower()}"] += 1
+
+    year = movie.get("year")
+    if year is not None:
+        terms[f"decade:{year // 10 * 10}"] += 1
+
+    runtime = movie.get("runtime_minutes")
+    if runtime is not None:
+        terms[f"runtime:{runtime // 30 * 30}"] += 1
+
+    text = " ".join(movie.get(field) or "" for field in ("Plot", "Synopsis"))
+    for word in re.findall(r"[a-z0-9']+", text.lower()):
+        if len(word) > 2 and word not in STOP_WORDS:
+            terms[f"word:{word}"] += 1
+
+    return terms
+
+
+def _encode_strings(values: List[str]) -> np.ndarray:
+    """ Strings as UTF-8 JSON bytes, so they're saved and loaded without pickling """
+    return np.frombuffer(json.dumps(values).encode("utf-8"), dtype=np.uint8)
+
+
+def _decode_strings(array: np.ndarray) -> List[str]:
+    return json.loads(array.tobytes().decode("utf-8"))
+
+
+class RecommendationIndex:
+    """ Normalized feature vectors for every movie along with their nearest neighbours
+
+    Vectors live in a memory-mapped LSHIndex. Neighbours are found exactly
+    until the catalog reaches ann_threshold movies, then approximately.
+    """
+
+    def __init__(
+        self,
+        vocabulary: List[str],
+        weights: np.ndarray,
+        slugs: List[str],
+        neighbor_ids: np.ndarray,
+        neighbor_scores: np.ndarray,
+        ann: LSHIndex,
+        ann_threshold: int,
+    ):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.weights = weights
+        self.slugs = slugs
+        self.slug_ids = {slug: i for i, slug in enumerate(slugs)}
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_scores = neighbor_scores
+        self.ann = ann
+        self.ann_threshold = ann_threshold
+
+    @property
+    def vectors(self) -> scipy.sparse.csr_matrix:
+        """ Every movie's feature vector, one row per movie """
+        return self.ann.vectors
+
+    @property
+    def uses_ann(self) -> bool:
+        """ Whether neighbours are currently found approximately """
+        return len(self.slugs) >= self.ann_threshold
+
+    @classmethod
+    def build(cls, movies: Iterable[dict], directory: str, config) -> "RecommendationIndex":
+        """ Build an index from scratch over every movie """
+        slugs = []
+        movie_term_counts = []
+        document_frequency = Counter()
+
+        for movie in movies:
+            terms = movie_terms(movie)
+            slugs.append(movie["slug"])
+            movie_term_counts.append(terms)
+            document_frequency.update(terms.keys())
+
+        # A feature only one movie has can't make two movies similar
+        shared_terms = [term for term, df in document_frequency.items() if df > 1]
+        shared_terms.sort(key=lambda term: (-document_frequency[term], term))
+        vocabulary = shared_terms[:config["RECS_MAX_FEATURES"]]
+
+        movie_count = len(slugs)
+        weights = np.array([
+            FEATURE_WEIGHTS[term.split(":", 1)[0]] * (
+                math.log((1 + movie_count) / (1 + document_frequency[term])) + 1
+                if term.startswith("word:") else 1.0
+            )
+            for term in vocabulary
+        ], dtype=np.float32)
+
+        tables = config["RECS_ANN_TABLES"]
+        planes = LSHIndex.make_planes(
+            len(vocabulary), tables, config["RECS_ANN_BITS"], config["RECS_ANN_SEED"])
+        ann = LSHIndex.create(
+            directory, uuid.uuid4().hex, planes, tables, config["RECS_ANN_PROBES"])
+
+        neighbors = config["RECS_NEIGHBORS"]
+        index = cls(
+            vocabulary,
+            weights,
+            slugs,
+            neighbor_ids=np.zeros((0, neighbors), dtype=np.int32),
+            neighbor_scores=np.zeros((0, neighbors), dtype=np.float32),
+            ann=ann,
+            ann_threshold=config["RECS_ANN_THRESHOLD"],
+        )
+
+        batch_size = config["RECS_BATCH_SIZE"]
+        for start in range(0, movie_count, batch_size):
+            ann.add(index._vectorize_terms(movie_term_counts[start:start + batch_size]))
+
+        index.neighbor_ids, index.neighbor_scores = index.nearest(
+            index.vectors, neighbors, batch_size, exclude_self_from=0)
+
+        return index
+
+    def _vectorize_terms(self, movie_term_counts: List[Counter]) -> scipy.sparse.csr_matrix:
+        rows, columns, counts = [], [], []
+
+        for row, terms in enumerate(movie_term_counts):
+            for term, count in terms.items():
+                column = self.term_ids.get(term)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    counts.append(count)
+
+        columns = np.array(columns, dtype=np.int32)
+        vectors = scipy.sparse.csr_matrix(
+            (np.array(counts, dtype=np.float32) * self.weights[columns], (rows, columns)),
+            shape=(len(movie_term_counts), len(self.vocabulary)),
+            dtype=np.float32,
+        )
+
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        vectors.data /= np.repeat(norms, np.diff(vectors.indptr)).astype(np.float32)
+        return vectors
+
+    def vectorize(self, movies: Iterable[dict]) -> scipy.sparse.csr_matrix:
+        """ Turn movies into normalized feature vectors using this index's vocabulary """
+        return self._vectorize_terms([movie_terms(movie) for movie in movies])
+
+    def nearest(self, vectors: scipy.sparse.csr_matrix, k: int, batch_size: int,
+                exclude_self_from: Optional[int] = None):
+        """ Find the k most similar indexed movies to each vector
+
+        If the vectors are rows of this index starting at exclude_self_from,
+        each movie is kept out of its own results. Returns the neighbours'
+        row numbers and similarities, most similar first, padded with -1 when
+        there are fewer than k other movies.
+        """
+        vectors = as_rows(vectors)
+        count = vectors.shape[0]
+        neighbor_ids = np.full((count, k), -1, dtype=np.int32)
+        neighbor_scores = np.zeros((count, k), dtype=np.float32)
+        indexed = self.vectors.shape[0]
+
+        if indexed == 0 or count == 0:
+            return neighbor_ids, neighbor_scores
+
+        if self.uses_ann:
+            for row in range(count):
+                exclude = None if exclude_self_from is None else exclude_self_from + row
+                found_ids, found_scores = self.ann.query(vectors[row], k, exclude)
+                neighbor_ids[row, :len(found_ids)] = found_ids
+                neighbor_scores[row, :len(found_ids)] = found_scores
+
+            return neighbor_ids, neighbor_scores
+
+        for start in range(0, count, batch_size):
+            batch = vectors[start:start + batch_size]
+            similarities = (batch @ self.vectors.T).toarray()
+
+            if exclude_self_from is not None:
+                rows = np.arange(batch.shape[0])
+                similarities[rows, exclude_self_from + start + rows] = -np.inf
+
+            found = min(k, indexed - (exclude_self_from is not None))
+            if found <= 0:
+                continue
+
+            top = np.argpartition(-similarities, found - 1, axis=1)[:, :found]
+            top_scores = np.take_along_axis(similarities, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+
+            stop = start + batch.shape[0]
+            neighbor_ids[start:stop, :found] = np.take_along_axis(top, order, axis=1)
+            neighbor_scores[start:stop, :found] = np.take_along_axis(top_scores, order, axis=1)
+
+        return neighbor_ids, neighbor_scores
+
+    def add(self, movies: List[dict], batch_size: int) -> List[int]:
+        """ Add new movies to the index, updating the neighbours of existing movies
+
+        Movies already in the index are skipped. Returns the row numbers of
+        every movie whose neighbours changed.
+        """
+        movies = [movie for movie in movies if movie["slug"] not in self.slug_ids]
+        if not movies:
+            return []
+
+        k = self.neighbor_ids.shape[1]
+        first_new = len(self.slugs)
+        new_vectors = self.vectorize(movies)
+
+        for movie in movies:
+            self.slug_ids[movie["slug"]] = len(self.slugs)
+            self.slugs.append(movie["slug"])
+
+        self.ann.add(new_vectors)
+        new_ids, new_scores = self.nearest(new_vectors, k, batch_size, exclude_self_from=first_new)
+
+        # Existing movies pick up a new movie if it beats their weakest neighbour.
+        # With LSH, only movies sharing a bucket with a new movie are considered.
+        if self.uses_ann:
+            rows = np.unique(np.concatenate(
+                [self.ann.candidates(new_vectors[row]) for row in range(new_vectors.shape[0])]))
+            rows = rows[rows < first_new]
+        else:
+            rows = np.arange(first_new)
+
+        similarities = (self.vectors[rows] @ new_vectors.T).toarray()
+        current_ids = self.neighbor_ids[rows]
+        combined_ids = np.hstack([
+            current_ids,
+            np.broadcast_to(np.arange(first_new, len(self.slugs), dtype=np.int32),
+                            similarities.shape),
+        ])
+        combined_scores = np.hstack([
+            np.where(current_ids >= 0, self.neighbor_scores[rows], -np.inf),
+            similarities,
+        ])
+        order = np.argsort(-combined_scores, axis=1, kind="stable")[:, :k]
+        updated_ids = np.take_along_axis(combined_ids, order, axis=1)
+        updated_scores = np.take_along_axis(combined_scores, order, axis=1)
+        updated_ids[np.isinf(updated_scores)] = -1
+        updated_scores[np.isinf(updated_scores)] = 0
+
+        changed = set(range(first_new, len(self.slugs)))
+        changed.update(rows[(updated_ids != current_ids).any(axis=1)].tolist())
+
+        self.neighbor_ids[rows] = updated_ids
+        self.neighbor_scores[rows] = updated_scores
+        self.neighbor_ids = np.vstack([self.neighbor_ids, new_ids])
+        self.neighbor_scores = np.vstack([self.neighbor_scores, new_scores])
+
+        return sorted(changed)
+
+    def neighbors_of(self, row: int) -> List[dict]:
+        """ The stored form of a movie's neighbours """
+        return [
+            {"slug": self.slugs[neighbor], "score": round(float(score), 4)}
+            for neighbor, score in zip(self.neighbor_ids[row], self.neighbor_scores[row])
+            if neighbor >= 0 and score > 0
+        ]
+
+    def save(self):
+        """ Write everything but the vectors next to the LSH index's files
+
+        The file is replaced atomically so other processes never read a
+        partly written index. It holds only plain arrays, so loading it never
+        unpickles anything.
+        """
+        path = os.path.join(self.ann.directory, INDEX_FILE)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(temp_path, "wb") as index_file:
+            np.savez(
+                index_file,
+                format=INDEX_FORMAT,
+                vocabulary=_encode_strings(self.vocabulary),
+                weights=self.weights,
+                slugs=_encode_strings(self.slugs),
+                neighbor_ids=self.neighbor_ids,
+                neighbor_scores=self.neighbor_scores,
+                planes=self.ann.planes,
+                tables=self.ann.tables,
+                generation=self.ann.generation,
+            )
+
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, directory: str, config) -> Optional["RecommendationIndex"]:
+        """ Open an index written by save, memory-mapping its vectors
+
+        Returns None if the index was saved in an older layout.
+        """
+        with np.load(os.path.join(directory, INDEX_FILE)) as data:
+            if "format" not in data.files or int(data["format"]) != INDEX_FORMAT:
+                return None
+
+            slugs = _decode_strings(data["slugs"])
+            ann = LSHIndex(
+                directory,
+                str(data["generation"]),
+                data["planes"],
+                int(data["tables"]),
+                len(slugs),
+                config["RECS_ANN_PROBES"],
+            )
+            return cls(
+                _decode_strings(data["vocabulary"]),
+                data["weights"],
+                slugs,
+                data["neighbor_ids"],
+                data["neighbor_scores"],
+                ann,
+                config["RECS_ANN_THRESHOLD"],
+            )
+
+
+class _IndexState:
+    """ The loaded index for an app, along with the version of the file it came from """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.index = None
+        self.mtime = None
+
+
+def _index_directory() -> str:
+    directory = current_app.config["RECS_INDEX_DIR"]
+    if directory is None:
+        directory = os.path.join(current_app.instance_path, "recommendations")
+    return directory
+
+
+def _store_neighbors(index: RecommendationIndex, rows: Iterable[int]):
+    """ Write the neighbours of the given rows to the recommendations collection """
+    operations = [
+        UpdateOne(
+            {"slug": index.slugs[row]},
+            {"$set": {"similar": index.neighbors_of(row)}},
+            upsert=True,
+        )
+        for row in rows
+    ]
+
+    if operations:
+        get_db().recommendations.bulk_write(operations, ordered=False)
+    bump_version("recommendations")
+
+
+@contextlib.contextmanager
+def _index_lock(directory: str, exclusive: bool = True) -> Iterator[None]:
+    """ Hold a lock on the index directory that every process using it respects
+
+    Writers hold it exclusively from reading the saved index until they've
+    saved their changes, so two processes can't append at the same offset
+    or save over each other. Readers hold it shared while opening the index.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, LOCK_FILE), "a", encoding="ascii") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _index_mtime(directory: str) -> Optional[int]:
+    path = os.path.join(directory, INDEX_FILE)
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+def _saved_generation(directory: str) -> Optional[str]:
+    """ The generation of the index saved in directory, if there is one """
+    if _index_mtime(directory) is None:
+        return None
+
+    with np.load(os.path.join(directory, INDEX_FILE)) as data:
+        return str(data["generation"])
+
+
+def _load(state: _IndexState, directory: str) -> Optional[RecommendationIndex]:
+    """ Open the saved index unless it's the one already open; the caller holds the locks """
+    mtime = _index_mtime(directory)
+
+    if mtime is None:
+        state.index = None
+    elif state.index is None or state.mtime != mtime:
+        state.index = RecommendationIndex.load(directory, current_app.config)
+
+    state.mtime = mtime
+    return state.index
+
+
+def _save(state: _IndexState, index: RecommendationIndex):
+    index.save()
+    state.index = index
+    state.mtime = _index_mtime(index.ann.directory)
+
+
+def _build(state: _IndexState, directory: str) -> RecommendationIndex:
+    """ Build and save a new index; the caller holds the locks """
+    previous_generation = _saved_generation(directory)
+    index = RecommendationIndex.build(
+        get_db().movies.find({}, FEATURE_PROJECTION),
+        directory,
+        current_app.config,
+    )
+
+    get_db().recommendations.delete_many({})
+    _store_neighbors(index, range(len(index.slugs)))
+
+    _save(state, index)
+    if previous_generation not in (None, index.ann.generation):
+        remove_generation(directory, previous_generation)
+
+    return index
+
+
+def build_index() -> RecommendationIndex:
+    """ Rebuild the index over every stored movie and store every movie's neighbours """
+    state = current_app.extensions.setdefault(EXTENSION_NAME, _IndexState())
+    directory = _index_directory()
+
+    with state.lock, _index_lock(directory):
+        return _build(state, directory)
+
+
+def get_index() -> Optional[RecommendationIndex]:
+    """ Provides the index saved on disk, or None if it hasn't been built yet
+
+    An index that another process has saved since it was opened is reopened.
+    """
+    state = current_app.extensions.setdefault(EXTENSION_NAME, _IndexState())
+    directory = _index_directory()
+
+    with state.lock:
+        if _index_mtime(directory) is None:
+            return None
+
+        with _index_lock(directory, exclusive=False):
+            return _load(state, directory)
+
+
+def index_movies(movies: List[dict], build: bool = True):
+    """ Add newly inserted movies to the index and update any affected neighbours
+
+    The saved index is reopened first if another process has changed it. If
+    there's no index yet, one is built over every stored movie instead, or
+    without build nothing is done.
+    """
+    state = current_app.extensions.setdefault(EXTENSION_NAME, _IndexState())
+    directory = _index_directory()
+
+    with state.lock, _index_lock(directory):
+        index = _load(state, directory)
+        if index is None:
+            if build:
+                _build(state, directory)
+            return
+
+        try:
+            changed = index.add(
+                [{key: movie.get(key) for key in FEATURE_PROJECTION} for movie in movies],
+                current_app.config["RECS_BATCH_SIZE"],
+            )
+
+            if changed:
+                _store_neighbors(index, changed)
+                _save(state, index)
+        except BaseException:
+            # The open index may have been changed without being saved
+            state.index = None
+            raise
+
+
+def get_similar_movies(slug: str, limit: Optional[int] = None) -> List[dict]:
+    """ Returns the movies most similar to the one with slug, most similar first
+
+    Each movie has the fields needed to list it plus its similarity score.
+    """
+    database = get_db()
+    recommendation = database.recommendations.find_one({"slug": slug})
+
+    if recommendation is None:
+        return []
+
+    similar = recommendation["similar"][:limit]
+    scores = {neighbor["slug"]: neighbor["score"] for neighbor in similar}
+    movies: Dict[str, dict] = {
+        movie["slug"]: movie
+        for movie in database.movies.find({"slug": {"$in": list(scores)}}, LIST_PROJECTION)
+    }
+
+    return [
+        {**movies[neighbor["slug"]], "score": neighbor["score"]}
+        for neighbor in similar
+        if neighbor["slug"] in movies
+    ]
+
+
+def _run_index_job(job: dict):
+    index_movies(list(get_db().movies.find({"slug": {"$in": job["slugs"]}}, FEATURE_PROJECTION)))
+
+
+def _on_movies_changed(event: str, movies: List[dict]):
+    if event != "added" or not current_app.config["RECS_UPDATE_ON_INSERT"]:
+        return
+
+    if current_app.config["MOVIES_ADD_QUEUED"]:
+        enqueue_job(INDEX_MOVIES, slugs=[movie["slug"] for movie in movies])
+    else:
+        # Without a worker, building a missing index is left to the command line
+        index_movies(movies, build=False)
+
+
+def init_app(app: Flask):
+    """ Index added movies, queueing them for a worker if there is one """
+    add_movie_listener(app, _on_movies_changed)
+    add_job_handler(app, INDEX_MOVIES, _run_index_job)
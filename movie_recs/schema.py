@@ -0,0 +1,129 @@
+""" Turns the OMDB's records into the typed movie documents that are stored
+
+The OMDB returns every value as a string, such as "1958", "128 min",
+"1,234,567" or "Mystery, Romance, Thriller", and "N/A" for anything it
+doesn't know. Before a movie is stored, the fields listed in TYPED_FIELDS are
+parsed into numbers, dates and lists under snake_case names so they can be
+indexed, filtered and compared without reparsing. Fields that keep their
+meaning as text, like Title, Plot and Poster, keep their OMDB names. Values
+of "N/A" are dropped rather than stored. Genres are also stored lower cased
+as genre_keys, so they can be matched regardless of case using an index.
+
+Listings only need LISTING_FIELDS, which are small. The rest, like the plot,
+cast and ratings, are only read for a movie's own page and the
+recommendation index.
+"""
+import datetime
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+MISSING = "N/A"
+
+
+def parse_int(value) -> Optional[int]:
+    """ The first whole number in a value, ignoring thousands separators """
+    if isinstance(value, int):
+        return value
+    match = re.search(r"\d+", (value or "").replace(",", ""))
+    return int(match.group()) if match else None
+
+
+def parse_float(value) -> Optional[float]:
+    """ The first number in a value, which may have a fractional part """
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"\d+(?:\.\d+)?", (value or "").replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def parse_list(value) -> List[str]:
+    """ Split a comma joined value """
+    if isinstance(value, list):
+        return value
+    if not value or value == MISSING:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def parse_date(value) -> Optional[datetime.datetime]:
+    """ Parse a date written like "09 May 1958" """
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.strptime(value or "", "%d %b %Y")
+    except ValueError:
+        return None
+
+
+def parse_score(value: str) -> Optional[float]:
+    """ Convert a rating like "8.3/10", "94%" or "100/100" to a score out of 100 """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?)|%)\s*", value or "")
+    if match is None:
+        return None
+    scale = float(match.group(2)) if match.group(2) else 100.0
+    return round(float(match.group(1)) * 100 / scale, 1) if scale else None
+
+
+def parse_ratings(value) -> List[dict]:
+    """ Convert the OMDB's Ratings to a list of {"source", "score"} """
+    ratings = []
+    for rating in value or []:
+        if "score" in rating:
+            ratings.append(rating)
+            continue
+        score = parse_score(rating.get("Value"))
+        if rating.get("Source") and score is not None:
+            ratings.append({"source": rating["Source"], "score": score})
+    return ratings
+
+
+# How each OMDB field is renamed and parsed
+TYPED_FIELDS: Dict[str, Tuple[str, Callable]] = {
+    "Year": ("year", parse_int),
+    "Runtime": ("runtime_minutes", parse_int),
+    "Released": ("released", parse_date),
+    "Genre": ("genres", parse_list),
+    "Director": ("directors", parse_list),
+    "Writer": ("writers", parse_list),
+    "Actors": ("actors", parse_list),
+    "Language": ("languages", parse_list),
+    "Country": ("countries", parse_list),
+    "imdbRating": ("imdb_rating", parse_float),
+    "imdbVotes": ("imdb_votes", parse_int),
+    "Metascore": ("metascore", parse_int),
+    "BoxOffice": ("box_office", parse_int),
+    "Ratings": ("ratings", parse_ratings),
+}
+
+# OMDB fields that say nothing about the movie
+DROPPED_FIELDS = ("Response",)
+
+# The fields the movie list shows, read with a projection
+LISTING_FIELDS = ("slug", "Title", "year", "genres", "Poster", "Synopsis", "revision")
+
+
+def normalize_movie(movie: dict) -> dict:
+    """ Returns a movie with its OMDB strings parsed into typed fields
+
+    Fields that are already typed are kept, so a stored movie can be
+    normalized again, as can a partial update.
+    """
+    normalized = {}
+
+    for key, value in movie.items():
+        if key in DROPPED_FIELDS:
+            continue
+
+        if key in TYPED_FIELDS:
+            name, parse = TYPED_FIELDS[key]
+            parsed = parse(value)
+            if parsed not in (None, []):
+                normalized[name] = parsed
+        elif value != MISSING:
+            normalized[key] = value
+
+    if "genres" in normalized:
+        normalized["genre_keys"] = list(dict.fromkeys(
+            genre.lower() for genre in normalized["genres"]))
+
+    return normalized
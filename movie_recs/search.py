@@ -0,0 +1,387 @@
+""" Title search with genre, year and director facets over a local inverted index
+
+Titles are split into normalized words. A query word matches a title word
+exactly, as a prefix (found by bisecting the sorted vocabulary) or within a
+small edit distance (found through a trigram index over the vocabulary), so
+looking up a word only touches the words that could match it rather than
+every movie. The facets are kept as sets of slugs per value, and titles in
+sorted order, so a search without words can page through titles and count
+facets from the sizes of those sets. Otherwise facets are counted over the
+best SEARCH_FACET_MATCHES matches rather than every one.
+
+Each process builds its index from the movies collection on first use, then
+keeps it current with the movie listener and by periodically picking up
+movies other processes have inserted or changed since, found by their
+updated_at. Movies are read from the database without holding the index's
+lock, so searches only wait for the first load.
+"""
+import bisect
+import datetime
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from flask import Flask, current_app
+from slugify import slugify
+
+from .db import add_movie_listener, get_db
+
+EXTENSION_NAME = "movie_recs.search"
+
+# The fields read from each movie document to index it
+SEARCH_PROJECTION = {
+    "_id": 0, "slug": 1, "Title": 1, "year": 1, "genres": 1, "directors": 1, "revision": 1,
+}
+
+# The fields whose changes need a movie indexing again
+INDEXED_FIELDS = ("Title", "year", "genres", "directors")
+
+# How far before the last refresh to look for changes, allowing for other
+# processes' clocks and for writes that were in flight during the refresh
+REFRESH_OVERLAP = datetime.timedelta(seconds=60)
+
+FACETS = ("genre", "year", "director")
+
+# Points for each way a query word can match a title word
+EXACT_SCORE = 3
+PREFIX_SCORE = 2
+FUZZY_SCORE = 1
+
+
+class SearchResult(NamedTuple):
+    """ The best matching movies along with the facet counts over the best matches """
+    slugs: List[str]
+    titles: List[str]
+    total: int
+    facets: Dict[str, List[tuple]]
+
+
+def tokenize(text: str) -> List[str]:
+    """ Split text into lower case, unaccented words """
+    return [word for word in slugify(text or "").split("-") if word]
+
+
+def _trigrams(word: str) -> Set[str]:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_typos(word: str) -> int:
+    """ How many edits a query word can be away from a title word and still match """
+    if len(word) < 4:
+        return 0
+    if len(word) < 8:
+        return 1
+    return 2
+
+
+def edit_distance(first: str, second: str, limit: int) -> int:
+    """ The Damerau-Levenshtein distance between two words, or limit + 1 if it's over limit """
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+
+    previous, current = None, list(range(len(second) + 1))
+    for i, first_char in enumerate(first, start=1):
+        before, previous, current = previous, current, [i] + [0] * len(second)
+        for j, second_char in enumerate(second, start=1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (first_char != second_char),
+            )
+            if (before is not None and i > 1 and j > 1
+                    and first_char == second[j - 2] and first[i - 2] == second_char):
+                current[j] = min(current[j], before[j - 2] + 1)
+
+        if min(current) > limit:
+            return limit + 1
+
+    return current[-1]
+
+
+class SearchIndex:
+    """ An in-memory inverted index over movie titles and facet values """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Held while reading movies from the database into the index
+        self.loading = threading.Lock()
+        self.titles: Dict[str, str] = {}
+        self.sorted_titles: List[Tuple[str, str]] = []
+        self.revisions: Dict[str, Optional[int]] = {}
+        self.postings: Dict[str, Set[str]] = defaultdict(set)
+        self.vocabulary: List[str] = []
+        self.trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self.facets: Dict[str, Dict[str, Set[str]]] = {facet: defaultdict(set) for facet in FACETS}
+        self.facet_names: Dict[str, Dict[str, str]] = {facet: {} for facet in FACETS}
+        self.movie_facets: Dict[str, Dict[str, List[str]]] = {}
+        self.movie_words: Dict[str, List[str]] = {}
+        self.updated_since: Optional[datetime.datetime] = None
+        self.refreshed = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def is_current(self, movie: dict) -> bool:
+        """ Whether the index already has this revision of a movie """
+        slug = movie["slug"]
+        return slug in self.revisions and self.revisions[slug] == movie.get("revision")
+
+    def add(self, movie: dict):
+        """ Index a movie, replacing any earlier version of it
+
+        A movie older than the revision already indexed is ignored, in case a
+        refresh read it before a listener indexed the newer one.
+        """
+        slug = movie["slug"]
+
+        with self.lock:
+            indexed = self.revisions.get(slug)
+            if indexed is not None and (movie.get("revision") or 0) < indexed:
+                return
+
+            self.remove(slug)
+            self.titles[slug] = movie.get("Title") or slug
+            self.revisions[slug] = movie.get("revision")
+            bisect.insort(self.sorted_titles, (self.titles[slug].lower(), slug))
+
+            words = sorted(set(tokenize(movie.get("Title"))))
+            for word in words:
+                if word not in self.postings:
+                    bisect.insort(self.vocabulary, word)
+                    for trigram in _trigrams(word):
+                        self.trigrams[trigram].add(word)
+                self.postings[word].add(slug)
+            self.movie_words[slug] = words
+
+            values = {
+                "genre": movie.get("genres") or [],
+                "year": [str(movie["year"])] if movie.get("year") else [],
+                "director": movie.get("directors") or [],
+            }
+            for facet, names in values.items():
+                for name in names:
+                    self.facets[facet][name.lower()].add(slug)
+                    self.facet_names[facet].setdefault(name.lower(), name)
+            self.movie_facets[slug] = values
+
+    def remove(self, slug: str):
+        """ Remove a movie from the index """
+        with self.lock:
+            title = self.titles.pop(slug, None)
+            if title is None:
+                return
+            del self.revisions[slug]
+            del self.sorted_titles[bisect.bisect_left(self.sorted_titles, (title.lower(), slug))]
+
+            for word in self.movie_words.pop(slug):
+                self.postings[word].discard(slug)
+                if not self.postings[word]:
+                    del self.postings[word]
+                    del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+                    for trigram in _trigrams(word):
+                        self.trigrams[trigram].discard(word)
+
+            for facet, names in self.movie_facets.pop(slug).items():
+                for name in names:
+                    self.facets[facet][name.lower()].discard(slug)
+
+    def word_matches(self, query_word: str) -> Dict[str, int]:
+        """ The slugs with a title word matching query_word, with the best score for each """
+        scores: Dict[str, int] = {}
+
+        def match(words: Iterable[str], score: int):
+            for word in words:
+                for slug in self.postings.get(word, ()):
+                    if scores.get(slug, 0) < score:
+                        scores[slug] = score
+
+        start = bisect.bisect_left(self.vocabulary, query_word)
+        end = bisect.bisect_left(self.vocabulary, query_word + "\uffff")
+        match(self.vocabulary[start:end], PREFIX_SCORE)
+        match([query_word], EXACT_SCORE)
+
+        typos = max_typos(query_word)
+        if typos:
+            shared = Counter(
+                word
+                for trigram in _trigrams(query_word)
+                for word in self.trigrams.get(trigram, ())
+            )
+            # Each edit, counting swapping neighbouring letters as one, changes at
+            # most four of a word's trigrams
+            needed = len(_trigrams(query_word)) - 4 * typos
+            match(
+                (
+                    word for word, count in shared.items()
+                    if count >= needed and edit_distance(query_word, word, typos) <= typos
+                ),
+                FUZZY_SCORE,
+            )
+
+        return scores
+
+    def _title_order(self, slug: str) -> Tuple[str, str]:
+        return self.titles[slug].lower(), slug
+
+    def _top_values(self, facet: str, counts: Iterable[Tuple[str, int]],
+                    limit: int) -> List[tuple]:
+        """ The most common facet values, with their display names """
+        return [
+            (self.facet_names[facet][name], count)
+            for name, count in heapq.nsmallest(
+                limit, counts, key=lambda item: (-item[1], item[0]))
+            if count
+        ]
+
+    def search(self, query: str, filters: Optional[Dict[str, str]] = None,
+               limit: int = 20, facet_limit: int = 10,
+               facet_matches: int = 1000) -> SearchResult:
+        """ Find the movies matching every word of query and every facet filter
+
+        Matches are ranked by how closely their titles match, then by title.
+        Facets are counted over the best facet_matches of them, except for a
+        search with no words or filters, whose facets count every movie.
+        """
+        filters = {facet: value for facet, value in (filters or {}).items() if value}
+        query_words = tokenize(query)
+        wanted = max(limit, facet_matches)
+
+        with self.lock:
+            if not query_words and not filters:
+                ranked = [slug for _, slug in self.sorted_titles[:limit]]
+                facets = {
+                    facet: self._top_values(
+                        facet,
+                        ((name, len(slugs)) for name, slugs in self.facets[facet].items()),
+                        facet_limit)
+                    for facet in FACETS
+                }
+                return SearchResult(
+                    ranked, [self.titles[slug] for slug in ranked], len(self.titles), facets)
+
+            allowed: Optional[Set[str]] = None
+            for facet, value in sorted(
+                    filters.items(),
+                    key=lambda item: len(self.facets[item[0]].get(str(item[1]).lower(), ()))):
+                slugs = self.facets[facet].get(str(value).lower(), set())
+                allowed = set(slugs) if allowed is None else allowed & slugs
+
+            if not query_words:
+                total = len(allowed)
+                if total * total > wanted * len(self.titles):
+                    # Most movies are allowed, so walking the titles in order soon finds enough
+                    top = list(itertools.islice(
+                        (slug for _, slug in self.sorted_titles if slug in allowed), wanted))
+                else:
+                    top = heapq.nsmallest(wanted, allowed, key=self._title_order)
+            else:
+                matches: Optional[Dict[str, int]] = None
+                for query_word in query_words:
+                    word_scores = self.word_matches(query_word)
+                    if matches is None:
+                        matches = {
+                            slug: score for slug, score in word_scores.items()
+                            if allowed is None or slug in allowed
+                        }
+                    else:
+                        matches = {
+                            slug: score + word_scores[slug]
+                            for slug, score in matches.items() if slug in word_scores
+                        }
+
+                total = len(matches)
+                top = heapq.nsmallest(
+                    wanted, matches, key=lambda slug: (-matches[slug], *self._title_order(slug)))
+
+            facets = {
+                facet: self._top_values(
+                    facet,
+                    Counter(
+                        name.lower()
+                        for slug in top[:facet_matches]
+                        for name in self.movie_facets[slug][facet]
+                    ).items(),
+                    facet_limit)
+                for facet in FACETS
+            }
+
+            ranked = top[:limit]
+            return SearchResult(ranked, [self.titles[slug] for slug in ranked], total, facets)
+
+
+def _load_changed_movies(index: SearchIndex):
+    """ Index every movie inserted or changed since the index last looked
+
+    Each movie takes the index's lock only while it's added, so searches
+    carry on while the rest are read.
+    """
+    started = datetime.datetime.utcnow()
+    query = ({} if index.updated_since is None
+             else {"updated_at": {"$gte": index.updated_since - REFRESH_OVERLAP}})
+
+    for movie in get_db().movies.find(query, SEARCH_PROJECTION):
+        if not index.is_current(movie):
+            index.add(movie)
+
+    index.updated_since = started
+    index.refreshed = time.monotonic()
+
+
+def get_search_index() -> SearchIndex:
+    """ Provides the search index for the current app, building it on first use
+
+    Searches wait for the first load, since a partly loaded index would
+    miss movies, but not for later refreshes: if another search is already
+    refreshing the index, they use it as it is.
+    """
+    index = current_app.extensions.get(EXTENSION_NAME)
+    if index is None:
+        index = current_app.extensions.setdefault(EXTENSION_NAME, SearchIndex())
+
+    if index.updated_since is None:
+        with index.loading:
+            if index.updated_since is None:
+                _load_changed_movies(index)
+
+    elif (time.monotonic() - index.refreshed > current_app.config["SEARCH_REFRESH_INTERVAL"]
+          and index.loading.acquire(blocking=False)):
+        try:
+            _load_changed_movies(index)
+        finally:
+            index.loading.release()
+
+    return index
+
+
+def search_movies(query: str, filters: Optional[Dict[str, str]] = None,
+                  limit: Optional[int] = None) -> SearchResult:
+    """ Search the current app's movies """
+    config = current_app.config
+    if limit is None:
+        limit = config["SEARCH_RESULTS"]
+
+    return get_search_index().search(
+        query, filters, limit, facet_matches=config["SEARCH_FACET_MATCHES"])
+
+
+def _on_movies_changed(event: str, movies: List[dict]):
+    index = current_app.extensions.get(EXTENSION_NAME)
+    if index is None:
+        return
+
+    for movie in movies:
+        if event == "added":
+            index.add(movie)
+        elif any(field in movie for field in INDEXED_FIELDS):
+            stored = get_db().movies.find_one({"slug": movie["slug"]}, SEARCH_PROJECTION)
+            if stored is not None:
+                index.add(stored)
+
+
+def init_app(app: Flask):
+    """ Keep the search index up to date as movies are added and changed """
+    add_movie_listener(app, _on_movies_changed)
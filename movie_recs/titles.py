@@ -0,0 +1,123 @@
+""" Resolves titles to movies that are already stored, without asking the OMDB
+
+Every stored movie is registered in the aliases collection under the keys
+of its title, its title with its year and any other title it was requested
+by. A key ignores case, accents, punctuation and a leading article, so
+"Rashomon" finds "Rashômon" and "Imitation Game" finds "The Imitation Game".
+"""
+from typing import Dict, Iterable, List, Optional
+
+from flask import Flask
+from pymongo import UpdateOne
+from slugify import slugify
+
+from .db import add_movie_listener, get_db
+
+LEADING_ARTICLES = ("the", "a", "an")
+
+# How many aliases are written at once when registering many movies
+BATCH_SIZE = 1000
+
+
+def title_key(title: str) -> str:
+    """ Reduce a title to the key its aliases are stored under """
+    key = slugify(title or "")
+    for article in LEADING_ARTICLES:
+        if key.startswith(f"{article}-") and len(key) > len(article) + 1:
+            return key[len(article) + 1:]
+    return key
+
+
+def movie_title_keys(movie: dict) -> List[str]:
+    """ The keys a stored movie can be found by """
+    keys = [title_key(movie.get("Title")), movie["slug"]]
+
+    if movie.get("year"):
+        keys.append(title_key(f"{movie.get('Title')} {movie['year']}"))
+
+    return keys
+
+
+def add_aliases(slug: str, titles: Iterable[str]):
+    """ Register other titles a movie can be found by
+
+    A key that already belongs to another movie keeps pointing at that movie.
+    """
+    add_alias_keys([(title_key(title), slug) for title in titles])
+
+
+def add_alias_keys(keys: Iterable[tuple]):
+    """ Register (key, slug) pairs, leaving keys that are already taken alone """
+    operations = [
+        UpdateOne({"key": key}, {"$setOnInsert": {"slug": slug}}, upsert=True)
+        for key, slug in dict(keys).items()
+        if key
+    ]
+
+    if operations:
+        get_db().aliases.bulk_write(operations, ordered=False)
+
+
+def index_titles(movies: Iterable[dict]) -> int:
+    """ Register the keys of each movie, returning how many movies were registered """
+    count = 0
+    keys = []
+    for movie in movies:
+        keys.extend((key, movie["slug"]) for key in movie_title_keys(movie))
+        count += 1
+
+        if len(keys) >= BATCH_SIZE:
+            add_alias_keys(keys)
+            keys = []
+
+    add_alias_keys(keys)
+    return count
+
+
+def index_all_titles() -> int:
+    """ Register the keys of every stored movie """
+    return index_titles(get_db().movies.find({}, {"_id": 0, "slug": 1, "Title": 1, "year": 1}))
+
+
+def resolve_title(title: str) -> Optional[str]:
+    """ Returns the slug of the stored movie a title refers to, or None if it's unknown """
+    key = title_key(title)
+    if not key:
+        return None
+
+    alias = get_db().aliases.find_one({"key": key}, {"_id": 0, "slug": 1})
+    if alias is not None:
+        return alias["slug"]
+
+    movie = get_db().movies.find_one({"slug": slugify(title)}, {"_id": 0, "slug": 1})
+    return movie["slug"] if movie is not None else None
+
+
+def resolve_titles(titles: Iterable[str]) -> Dict[str, str]:
+    """ Resolve many titles at once, returning the slug of each title that's known """
+    database = get_db()
+    keys = {title: title_key(title) for title in titles if title_key(title)}
+
+    slugs = {
+        alias["key"]: alias["slug"]
+        for alias in database.aliases.find(
+            {"key": {"$in": list(set(keys.values()))}}, {"_id": 0, "key": 1, "slug": 1})
+    }
+    resolved = {title: slugs[key] for title, key in keys.items() if key in slugs}
+
+    unresolved = {slugify(title): title for title in keys if title not in resolved}
+    for movie in database.movies.find(
+            {"slug": {"$in": list(unresolved)}}, {"_id": 0, "slug": 1}):
+        resolved[unresolved[movie["slug"]]] = movie["slug"]
+
+    return resolved
+
+
+def _on_movies_changed(event: str, movies: List[dict]):
+    if event == "added":
+        index_titles(movies)
+
+
+def init_app(app: Flask):
+    """ Register the titles of movies as they're added """
+    add_movie_listener(app, _on_movies_changed)
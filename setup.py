@@ -7,9 +7,12 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
-        "flask",
+        "flask[async]",
+        "httpx",
+        "numpy",
         "pymongo",
         "python-slugify",
         "requests",
+        "scipy",
     ],
 )
@@ -0,0 +1,79 @@
+""" Test behavior of the approximate nearest neighbour index """
+import tempfile
+import unittest
+
+import numpy as np
+from movie_recs.ann import LSHIndex
+
+
+def clustered_vectors(count: int, dimensions: int, clusters: int, seed: int = 1) -> np.ndarray:
+    """ Normalized vectors scattered around a few random centres """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimensions))
+    vectors = centres[rng.integers(clusters, size=count)]
+    vectors = vectors + 0.3 * rng.standard_normal((count, dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+class LSHIndexTest(unittest.TestCase):
+    """ Test behavior of the approximate nearest neighbour index """
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = temp_dir.name
+
+        self.vectors = clustered_vectors(2000, 32, clusters=20)
+        self.planes = LSHIndex.make_planes(32, tables=8, bits=10, seed=0)
+        self.index = LSHIndex.create(self.directory, "test", self.planes, tables=8)
+        self.index.add(self.vectors)
+
+    def exact_neighbors(self, vector, k, exclude):
+        """ Helper function to find the true nearest neighbours by brute force """
+        scores = self.vectors @ vector
+        scores[exclude] = -np.inf
+        return set(np.argsort(-scores)[:k].tolist())
+
+    def test_recall_against_exact_search(self):
+        """ Most of the true nearest neighbours should be found """
+        k = 10
+        found = 0
+
+        for row in range(0, 2000, 40):
+            rows, _ = self.index.query(self.vectors[row], k, exclude=row)
+            found += len(set(rows.tolist()) & self.exact_neighbors(self.vectors[row], k, row))
+
+        recall = found / (k * 50)
+        self.assertGreater(recall, 0.9)
+
+    def test_results_sorted_by_similarity(self):
+        """ Results should be most similar first and exclude the given row """
+        rows, scores = self.index.query(self.vectors[0], 10, exclude=0)
+
+        self.assertNotIn(0, rows.tolist())
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+        np.testing.assert_allclose(scores, self.vectors[rows] @ self.vectors[0], rtol=1e-5)
+
+    def test_reopened_from_files(self):
+        """ An index opened from its files should give the same results """
+        reopened = LSHIndex(self.directory, "test", self.planes, tables=8, count=2000)
+
+        expected_rows, _ = self.index.query(self.vectors[5], 10)
+        rows, _ = reopened.query(self.vectors[5], 10)
+
+        self.assertIsInstance(reopened.data, np.memmap)
+        self.assertIsInstance(reopened.indices, np.memmap)
+        self.assertEqual(rows.tolist(), expected_rows.tolist())
+
+    def test_added_vectors_found(self):
+        """ Vectors appended after querying should be found by later queries """
+        self.index.query(self.vectors[0], 10)
+
+        new_vector = self.vectors[7] + 0.01
+        new_vector /= np.linalg.norm(new_vector)
+        self.index.add(new_vector[np.newaxis])
+
+        rows, _ = self.index.query(new_vector, 1)
+
+        self.assertEqual(rows.tolist(), [2000])
@@ -1,9 +1,12 @@
 """ Test behavior of authentication module """
 
 from typing import NamedTuple
+from unittest.mock import patch
 
 from flask import g, session, url_for
+from movie_recs.auth import get_user_cache, get_user_cache_stats
 from movie_recs.db import get_user_by_username
+from movie_recs.passwords import get_executor
 
 from fixtures import AuthenticationTestFixture
 
@@ -173,3 +176,69 @@ class AuthTest(AuthenticationTestFixture):
             with self.subTest(path=path):
                 response = client.get(path)
                 self.assertIsNone(response.location)
+
+    def test_logged_in_user_cached_between_requests(self):
+        """ Loading the logged in user shouldn't query the database on every request """
+
+        client = self.app.test_client()
+        self.login(client=client)
+
+        with patch("movie_recs.auth.get_user_by_id") as mock_get_user:
+            client.get("/")
+            client.get("/")
+
+        mock_get_user.assert_not_called()
+        self.assertEqual(get_user_cache_stats()["hits"], 2)
+
+    def test_logout_invalidates_cached_user(self):
+        """ Logging out should drop the user from the cache """
+
+        with self.app.test_client() as client:
+            self.login(client=client)
+            client.get("/")
+            user_id = session["user_id"]
+            self.assertIsNotNone(get_user_cache().get(user_id))
+
+            self.logout(client)
+
+        self.assertIsNone(get_user_cache().get(user_id))
+
+    def test_session_claims_replace_user_lookup(self):
+        """ With session claims enabled, the user should be loaded from the session """
+
+        self.app.config.from_mapping(AUTH_SESSION_CLAIMS=True)
+
+        with self.app.test_client() as client:
+            self.login(client=client)
+            get_user_cache().clear()
+
+            with patch("movie_recs.auth.get_user_by_id") as mock_get_user:
+                client.get("/")
+
+            mock_get_user.assert_not_called()
+            self.assertEqual(g.user["username"], self.default_username)
+
+    def test_password_rehashed_when_settings_change(self):
+        """ Logging in should upgrade a hash made with old settings """
+
+        old_hash = get_user_by_username(self.default_username)["password_hash"]
+        self.app.config.from_mapping(AUTH_HASH_METHOD="pbkdf2:sha256:1000", AUTH_SALT_LENGTH=8)
+
+        response = self.login()
+
+        new_hash = get_user_by_username(self.default_username)["password_hash"]
+        self.assertIn("Location", response.headers)
+        self.assertNotEqual(new_hash, old_hash)
+        self.assertTrue(new_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertEqual(self.login().status_code, 302)
+
+    def test_hashing_offloaded_to_thread_pool(self):
+        """ Registering and logging in should work with hashing on a thread pool """
+
+        self.app.config.from_mapping(AUTH_HASH_EXECUTOR="thread")
+
+        self.register_user("pooled", "pooled123")
+        response = self.login("pooled", "pooled123")
+
+        self.assertIn("Location", response.headers)
+        self.assertIsNotNone(get_executor())
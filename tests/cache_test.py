@@ -0,0 +1,93 @@
+""" Test behavior of the local caches """
+import os.path
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from movie_recs.cache import SqliteCache, TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+    """ Test behavior of the in-process TTL cache """
+
+    def test_entries_expire(self):
+        """ Entries older than the ttl should be treated as missing """
+        cache = TTLCache(10, ttl=60)
+
+        with patch("movie_recs.cache.time.monotonic", return_value=1000):
+            cache.set("key", "value")
+
+        with patch("movie_recs.cache.time.monotonic", return_value=1059):
+            self.assertEqual(cache.get("key"), "value")
+
+        with patch("movie_recs.cache.time.monotonic", return_value=1061):
+            self.assertIsNone(cache.get("key"))
+
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_evicted(self):
+        """ Once full, the least recently used entry should be evicted """
+        cache = TTLCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.evictions, 1)
+
+
+class SqliteCacheTest(unittest.TestCase):
+    """ Test behavior of the persistent SQLite cache """
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, "cache.sqlite3")
+
+    def test_round_trip(self):
+        """ A stored value should be returned by a later lookup """
+        cache = SqliteCache(self.path)
+        cache.set("key", {"Title": "Vertigo"})
+
+        self.assertEqual(cache.get("key"), {"Title": "Vertigo"})
+        self.assertIsNone(cache.get("missing"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_persists_between_instances(self):
+        """ Entries should survive re-opening the database file """
+        SqliteCache(self.path).set("key", "value")
+
+        self.assertEqual(SqliteCache(self.path).get("key"), "value")
+
+    def test_entries_expire(self):
+        """ Entries older than the ttl should be treated as missing """
+        cache = SqliteCache(self.path, ttl=60)
+
+        with patch("movie_recs.cache.time.time", return_value=1000):
+            cache.set("key", "value")
+
+        with patch("movie_recs.cache.time.time", return_value=1059):
+            self.assertEqual(cache.get("key"), "value")
+
+        with patch("movie_recs.cache.time.time", return_value=1061):
+            self.assertIsNone(cache.get("key"))
+
+    def test_least_recently_used_evicted(self):
+        """ Once full, the least recently used entry should be evicted """
+        cache = SqliteCache(self.path, max_entries=2)
+
+        with patch("movie_recs.cache.time.time", return_value=1):
+            cache.set("a", 1)
+        with patch("movie_recs.cache.time.time", return_value=2):
+            cache.set("b", 2)
+        with patch("movie_recs.cache.time.time", return_value=3):
+            cache.get("a")
+        with patch("movie_recs.cache.time.time", return_value=4):
+            cache.set("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.evictions, 1)
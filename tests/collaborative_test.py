@@ -0,0 +1,133 @@
+""" Test behavior of watchlists, ratings and collaborative filtering """
+
+from flask import url_for
+from movie_recs.collaborative import build_similarities, item_similarities, recommend_for_user
+from movie_recs.db import add_movies, get_user_by_username, get_user_movie, set_user_movie
+
+from fixtures import AuthenticationTestFixture
+
+
+class CollaborativeTest(AuthenticationTestFixture):
+    """ Test behavior of watchlists, ratings and collaborative filtering """
+
+    def setUp(self):
+        super().setUp()
+
+        add_movies([
+            {"Title": f"Movie {i}", "slug": f"movie-{i}", "Genre": "Drama"}
+            for i in range(5)
+        ])
+        self.user_id = get_user_by_username(self.default_username)["_id"]
+
+    def add_other_user(self, username, slugs):
+        """ Helper function to register a user who has watched slugs """
+        self.register_user(username=username)
+        user_id = get_user_by_username(username)["_id"]
+        for slug in slugs:
+            set_user_movie(user_id, slug, {"status": "watched"})
+
+    def test_item_similarities_from_co_occurrence(self):
+        """ Movies liked by the same users should be each other's nearest neighbours """
+        similar = item_similarities(
+            [
+                [("a", 1.0), ("b", 1.0)],
+                [("a", 1.0), ("b", 1.0), ("c", 0.5)],
+                [("c", 1.0), ("d", 1.0)],
+            ],
+            neighbors=2,
+        )
+
+        self.assertEqual(similar["a"][0]["slug"], "b")
+        self.assertEqual(similar["d"], [{"slug": "c", "score": similar["d"][0]["score"]}])
+        self.assertAlmostEqual(similar["a"][0]["score"], similar["b"][0]["score"])
+        self.assertTrue(all(len(neighbors) <= 2 for neighbors in similar.values()))
+
+    def test_item_similarities_accumulate_across_chunks(self):
+        """ Splitting users into chunks should not change the result """
+        users = [
+            [("a", 1.0), ("b", 0.5), ("c", 1.0)],
+            [("a", 0.5), ("b", 1.0)],
+            [("b", 1.0), ("c", 1.0)],
+        ]
+
+        self.assertEqual(
+            item_similarities(users, neighbors=5, chunk_pairs=1),
+            item_similarities(users, neighbors=5),
+        )
+
+    def test_item_similarities_keep_strongest_pairs(self):
+        """ Past max_pairs, only the pairs with the most co-occurrence should be kept """
+        users = iter([
+            [("a", 1.0), ("b", 1.0)],
+            [("a", 1.0), ("b", 1.0)],
+            [("c", 0.5), ("d", 0.5)],
+        ])
+
+        similar = item_similarities(users, neighbors=5, max_pairs=1, chunk_pairs=1)
+
+        self.assertEqual(set(similar), {"a", "b"})
+
+    def test_personal_recommendations(self):
+        """ A user should be recommended what similar users watched, and not what they have """
+        self.add_other_user("other-1", ["movie-0", "movie-1", "movie-2"])
+        self.add_other_user("other-2", ["movie-0", "movie-1"])
+        self.add_other_user("other-3", ["movie-3", "movie-4"])
+        set_user_movie(self.user_id, "movie-0", {"status": "watched", "rating": 5})
+
+        build_similarities()
+        recommended = [movie["slug"] for movie in recommend_for_user(self.user_id)]
+
+        self.assertEqual(recommended, ["movie-1", "movie-2"])
+
+    def test_no_recommendations_without_history(self):
+        """ A user who hasn't recorded anything should get no recommendations """
+        self.add_other_user("other-1", ["movie-0", "movie-1"])
+        build_similarities()
+
+        self.assertEqual(recommend_for_user(self.user_id), [])
+
+    def test_watchlist_routes(self):
+        """ Test adding, rating and clearing a movie through the movie page """
+        with self.app.test_client() as client:
+            self.login(client=client)
+
+            with self.app.test_request_context():
+                status_url = url_for("movies.set_status", slug="movie-0")
+                rating_url = url_for("movies.rate", slug="movie-0")
+                watchlist_url = url_for("movies.watchlist")
+
+            client.post(status_url, data={"status": "watchlist"})
+            self.assertEqual(get_user_movie(self.user_id, "movie-0")["status"], "watchlist")
+            self.assertIn(b"Movie 0", client.get(watchlist_url).data)
+
+            client.post(rating_url, data={"rating": "4"})
+            user_movie = get_user_movie(self.user_id, "movie-0")
+            self.assertEqual((user_movie["status"], user_movie["rating"]), ("watched", 4))
+
+            client.post(status_url, data={"status": ""})
+            self.assertIsNone(get_user_movie(self.user_id, "movie-0"))
+
+            self.assertEqual(client.post(rating_url, data={"rating": "9"}).status_code, 400)
+            self.assertEqual(client.post(status_url, data={"status": "loved"}).status_code, 400)
+
+    def test_watchlist_requires_login(self):
+        """ Recording a movie without logging in should redirect to the login page """
+        with self.app.test_request_context():
+            status_url = url_for("movies.set_status", slug="movie-0")
+
+        response = self.app.test_client().post(status_url, data={"status": "watchlist"})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(get_user_movie(self.user_id, "movie-0"))
+
+    def test_index_shows_personal_recommendations(self):
+        """ The first page of movies should lead with the user's recommendations """
+        self.add_other_user("other-1", ["movie-0", "movie-3"])
+        set_user_movie(self.user_id, "movie-0", {"status": "watchlist"})
+        build_similarities()
+
+        with self.app.test_client() as client:
+            self.login(client=client)
+            response = client.get("/")
+
+        self.assertIn(b"Recommended for you", response.data)
@@ -1,15 +1,19 @@
 """ Test behavior of the database module """
+import datetime
+import os
 from unittest.mock import MagicMock, patch
 
 import mongomock
-from movie_recs.db import get_db
+from movie_recs.db import (
+    add_movie, add_movie_listener, close_client, get_client, get_db, get_pool_stats,
+)
 from movie_recs.movie_list import top_100_classic_movies
 import slugify
 
 from fixtures import AppTestFixture
 
 
-def get_dummy_movie_data(movie_title):
+def get_dummy_movie_data(movie_title, refresh=False):  # pylint: disable=unused-argument
     """ Return simplified movie data that omdb.get_movie_data would return """
     movie_data = {
         "Title": movie_title,
@@ -32,15 +36,67 @@ class DatabaseTest(AppTestFixture):
             self.assertIs(db_first_call, db_second_call)
 
     # mongomock.MongoClient.close simply passes.
-    # Use a mock to check that it's called
+    # Use a mock to check whether it's called
     @patch.object(mongomock.MongoClient, "close", autospec=True)
-    def test_leaving_app_context_closes_db(self, mock_close_method: MagicMock):
-        """ Any instance of the db connection should be closed when the app context is left """
+    def test_leaving_app_context_keeps_client_open(self, mock_close_method: MagicMock):
+        """ The shared client should stay open when the app context is left """
         with self.app.app_context():
-            database = get_db()
-            mock_close_method.assert_not_called()
+            get_db()
+
+        mock_close_method.assert_not_called()
+
+    def test_client_shared_between_app_contexts(self):
+        """ Every app context in a process should use the same client """
+        with self.app.app_context():
+            first_client = get_db().client
+
+        with self.app.app_context():
+            second_client = get_db().client
+
+        self.assertIs(first_client, second_client)
+
+    def test_client_replaced_after_fork(self):
+        """ A client created by a parent process should not be reused in a child """
+        with self.app.app_context():
+            parent_client = get_client()
+
+            with patch("movie_recs.db.os.getpid", return_value=os.getpid() + 1):
+                child_client = get_client()
+
+        self.assertIsNot(parent_client, child_client)
 
-        mock_close_method.assert_called_once_with(database.client)
+    def test_pool_settings_from_config(self):
+        """ Pool size and timeouts should be taken from the app config """
+        self.app.config.from_mapping(DB_MAX_POOL_SIZE=7, DB_MAX_IDLE_TIME_MS=1234)
+
+        with patch("movie_recs.db.pymongo.MongoClient") as mock_client:
+            with self.app.app_context():
+                close_client(self.app)
+                get_client()
+
+        kwargs = mock_client.call_args.kwargs
+        self.assertEqual(kwargs["maxPoolSize"], 7)
+        self.assertEqual(kwargs["maxIdleTimeMS"], 1234)
+
+    def test_pool_stats(self):
+        """ Pool stats should report the configured pool size """
+        with self.app.app_context():
+            get_db()
+            stats = get_pool_stats()
+
+        self.assertTrue(stats["client_created"])
+        self.assertEqual(stats["max_pool_size"], self.app.config["DB_MAX_POOL_SIZE"])
+        self.assertEqual(stats["checked_out"], 0)
+
+    def test_failing_listener_logged(self):
+        """ A listener that raises shouldn't fail a write that has already happened """
+        add_movie_listener(self.app, MagicMock(side_effect=RuntimeError("listener failed")))
+
+        with self.app.app_context():
+            with self.assertLogs(self.app.logger, level="ERROR"):
+                add_movie(get_dummy_movie_data("Vertigo"))
+
+            self.assertIsNotNone(get_db().movies.find_one({"slug": "vertigo"}))
 
     @patch("movie_recs.cli.get_movie_data", new=get_dummy_movie_data)
     def test_db_initialization(self):
@@ -56,3 +112,72 @@ class DatabaseTest(AppTestFixture):
         titles_in_db.sort()
 
         self.assertListEqual(titles_in_db, sorted(top_100_classic_movies))
+
+    def test_db_initialization_async(self):
+        """ Ensure that init-db can fetch movies with the asyncio client """
+
+        async def get_movie_data_async(movie_title, session, refresh=False):
+            return get_dummy_movie_data(movie_title, refresh)
+
+        with patch("movie_recs.omdb.get_movie_data_async", new=get_movie_data_async):
+            result = self.app.test_cli_runner().invoke(args=["init-db", "--async"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(f"Added {len(top_100_classic_movies)} movies", result.output)
+
+    def test_db_initialization_reports_failures(self):
+        """ A title that can't be fetched should be reported without stopping init-db """
+        failing_title = top_100_classic_movies[0]
+
+        def get_movie_data(movie_title, refresh=False):  # pylint: disable=unused-argument
+            if movie_title == failing_title:
+                raise LookupError(f"Movie \"{movie_title}\" not found in OMDB.")
+            return get_dummy_movie_data(movie_title)
+
+        with patch("movie_recs.cli.get_movie_data", new=get_movie_data):
+            result = self.app.test_cli_runner().invoke(args=["init-db"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(failing_title, result.output)
+        self.assertIn(f"Added {len(top_100_classic_movies) - 1} movies", result.output)
+
+        with self.app.app_context():
+            self.assertEqual(get_db().movies.count_documents({}),
+                             len(top_100_classic_movies) - 1)
+
+    @patch("movie_recs.cli.get_movie_data", new=get_dummy_movie_data)
+    def test_incremental_db_initialization(self):
+        """ An incremental init-db should keep users and only fetch missing or stale movies """
+        stale_title, missing_title = top_100_classic_movies[:2]
+
+        self.app.test_cli_runner().invoke(args=["init-db"])
+
+        with self.app.app_context():
+            database = get_db()
+            database.users.insert_one({"username": "kept", "password": "hash"})
+            database.movies.delete_one({"Title": missing_title})
+            database.movies.update_one(
+                {"Title": stale_title},
+                {"$set": {"fetched_at": datetime.datetime(2000, 1, 1), "Plot": "Old plot"}},
+            )
+
+        fetched = []
+
+        def get_movie_data(movie_title, refresh=False):
+            fetched.append((movie_title, refresh))
+            return get_dummy_movie_data(movie_title)
+
+        with patch("movie_recs.cli.get_movie_data", new=get_movie_data):
+            result = self.app.test_cli_runner().invoke(args=["init-db", "--incremental"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertCountEqual(fetched, [(stale_title, True), (missing_title, False)])
+        self.assertIn("Added 1 movies", result.output)
+        self.assertIn(f"Refreshed 1 stale movies, {len(top_100_classic_movies) - 2} unchanged",
+                      result.output)
+
+        with self.app.app_context():
+            database = get_db()
+            self.assertEqual(database.users.count_documents({"username": "kept"}), 1)
+            self.assertEqual(database.movies.count_documents({}), len(top_100_classic_movies))
+            self.assertEqual(database.movies.find_one({"Title": stale_title})["Plot"], "Full plot")
@@ -2,9 +2,12 @@
 
 import contextlib
 import json
+import tempfile
 import unittest
 from typing import Optional
+from unittest.mock import patch
 
+import httpx
 import mongomock
 import responses
 from flask import url_for
@@ -24,6 +27,7 @@ class AppTestFixture(unittest.TestCase):
         with contextlib.ExitStack() as stack:
             stack.enter_context(mongomock.patch(servers=TEST_MONGO_HOST))
             stack.enter_context(responses.mock)
+            self.instance_path = stack.enter_context(tempfile.TemporaryDirectory())
             self.addCleanup(stack.pop_all().close)
 
         self.test_movie_title = "The Imitation Game"
@@ -31,10 +35,8 @@ class AppTestFixture(unittest.TestCase):
         self.short_plot = "Short plot"
         self.full_plot = "Full plot"
 
-        def request_callback(request):
-            """ Generate an appropriate response for the request params """
-
-            params: dict = request.params
+        def omdb_response_body(params: dict) -> dict:
+            """ Generate an appropriate response body for the request params """
             response_body = {}
 
             if "apikey" not in params or params["apikey"] != TEST_OMDB_API_KEY:
@@ -53,8 +55,31 @@ class AppTestFixture(unittest.TestCase):
                 else:
                     response_body["Plot"] = self.full_plot
 
+            return response_body
+
+        def request_callback(request):
+            """ Respond to a request made with requests """
             headers = {'request-id': '728d329e-0e86-11e4-a748-0c84dc037c13'}
-            return (200, headers, json.dumps(response_body))
+            return (200, headers, json.dumps(omdb_response_body(request.params)))
+
+        # Requests made by the asyncio client, and an error to raise instead of answering
+        self.async_omdb_calls = []
+        self.async_omdb_error = None
+
+        def async_request_callback(request: httpx.Request) -> httpx.Response:
+            """ Respond to a request made with the asyncio client """
+            params = dict(request.url.params)
+            self.async_omdb_calls.append(params)
+            if self.async_omdb_error is not None:
+                raise self.async_omdb_error
+            return httpx.Response(200, json=omdb_response_body(params))
+
+        async_transport = patch(
+            "movie_recs.omdb._async_transport",
+            new=lambda config: httpx.MockTransport(async_request_callback),
+        )
+        async_transport.start()
+        self.addCleanup(async_transport.stop)
 
         responses.add_callback(
             responses.GET,
@@ -68,7 +93,8 @@ class AppTestFixture(unittest.TestCase):
                 "TESTING": True,
                 "DB_HOST": TEST_MONGO_HOST,
                 "OMDB_API_KEY": TEST_OMDB_API_KEY,
-            }
+            },
+            instance_path=self.instance_path,
         )
 
         with self.app.app_context():
@@ -0,0 +1,97 @@
+""" Test behavior of the rendered fragment cache """
+
+import os
+
+from flask import url_for
+from movie_recs.db import add_movie, get_db, update_movie
+from movie_recs.fragments import EXTENSION_NAME, get_fragment_cache, get_fragment_cache_stats
+
+from fixtures import AppContextTestFixture
+
+
+class FragmentsTest(AppContextTestFixture):
+    """ Test behavior of the rendered fragment cache """
+
+    def setUp(self):
+        super().setUp()
+
+        self.app.config["HTTP_CACHE_ENABLED"] = False
+        add_movie({"Title": "Vertigo", "slug": "vertigo", "Synopsis": "Heights."})
+
+        with self.app.test_request_context():
+            self.list_url = url_for("movies.list_movies")
+            self.detail_url = url_for("movies.movie_details", slug="vertigo")
+
+    def test_fragments_reused(self):
+        """ Rendering a page again should reuse its movie fragments """
+        client = self.app.test_client()
+
+        first = client.get(self.list_url).data
+        second = client.get(self.list_url).data
+        client.get(self.detail_url)
+        client.get(self.detail_url)
+
+        stats = get_fragment_cache_stats()
+        self.assertEqual(first, second)
+        self.assertEqual(stats["renders"], 2)
+        self.assertEqual(stats["memory"]["hits"], 2)
+        self.assertGreaterEqual(stats["saved_seconds"], 0)
+
+    def test_fragments_invalidated_on_update(self):
+        """ Updating a movie should re-render its fragments """
+        client = self.app.test_client()
+        client.get(self.list_url)
+        client.get(self.detail_url)
+
+        update_movie("vertigo", {"Synopsis": "A fear of heights."})
+
+        self.assertIn(b"A fear of heights.", client.get(self.list_url).data)
+        self.assertIn(b"A fear of heights.", client.get(self.detail_url).data)
+
+    def test_write_from_another_process_re_rendered(self):
+        """ A movie written without this process's listeners should still be re-rendered """
+        client = self.app.test_client()
+        client.get(self.list_url)
+
+        get_db().movies.update_one(
+            {"slug": "vertigo"},
+            {"$set": {"Synopsis": "Written elsewhere."}, "$inc": {"revision": 1}},
+        )
+
+        self.assertIn(b"Written elsewhere.", client.get(self.list_url).data)
+
+    def test_navigation_rendered_live(self):
+        """ The user specific parts of a page should not come from the cache """
+        client = self.app.test_client()
+        client.get(self.detail_url)
+
+        client.post("/auth/register", data={"username": "cached", "password": "password"})
+        client.post("/auth/login", data={"username": "cached", "password": "password"})
+        response = client.get(self.detail_url)
+
+        self.assertIn(b"cached", response.data)
+        self.assertIn(b"+ Watchlist", response.data)
+
+    def test_shared_cache(self):
+        """ Fragments in the shared cache should be used by a fresh in-process cache """
+        self.app.config["FRAGMENT_CACHE_PATH"] = os.path.join(self.instance_path, "fragments.db")
+        self.app.extensions.pop(EXTENSION_NAME, None)
+        client = self.app.test_client()
+        client.get(self.list_url)
+
+        get_fragment_cache().memory.clear()
+        client.get(self.list_url)
+
+        stats = get_fragment_cache_stats()
+        self.assertEqual(stats["renders"], 1)
+        self.assertEqual(stats["shared"]["hits"], 1)
+
+    def test_disabled(self):
+        """ With the cache disabled every fragment should be rendered """
+        self.app.config["FRAGMENT_CACHE_ENABLED"] = False
+        client = self.app.test_client()
+
+        client.get(self.list_url)
+        client.get(self.list_url)
+
+        self.assertEqual(get_fragment_cache_stats()["memory"]["entries"], 0)
@@ -0,0 +1,90 @@
+""" Test behavior of conditional GETs on movie pages """
+
+from unittest import mock
+
+from flask import url_for
+from movie_recs.db import (add_movie, get_db, get_user_by_username, get_version, set_user_movie,
+                           update_movie)
+
+from fixtures import AuthenticationTestFixture
+
+
+class HttpCacheTest(AuthenticationTestFixture):
+    """ Test behavior of conditional GETs on movie pages """
+
+    def setUp(self):
+        super().setUp()
+
+        add_movie({"Title": "Vertigo", "slug": "vertigo"})
+
+        with self.app.test_request_context():
+            self.list_url = url_for("movies.list_movies")
+            self.detail_url = url_for("movies.movie_details", slug="vertigo")
+
+    def test_unchanged_page_not_modified(self):
+        """ Repeating a request with the page's ETag should get a 304 without querying """
+        client = self.app.test_client()
+
+        for url in (self.list_url, self.detail_url):
+            with self.subTest(url=url):
+                etag = client.get(url).headers["ETag"]
+
+                with mock.patch("movie_recs.movies.get_movie_by_slug") as get_movie, \
+                        mock.patch("movie_recs.movies.get_movies_page") as get_page:
+                    response = client.get(url, headers={"If-None-Match": etag})
+
+                self.assertEqual(response.status_code, 304)
+                get_movie.assert_not_called()
+                get_page.assert_not_called()
+
+    def test_etag_changes_with_movies(self):
+        """ Writing a movie should change the pages' ETags """
+        client = self.app.test_client()
+        etags = [client.get(url).headers["ETag"] for url in (self.list_url, self.detail_url)]
+
+        update_movie("vertigo", {"Synopsis": "A detective falls for a woman."})
+
+        for url, etag in zip((self.list_url, self.detail_url), etags):
+            with self.subTest(url=url):
+                response = client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_other_processes_writes_seen_after_ttl(self):
+        """ A version written by another process should be read once the local copy is stale """
+        self.app.config["DB_VERSION_TTL"] = 0
+        version = get_version("movies")
+
+        get_db().meta.update_one({"_id": "movies"}, {"$set": {"version": "elsewhere"}})
+
+        self.assertNotEqual(get_version("movies"), version)
+
+    def test_anonymous_and_logged_in_variants(self):
+        """ Anonymous pages should be public, logged in pages private and distinct """
+        anonymous = self.app.test_client().get(self.detail_url)
+
+        client = self.app.test_client()
+        self.login(client=client)
+        logged_in = client.get(self.detail_url)
+
+        self.assertTrue(anonymous.cache_control.public)
+        self.assertIsNotNone(anonymous.cache_control.max_age)
+        self.assertTrue(logged_in.cache_control.private)
+        self.assertIn("Cookie", logged_in.vary)
+        self.assertNotEqual(anonymous.headers["ETag"], logged_in.headers["ETag"])
+
+        response = client.get(
+            self.detail_url, headers={"If-None-Match": anonymous.headers["ETag"]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_user_changes_invalidate_their_pages(self):
+        """ Recording a movie should change that user's ETags """
+        client = self.app.test_client()
+        self.login(client=client)
+        etag = client.get(self.detail_url).headers["ETag"]
+
+        user_id = get_user_by_username(self.default_username)["_id"]
+        set_user_movie(user_id, "vertigo", {"status": "watchlist"})
+
+        response = client.get(self.detail_url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,130 @@
+""" Test behavior of the bulk movie importer """
+import json
+import os
+from unittest.mock import patch
+
+import slugify
+from movie_recs.db import add_movie, get_db
+from movie_recs.importer import ImportProgress, load_checkpoint, read_references, save_checkpoint
+from movie_recs.omdb import lookup_params
+from movie_recs.titles import add_aliases, resolve_title
+
+from fixtures import AppTestFixture
+
+
+def get_dummy_movie_data(movie_title, refresh=False):  # pylint: disable=unused-argument
+    """ Return simplified movie data for a title or IMDb ID """
+    if movie_title.startswith("tt"):
+        return {"Title": f"Movie {movie_title}", "slug": f"movie-{movie_title}",
+                "imdbID": movie_title}
+
+    if movie_title == "Missing":
+        raise LookupError(f"Movie \"{movie_title}\" not found in OMDB.")
+
+    return {"Title": movie_title, "slug": slugify.slugify(movie_title)}
+
+
+@patch("movie_recs.cli.get_movie_data", new=get_dummy_movie_data)
+class ImporterTest(AppTestFixture):
+    """ Test behavior of the bulk movie importer """
+
+    def write(self, name, lines):
+        """ Write lines to a file in the instance folder and return its path """
+        path = os.path.join(self.instance_path, name)
+        with open(path, "w", encoding="utf-8") as import_file:
+            import_file.write("\n".join(lines) + "\n")
+        return path
+
+    def invoke(self, *args):
+        """ Run the import-movies command """
+        result = self.app.test_cli_runner().invoke(args=["import-movies", *args])
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result
+
+    def stored_slugs(self):
+        """ The slugs of every stored movie """
+        with self.app.app_context():
+            return sorted(movie["slug"] for movie in get_db().movies.find())
+
+    def test_read_references(self):
+        """ Every format should yield one reference per record """
+        self.assertEqual(
+            list(read_references(["Title,Year\n", "Ikiru,1952\n", ",1950\n"], "csv")),
+            ["Ikiru", None],
+        )
+        self.assertEqual(
+            list(read_references(['{"imdbID": "tt0052357"}\n', '"Ikiru"\n', "{\n"], "jsonl")),
+            ["tt0052357", "Ikiru", None],
+        )
+        self.assertEqual(list(read_references(["Ikiru\n", "\n"], "txt")), ["Ikiru", None])
+
+    def test_lookup_params(self):
+        """ IMDb IDs should be looked up by ID and anything else by title """
+        self.assertEqual(lookup_params("tt0052357"), {"i": "tt0052357"})
+        self.assertEqual(lookup_params("Ikiru"), {"t": "Ikiru"})
+        self.assertEqual(lookup_params("tt"), {"t": "tt"})
+
+    def test_import(self):
+        """ Titles and IMDb IDs should be added once each, reporting failures """
+        path = self.write("movies.txt", ["Ikiru", "tt0052357", "ikiru", "Missing", "Ikiru"])
+
+        result = self.invoke(path, "--chunk-size", "2")
+
+        self.assertEqual(self.stored_slugs(), ["ikiru", "movie-tt0052357"])
+        self.assertIn("added 2, skipped 2, 1 failed", result.output)
+        self.assertIn("Missing", result.output)
+        self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+
+        with self.app.app_context():
+            self.assertEqual(resolve_title("ikiru"), "ikiru")
+
+    def test_import_skips_stored_movies(self):
+        """ Movies already stored should be skipped without fetching them """
+        with self.app.app_context():
+            add_movie({"Title": "Rashômon", "slug": "rashomon", "imdbID": "tt0042876"})
+            add_aliases("rashomon", ["Rashômon"])
+
+        path = self.write("movies.jsonl", [
+            json.dumps({"title": "Rashomon"}), json.dumps({"imdbID": "tt0042876"}),
+        ])
+
+        with patch("movie_recs.cli.get_movie_data") as mock_get_movie_data:
+            result = self.invoke(path)
+
+        mock_get_movie_data.assert_not_called()
+        self.assertIn("added 0, skipped 2, 0 failed", result.output)
+
+    def test_import_async(self):
+        """ The asyncio client should import the same movies as the thread pool """
+        path = self.write("movies.txt", ["Ikiru", "tt0052357", "Missing"])
+
+        async def get_movie_data_async(movie_title, session, refresh=False):
+            return get_dummy_movie_data(movie_title, refresh)
+
+        with patch("movie_recs.omdb.get_movie_data_async", new=get_movie_data_async):
+            result = self.invoke(path, "--async")
+
+        self.assertEqual(self.stored_slugs(), ["ikiru", "movie-tt0052357"])
+        self.assertIn("added 2, skipped 0, 1 failed", result.output)
+
+    def test_import_resumes_from_checkpoint(self):
+        """ An import with a checkpoint should carry on after the records it had done """
+        path = self.write("movies.csv", ["imdb_id,title", ",Ikiru", ",Ran", ",Kagemusha"])
+        save_checkpoint(f"{path}.checkpoint", ImportProgress(2, 2, 0, 0))
+
+        result = self.invoke(path)
+
+        self.assertEqual(self.stored_slugs(), ["kagemusha"])
+        self.assertIn("Resuming after 2 records", result.output)
+        self.assertIn("Read 3 records", result.output)
+
+        self.invoke(path, "--restart")
+        self.assertEqual(self.stored_slugs(), ["ikiru", "kagemusha", "ran"])
+
+    def test_checkpoint_round_trip(self):
+        """ A saved checkpoint should load back unchanged """
+        path = os.path.join(self.instance_path, "import.checkpoint")
+
+        self.assertEqual(load_checkpoint(path), ImportProgress(0, 0, 0, 0))
+        save_checkpoint(path, ImportProgress(10, 7, 2, 1))
+        self.assertEqual(load_checkpoint(path), ImportProgress(10, 7, 2, 1))
@@ -0,0 +1,152 @@
+""" Test behavior of the job queue """
+
+import datetime
+
+import requests
+import responses
+from flask import url_for
+from movie_recs.db import get_db, get_movie_by_slug
+from movie_recs.jobs import (DONE, FAILED, PENDING, claim_job, enqueue_add_movie, enqueue_job,
+                             get_job, run_worker)
+from movie_recs.recommend import INDEX_MOVIES
+
+from fixtures import AuthenticationTestFixture
+
+
+class JobsTest(AuthenticationTestFixture):
+    """ Test behavior of the job queue """
+
+    def setUp(self):
+        super().setUp()
+
+        self.app.config["MOVIES_ADD_QUEUED"] = True
+
+        with self.app.test_request_context():
+            self.add_url = url_for("movies.add")
+
+    def test_add_returns_before_fetching(self):
+        """ Adding a movie should queue a job without contacting the OMDB """
+        client = self.app.test_client()
+        self.login(client=client)
+
+        response = client.post(self.add_url, data={"movie_title": self.test_movie_title})
+
+        self.assertEqual(len(responses.calls), 0)
+        self.assertIn("/movies/jobs/", response.location)
+        self.assertIn(b"This page will refresh", client.get(response.location).data)
+
+    def test_worker_adds_movie_and_job_page_redirects(self):
+        """ Once a worker has run the job, its page should lead to the movie """
+        client = self.app.test_client()
+        self.login(client=client)
+        job_url = client.post(self.add_url, data={"movie_title": self.test_movie_title}).location
+
+        # Adding the movie queues a second job to index it for recommendations
+        self.assertEqual(run_worker(burst=True), 2)
+
+        self.assertIsNotNone(get_movie_by_slug(self.expected_slug))
+        response = client.get(job_url)
+        self.assertTrue(response.location.endswith(f"/movie/{self.expected_slug}"))
+
+        job_id = job_url.rsplit("/", 1)[1]
+        data = client.get(f"/api/jobs/{job_id}").get_json()
+        self.assertEqual((data["status"], data["slug"]), (DONE, self.expected_slug))
+
+    def test_unclaimed_job_run_by_status_page(self):
+        """ A job no worker has claimed within the lease should be run by its status page """
+        client = self.app.test_client()
+        self.login(client=client)
+        job_url = client.post(self.add_url, data={"movie_title": self.test_movie_title}).location
+
+        self.assertIn(b"This page will refresh", client.get(job_url).data)
+
+        get_db().jobs.update_many({}, {"$set": {
+            "updated": datetime.datetime.utcnow() - datetime.timedelta(minutes=5)}})
+        response = client.get(job_url)
+
+        self.assertTrue(response.location.endswith(f"/movie/{self.expected_slug}"))
+        self.assertIsNotNone(get_movie_by_slug(self.expected_slug))
+
+    def test_job_without_title_polled(self):
+        """ A job that doesn't add a movie should still be reported by the api and its page """
+        client = self.app.test_client()
+        self.login(client=client)
+        job_id = str(enqueue_job(INDEX_MOVIES, slugs=[])["_id"])
+
+        response = client.get(f"/api/jobs/{job_id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["type"], INDEX_MOVIES)
+        self.assertIsNone(response.get_json()["title"])
+        self.assertIn(b"This job is waiting to run", client.get(f"/movies/jobs/{job_id}").data)
+
+        run_worker(burst=True)
+
+        self.assertEqual(client.get(f"/api/jobs/{job_id}").get_json()["status"], DONE)
+        response = client.get(f"/movies/jobs/{job_id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"This job has finished", response.data)
+
+    def test_duplicate_requests_share_a_job(self):
+        """ Requesting the same movie twice should only queue one job """
+        first = enqueue_add_movie(self.test_movie_title)
+        second = enqueue_add_movie(self.test_movie_title.upper())
+
+        self.assertEqual(first["_id"], second["_id"])
+        self.assertEqual(get_db().jobs.count_documents({}), 1)
+
+    def test_missing_movie_fails(self):
+        """ A movie the OMDB doesn't have should fail the job without retrying """
+        job = enqueue_add_movie("My Home Movie 1998")
+
+        run_worker(burst=True)
+
+        job = get_job(str(job["_id"]))
+        self.assertEqual(job["status"], FAILED)
+        self.assertIn("was not found in the OMDB", job["error"])
+        self.assertEqual(job["attempts"], 1)
+
+    def test_unreachable_omdb_retried_with_backoff(self):
+        """ A job that couldn't reach the OMDB should be retried later, then given up on """
+        self.app.config.update(JOBS_MAX_ATTEMPTS=2, JOBS_RETRY_DELAY=60)
+        responses.replace(responses.GET, "http://www.omdbapi.com", body=requests.ConnectionError())
+        job = enqueue_add_movie(self.test_movie_title)
+
+        run_worker(burst=True)
+        job = get_job(str(job["_id"]))
+        self.assertEqual(job["status"], PENDING)
+        self.assertGreater(job["run_after"], datetime.datetime.utcnow())
+        self.assertIsNone(claim_job("test"), "Should wait for its backoff")
+
+        get_db().jobs.update_one({"_id": job["_id"]}, {"$set": {"run_after": job["created"]}})
+        run_worker(burst=True)
+        self.assertEqual(get_job(str(job["_id"]))["status"], FAILED)
+
+    def test_expired_lease_reclaimed(self):
+        """ A job whose worker died should be claimed again once its lease runs out """
+        enqueue_add_movie(self.test_movie_title)
+        job = claim_job("dead-worker")
+        self.assertIsNone(claim_job("other-worker"))
+
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        get_db().jobs.update_one({"_id": job["_id"]}, {"$set": {"locked_until": expired}})
+
+        self.assertEqual(claim_job("other-worker")["_id"], job["_id"])
+
+    def test_finished_job_requeued(self):
+        """ Requesting a movie whose job already finished should run it again """
+        job = enqueue_add_movie("My Home Movie 1998")
+        run_worker(burst=True)
+
+        job = enqueue_add_movie("My Home Movie 1998")
+
+        self.assertEqual(job["status"], PENDING)
+        self.assertEqual(job["attempts"], 0)
+
+    def test_worker_command(self):
+        """ The jobs-worker command should run queued jobs """
+        enqueue_add_movie(self.test_movie_title)
+
+        result = self.app.test_cli_runner().invoke(args=["jobs-worker", "--burst"])
+
+        self.assertIn("Ran 2 jobs", result.output)
+        self.assertEqual(get_db().jobs.find_one()["status"], DONE)
@@ -0,0 +1,182 @@
+""" Test behavior of request timing and the metrics endpoint """
+import contextlib
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import mongomock
+from flask import url_for
+from movie_recs import create_app
+from movie_recs.metrics import CommandTimer, Histogram, get_metrics
+
+from fixtures import TEST_MONGO_HOST, AuthenticationTestFixture
+
+
+def server_timing(response) -> dict:
+    """ The durations in a response's Server-Timing header, by name """
+    timings = {}
+    for entry in response.headers.get("Server-Timing", "").split(","):
+        name, _, duration = entry.strip().partition(";dur=")
+        if name:
+            timings[name] = float(duration)
+    return timings
+
+
+UNTRUSTED = {"REMOTE_ADDR": "203.0.113.5"}
+
+
+class MetricsTest(AuthenticationTestFixture):
+    """ Test behavior of request timing and the metrics endpoint """
+
+    def setUp(self):
+        super().setUp()
+
+        self.app.config["METRICS_SERVER_TIMING"] = True
+
+    def test_server_timing_header(self):
+        """ Responses should report their total time and the time spent rendering """
+        client = self.app.test_client()
+
+        with self.app.test_request_context():
+            response = client.get(url_for("auth.login"))
+
+        timings = server_timing(response)
+        self.assertIn("total", timings)
+        self.assertIn("render", timings)
+        self.assertLessEqual(timings["render"], timings["total"])
+
+    def test_server_timing_only_for_trusted_clients(self):
+        """ Untrusted clients and publicly cacheable pages shouldn't get the header """
+        client = self.app.test_client()
+
+        self.assertNotIn("Server-Timing", client.get("/auth/login", environ_base=UNTRUSTED).headers)
+
+        response = client.get("/")
+        self.assertTrue(response.cache_control.public)
+        self.assertNotIn("Server-Timing", response.headers)
+
+    def test_login_times_hashing(self):
+        """ Checking a password should count as hashing """
+        self.assertIn("hashing", server_timing(self.login()))
+
+    def test_add_times_omdb(self):
+        """ Adding a movie without queueing should count the OMDB request """
+        self.app.config["MOVIES_ADD_QUEUED"] = False
+        client = self.app.test_client()
+        self.login(client=client)
+
+        with self.app.test_request_context():
+            add_url = url_for("movies.add")
+
+        response = self.post(add_url, {"movie_title": self.test_movie_title}, client=client)
+
+        self.assertIn("omdb", server_timing(response))
+
+    def test_metrics_endpoint(self):
+        """ /metrics should expose request histograms and the clients' counters """
+        client = self.app.test_client()
+        self.login(client=client)
+
+        response = client.get("/metrics")
+        text = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        self.assertIn(
+            'movie_recs_request_duration_seconds_count{endpoint="auth.login",method="POST",'
+            'status="302"} 1', text)
+        self.assertIn(
+            'movie_recs_request_phase_seconds_count{endpoint="auth.login",phase="hashing"} 1',
+            text)
+        self.assertIn("movie_recs_mongo_pool_checkouts", text)
+        self.assertIn("movie_recs_omdb_client_requests", text)
+
+    def test_metrics_restricted_to_trusted_clients(self):
+        """ /metrics should only answer allowed addresses or requests with the token """
+        client = self.app.test_client()
+        self.app.config["METRICS_TOKEN"] = "scrape-token"
+
+        self.assertEqual(client.get("/metrics", environ_base=UNTRUSTED).status_code, 403)
+        self.assertEqual(client.get(
+            "/metrics", environ_base=UNTRUSTED, headers={"Authorization": "Bearer wrong"},
+        ).status_code, 403)
+        self.assertEqual(client.get(
+            "/metrics", environ_base=UNTRUSTED, headers={"Authorization": "Bearer scrape-token"},
+        ).status_code, 200)
+
+        self.app.config["METRICS_ALLOWED_NETWORKS"] = ["203.0.113.0/24"]
+        self.assertEqual(client.get("/metrics", environ_base=UNTRUSTED).status_code, 200)
+        self.assertEqual(client.get("/metrics").status_code, 403)
+
+    def test_streamed_render_timed(self):
+        """ Streaming a page should count towards rendering once the stream is read """
+        client = self.app.test_client()
+        client.get("/").get_data()
+
+        text = client.get("/metrics").get_data(as_text=True)
+        render_sum = next(
+            line for line in text.splitlines()
+            if line.startswith('movie_recs_request_phase_seconds_sum{endpoint="movies.list_movies"'
+                               ',phase="render"}'))
+
+        self.assertGreater(float(render_sum.split()[-1]), 0)
+
+    def test_mongo_commands_timed(self):
+        """ Commands reported by pymongo should be observed by command name """
+        timer = CommandTimer(get_metrics(self.app))
+        timer.succeeded(SimpleNamespace(command_name="find", duration_micros=1500))
+
+        text = self.app.test_client().get("/metrics").get_data(as_text=True)
+
+        self.assertIn(
+            'movie_recs_mongo_command_duration_seconds_bucket{command="find",le="0.001"} 0', text)
+        self.assertIn(
+            'movie_recs_mongo_command_duration_seconds_bucket{command="find",le="0.0025"} 1', text)
+
+
+class HistogramTest(unittest.TestCase):
+    """ Test behavior of histogram buckets """
+
+    def test_buckets_are_cumulative(self):
+        """ Each bucket should count every value up to its bound """
+        histogram = Histogram("latency", "Latency", ("route",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(("index",), value)
+
+        lines = histogram.expose()
+
+        self.assertIn('latency_bucket{route="index",le="0.1"} 2', lines)
+        self.assertIn('latency_bucket{route="index",le="1.0"} 3', lines)
+        self.assertIn('latency_bucket{route="index",le="+Inf"} 4', lines)
+        self.assertIn('latency_count{route="index"} 4', lines)
+
+
+class MetricsDisabledTest(unittest.TestCase):
+    """ Test behavior with metrics turned off """
+
+    def make_client(self, **config):
+        """ Helper function to get a test client for an app with config """
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(mongomock.patch(servers=TEST_MONGO_HOST))
+        app = create_app({
+            "TESTING": True,
+            "DB_HOST": TEST_MONGO_HOST,
+            **config,
+        }, instance_path=stack.enter_context(tempfile.TemporaryDirectory()))
+
+        return app.test_client()
+
+    def test_no_timing_or_endpoint(self):
+        """ No header should be added and /metrics shouldn't exist """
+        client = self.make_client(METRICS_ENABLED=False)
+
+        self.assertNotIn("Server-Timing", client.get("/auth/login").headers)
+        self.assertEqual(client.get("/metrics").status_code, 404)
+
+    def test_server_timing_off_by_default(self):
+        """ Responses shouldn't report their timings unless that's turned on """
+        client = self.make_client()
+
+        self.assertNotIn("Server-Timing", client.get("/auth/login").headers)
+        self.assertEqual(client.get("/metrics").status_code, 200)
@@ -2,7 +2,9 @@
 
 import html
 
+import httpx
 from flask import url_for
+from movie_recs.db import add_movies, get_movies_page
 
 from fixtures import AuthenticationTestFixture
 
@@ -13,9 +15,82 @@ class MoviesTest(AuthenticationTestFixture):
     def setUp(self):
         super().setUp()
 
+        # Add movies within the request; the queued path is tested in jobs_test
+        self.app.config["MOVIES_ADD_QUEUED"] = False
+
         with self.app.test_request_context():
             self.add_url = url_for("movies.add")
 
+    def add_numbered_movies(self, count: int):
+        """ Helper function to add movies titled "Movie 0", "Movie 1", ... """
+        add_movies([
+            {
+                "Title": f"Movie {i}",
+                "slug": f"movie-{i}",
+                "Synopsis": "Short plot",
+                "Plot": "Full plot",
+            }
+            for i in range(count)
+        ])
+
+    def test_movies_page_projects_list_fields(self):
+        """ Test that listing movies only loads the fields the list needs """
+        self.add_numbered_movies(1)
+
+        movie = get_movies_page().movies[0]
+
+        self.assertEqual(movie["Title"], "Movie 0")
+        self.assertNotIn("Plot", movie)
+
+    def test_movies_pages_are_stable(self):
+        """ Test that paging forwards and back visits each movie once in order """
+        self.add_numbered_movies(5)
+
+        first_page = get_movies_page(limit=2)
+        second_page = get_movies_page(after=first_page.next_cursor, limit=2)
+        add_movies([{"Title": "Late Movie", "slug": "late-movie"}])
+        last_page = get_movies_page(after=second_page.next_cursor, limit=2)
+        back_page = get_movies_page(before=last_page.prev_cursor, limit=2)
+
+        def titles(page):
+            return [movie["Title"] for movie in page.movies]
+
+        self.assertEqual(titles(first_page), ["Movie 0", "Movie 1"])
+        self.assertEqual(titles(second_page), ["Movie 2", "Movie 3"])
+        self.assertEqual(titles(last_page), ["Movie 4", "Late Movie"])
+        self.assertEqual(titles(back_page), titles(second_page))
+        self.assertIsNone(first_page.prev_cursor)
+        self.assertIsNone(last_page.next_cursor)
+
+    def test_list_movies_links_to_next_page(self):
+        """ Test that the movie list is limited to a page and links to the next one """
+        self.add_numbered_movies(3)
+
+        response = self.app.test_client().get("/?limit=2")
+        page = get_movies_page(limit=2)
+
+        self.assertIn(b"Movie 1", response.data)
+        self.assertNotIn(b"Movie 2", response.data)
+        self.assertIn(f"after={page.next_cursor}".encode(), response.data)
+
+    def test_streamed_list_matches_rendered_list(self):
+        """ Test that streaming the movie list gives the same page as rendering it """
+        self.add_numbered_movies(3)
+        client = self.app.test_client()
+
+        rendered = client.get("/?limit=2")
+        self.app.config.from_mapping(MOVIES_STREAM_LIST=True)
+        streamed = client.get("/?limit=2")
+
+        self.assertTrue(streamed.is_streamed)
+        self.assertEqual(streamed.get_data(as_text=True), rendered.get_data(as_text=True))
+
+    def test_list_movies_rejects_bad_cursor(self):
+        """ Test that a malformed page cursor is a bad request """
+        response = self.app.test_client().get("/?after=not-a-cursor")
+
+        self.assertEqual(response.status_code, 400)
+
     def test_add_movie_is_reachable(self):
         """ Test that the add movie page can be reached """
 
@@ -57,6 +132,19 @@ class MoviesTest(AuthenticationTestFixture):
         response_data = html.unescape(response.get_data(as_text=True))
         self.assertIn(expected_message, response_data)
 
+    def test_add_movie_omdb_unreachable(self):
+        """ Test that an OMDB timeout gives a message instead of an error page """
+
+        client = self.app.test_client()
+        self.login(client=client)
+
+        self.async_omdb_error = httpx.ReadTimeout("timed out")
+
+        response = client.post(self.add_url, data={"movie_title": self.test_movie_title})
+
+        self.assertNotIn("Location", response.headers, "Implies redirection")
+        self.assertIn(b"The OMDB could not be reached", response.data)
+
     def test_add_movie_already_added(self):
         """ Test that adding a movie that's already added gives a message """
 
@@ -1,8 +1,13 @@
 """ Test the interface to the Open Movie Database """
+import asyncio
 from typing import NamedTuple, Optional
+from unittest.mock import patch
 
+import httpx
+import requests
 import responses
 from movie_recs import omdb
+from movie_recs.db import add_movie, get_movie_by_slug
 
 from fixtures import AppContextTestFixture
 
@@ -24,6 +29,7 @@ class TestOmdbInterface(AppContextTestFixture):
 
     def test_get_movie_data_contains_synopsis(self):
         """ Test that the returned movie data includes the synopsis """
+        self.app.config.from_mapping(OMDB_SYNOPSIS_MODE="fetch")
         movie_data = omdb.get_movie_data(self.test_movie_title)
 
         synopsis_data = {"Synopsis": self.short_plot}
@@ -33,9 +39,38 @@ class TestOmdbInterface(AppContextTestFixture):
         """ Test that the returned movie data includes the plot """
         movie_data = omdb.get_movie_data(self.test_movie_title)
 
-        plot_data = {"Synopsis": self.short_plot}
+        plot_data = {"Plot": self.full_plot}
         self.assert_dict_contains_dict(movie_data, plot_data)
 
+    def test_derived_synopsis_needs_one_request(self):
+        """ Test that deriving the synopsis only makes a single OMDB request """
+        self.app.config.from_mapping(OMDB_SYNOPSIS_MODE="derive")
+        movie_data = omdb.get_movie_data(self.test_movie_title)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(responses.calls[0].request.params["plot"], "full")
+        self.assert_dict_contains_dict(
+            movie_data, {"Plot": self.full_plot, "Synopsis": self.full_plot})
+
+    def test_derive_synopsis(self):
+        """ Test that a derived synopsis is the plot's first sentence, shortened if needed """
+        plot = "A hacker learns the truth. He joins a rebellion against the machines."
+        self.assertEqual(omdb.derive_synopsis(plot, 200), "A hacker learns the truth.")
+        self.assertEqual(omdb.derive_synopsis(plot, 20), "A hacker learns the...")
+
+    def test_deferred_synopsis_replaced_with_short_plot(self):
+        """ Test that deferred mode later stores the OMDB's short plot as the synopsis """
+        self.app.config.from_mapping(OMDB_SYNOPSIS_MODE="deferred")
+        movie_data = omdb.get_movie_data(self.test_movie_title)
+        self.assertEqual(movie_data["Synopsis"], self.full_plot)
+
+        add_movie(movie_data)
+        omdb.defer_synopsis(movie_data).result()
+
+        stored_movie = get_movie_by_slug(self.expected_slug)
+        self.assertEqual(stored_movie["Synopsis"], self.short_plot)
+        self.assertEqual(omdb.get_movie_data(self.test_movie_title)["Synopsis"], self.short_plot)
+
     def test_get_movie_data_contains_slug(self):
         """ Test that the returned movie data includes the expected slug """
         movie_data = omdb.get_movie_data(self.test_movie_title)
@@ -86,3 +121,153 @@ class TestOmdbInterface(AppContextTestFixture):
                     omdb.get_movie_data(self.test_movie_title)
 
                 self.assertIn("An unknown error occurred", str(e.exception))
+
+    def test_get_movie_data_cached(self):
+        """ Test that looking up a movie a second time doesn't call the OMDB """
+        omdb.get_movie_data(self.test_movie_title)
+        calls_after_first_lookup = len(responses.calls)
+
+        movie_data = omdb.get_movie_data(self.test_movie_title.upper())
+
+        self.assertEqual(len(responses.calls), calls_after_first_lookup)
+        self.assertEqual(movie_data["slug"], self.expected_slug)
+        self.assertEqual(omdb.get_cache_stats()["hits"], 1)
+
+    def test_refresh_bypasses_cache(self):
+        """ Test that a refresh calls the OMDB and replaces the cached movie """
+        omdb.get_movie_data(self.test_movie_title)
+        cache = omdb.get_cache()
+        key = omdb.normalize_title(self.test_movie_title)
+        cache.set(key, {**cache.get(key), "Plot": "Old plot"})
+        calls_before = len(responses.calls)
+
+        movie_data = omdb.get_movie_data(self.test_movie_title, refresh=True)
+
+        self.assertEqual(len(responses.calls), calls_before + 1)
+        self.assertNotEqual(movie_data["Plot"], "Old plot")
+        self.assertEqual(omdb.get_movie_data(self.test_movie_title)["Plot"], movie_data["Plot"])
+
+    def test_cache_only_mode(self):
+        """ Test that cache-only mode serves cached movies and never calls the OMDB """
+        omdb.get_movie_data(self.test_movie_title)
+        self.app.config.from_mapping(OMDB_CACHE_ONLY=True)
+        calls_before = len(responses.calls)
+
+        movie_data = omdb.get_movie_data(self.test_movie_title)
+        self.assertEqual(movie_data["slug"], self.expected_slug)
+
+        with self.assertRaises(LookupError):
+            omdb.get_movie_data("My Home Movie 1998")
+
+        self.assertEqual(len(responses.calls), calls_before)
+
+    def test_session_reused(self):
+        """ Test that every request in the process shares one keep-alive session """
+        self.assertIs(omdb.get_session(), omdb.get_session())
+
+    def test_session_retry_policy_from_config(self):
+        """ Test that pool size and retries are taken from the app config """
+        self.app.config.from_mapping(OMDB_POOL_SIZE=3, OMDB_RETRIES=5)
+        self.app.extensions.pop(omdb.SESSION_EXTENSION_NAME, None)
+
+        adapter = omdb.get_session().get_adapter(self.app.config["OMDB_URL"])
+
+        self.assertEqual(adapter._pool_maxsize, 3)  # pylint: disable=protected-access
+        self.assertEqual(adapter.max_retries.total, 5)
+        self.assertIn(429, adapter.max_retries.status_forcelist)
+
+    def test_client_stats_recorded(self):
+        """ Test that requests, errors and timeouts are counted """
+        omdb.get_movie_data(self.test_movie_title)
+
+        responses.replace(
+            responses.GET,
+            "http://www.omdbapi.com",
+            body=requests.ConnectTimeout(),
+        )
+        with self.assertRaises(requests.Timeout):
+            omdb.get_movie_data("Vertigo")
+
+        stats = omdb.get_client_stats()
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+
+    def test_async_client_matches_blocking_client(self):
+        """ Test that the asyncio client returns the same data as the blocking one """
+        self.app.config.from_mapping(OMDB_CACHE_ENABLED=False)
+
+        movie_data = asyncio.run(omdb.get_movie_data_async(self.test_movie_title))
+
+        self.assertEqual(movie_data, omdb.get_movie_data(self.test_movie_title))
+        self.assertEqual(len(self.async_omdb_calls), 1)
+
+    def test_async_client_fetches_plots_concurrently(self):
+        """ Test that in fetch mode the async client has both plots' requests in flight at once """
+        self.app.config.from_mapping(OMDB_SYNOPSIS_MODE="fetch")
+        in_flight = []
+
+        async def respond(request: httpx.Request) -> httpx.Response:
+            in_flight.append(request.url.params["plot"])
+            await asyncio.sleep(0.01)
+            plot = self.short_plot if request.url.params["plot"] == "short" else self.full_plot
+            return httpx.Response(
+                200, json={"Response": "True", "Title": self.test_movie_title, "Plot": plot})
+
+        with patch("movie_recs.omdb._async_transport",
+                   new=lambda config: httpx.MockTransport(respond)):
+            async def fetch():
+                task = asyncio.ensure_future(omdb.get_movie_data_async(self.test_movie_title))
+                await asyncio.sleep(0.005)
+                started = list(in_flight)
+                return started, await task
+
+            started, movie_data = asyncio.run(fetch())
+
+        self.assertCountEqual(started, ["full", "short"])
+        self.assert_dict_contains_dict(
+            movie_data, {"Plot": self.full_plot, "Synopsis": self.short_plot})
+
+    def test_async_client_missing_movie(self):
+        """ Test that the async client raises LookupError for a missing movie """
+        with self.assertRaises(LookupError):
+            asyncio.run(omdb.get_movie_data_async("My Home Movie 1998"))
+
+    def test_async_client_retries_unavailable(self):
+        """ Test that the async client retries a retryable status and counts the retry """
+        self.app.config.from_mapping(OMDB_BACKOFF_FACTOR=0)
+        statuses = [503]
+
+        def respond(request: httpx.Request) -> httpx.Response:
+            if statuses:
+                return httpx.Response(statuses.pop())
+            return httpx.Response(200, json={
+                "Response": "True", "Title": request.url.params["t"], "Plot": self.full_plot})
+
+        with patch("movie_recs.omdb._async_transport",
+                   new=lambda config: httpx.MockTransport(respond)):
+            movie_data = asyncio.run(omdb.get_movie_data_async(self.test_movie_title))
+
+        self.assertEqual(movie_data["Plot"], self.full_plot)
+        self.assertEqual(omdb.get_client_stats()["retries"], 1)
+
+    def test_async_client_timeout(self):
+        """ Test that an async timeout is raised and counted """
+        self.async_omdb_error = httpx.ConnectTimeout("timed out")
+
+        with self.assertRaises(httpx.TimeoutException):
+            asyncio.run(omdb.get_movie_data_async(self.test_movie_title))
+
+        self.assertEqual(omdb.get_client_stats()["timeouts"], 1)
+
+    def test_iter_movie_data(self):
+        """ Test that many titles are fetched with each result or error reported """
+        titles = [self.test_movie_title, "My Home Movie 1998"] * 3
+
+        results = list(omdb.iterate_sync(omdb.iter_movie_data(titles, 2)))
+
+        self.assertEqual(len(results), len(titles))
+        found = [title for title, movie_data, error in results if error is None]
+        missing = [error for title, movie_data, error in results if movie_data is None]
+        self.assertEqual(found, [self.test_movie_title] * 3)
+        self.assertTrue(all(isinstance(error, LookupError) for error in missing))
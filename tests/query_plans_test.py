@@ -0,0 +1,124 @@
+""" Test behavior of the index registry and query plan checks """
+import os
+import tempfile
+import unittest
+
+import pymongo
+from movie_recs import create_app
+from movie_recs.db import INDEXES, get_db, init_collections
+from movie_recs.query_plans import QueryPlan, check_query_plans, plan_problems
+
+from fixtures import AppContextTestFixture
+
+MONGO_TEST_HOST = os.environ.get("MONGO_TEST_HOST", "localhost")
+MONGO_TEST_USER = os.environ.get("MONGO_TEST_USER", "root")
+MONGO_TEST_PASSWORD = os.environ.get("MONGO_TEST_PASSWORD", "example")
+
+
+def explanation(plan: dict) -> dict:
+    """ Wrap a winning plan the way explain() returns it """
+    return {"queryPlanner": {"winningPlan": plan}}
+
+
+class IndexRegistryTest(AppContextTestFixture):
+    """ Test behavior of the index registry """
+
+    def test_every_index_created_once(self):
+        """ init_collections should create the registry's indexes and then nothing """
+        database = get_db()
+
+        for spec in INDEXES:
+            with self.subTest(collection=spec.collection, keys=spec.keys):
+                existing = [
+                    [tuple(key) for key in info["key"]]
+                    for info in database[spec.collection].index_information().values()
+                ]
+                self.assertIn(spec.keys, existing)
+
+        self.assertEqual(init_collections(), [])
+
+    def test_expiring_index_created(self):
+        """ Finished jobs should be removed by a TTL index on their expiry date """
+        info = get_db().jobs.index_information()["expires_at_1"]
+
+        self.assertEqual(info["expireAfterSeconds"], 0)
+
+    def test_conflicting_index_left_alone(self):
+        """ An index whose keys exist with other options should be logged, not rebuilt """
+        database = get_db()
+        database.drop_collection("aliases")
+        database.aliases.create_index("key")
+
+        with self.assertLogs(self.app.logger, level="WARNING"):
+            init_collections()
+
+        self.assertNotIn("unique", database.aliases.index_information()["key_1"])
+
+
+class PlanProblemsTest(unittest.TestCase):
+    """ Test behavior of reading explained plans """
+
+    def test_index_scan_passes(self):
+        """ A plan that fetches from an index scan should pass an uncovered query """
+        query = QueryPlan("by slug", "movies", {"slug": "vertigo"})
+        plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+
+        self.assertEqual(plan_problems(query, explanation(plan)), [])
+
+    def test_collection_scan_fails(self):
+        """ A plan that scans the collection should be reported """
+        query = QueryPlan("by title", "movies", {"Title": "Vertigo"})
+        problems = plan_problems(query, explanation({"stage": "COLLSCAN"}))
+
+        self.assertEqual([problem.problem for problem in problems],
+                         ["scans the whole collection"])
+
+    def test_uncovered_and_sorted_plans_fail(self):
+        """ Covered queries shouldn't fetch and sorted queries shouldn't sort in memory """
+        query = QueryPlan("alias", "aliases", {"key": "vertigo"}, {"_id": 0, "slug": 1},
+                          sort=[("slug", 1)], covered=True)
+        plan = {"queryPlan": {"stage": "SORT", "inputStage": {
+            "stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+
+        problems = plan_problems(query, explanation(plan))
+
+        self.assertEqual([problem.problem for problem in problems],
+                         ["sorts in memory", "isn't covered by an index"])
+        self.assertEqual(problems[0].stages, ["SORT", "FETCH", "IXSCAN"])
+
+
+class QueryPlansTest(unittest.TestCase):
+    """ Explain every query against a real mongod, which mongomock can't do """
+
+    @classmethod
+    def setUpClass(cls):
+        client = pymongo.MongoClient(
+            MONGO_TEST_HOST, username=MONGO_TEST_USER, password=MONGO_TEST_PASSWORD,
+            serverSelectionTimeoutMS=500)
+        try:
+            client.admin.command("ping")
+        except pymongo.errors.PyMongoError as error:
+            raise unittest.SkipTest(f"No mongod at {MONGO_TEST_HOST}: {error}")
+        finally:
+            client.close()
+
+    def setUp(self):
+        instance_path = tempfile.TemporaryDirectory()
+        self.addCleanup(instance_path.cleanup)
+
+        self.app = create_app({
+            "TESTING": True,
+            "DB_HOST": MONGO_TEST_HOST,
+            "DB_USER": MONGO_TEST_USER,
+            "DB_PASSWORD": MONGO_TEST_PASSWORD,
+            "DB_NAME": "movie_recs_query_plans_test",
+        }, instance_path=instance_path.name)
+
+    def tearDown(self):
+        with self.app.app_context():
+            get_db().client.drop_database("movie_recs_query_plans_test")
+
+    def test_queries_use_indexes(self):
+        """ No query should scan a collection, sort in memory or miss a covering index """
+        with self.app.app_context():
+            self.assertEqual(check_query_plans(), [])
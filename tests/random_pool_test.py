@@ -0,0 +1,96 @@
+""" Test behavior of random movie picks """
+from unittest.mock import patch
+
+import responses
+from flask import url_for
+from movie_recs.db import LISTENERS_EXTENSION_NAME, add_movie, add_movies, get_db
+from movie_recs.random_pool import EXTENSION_NAME, get_random_pool, pick_random_movie
+
+from fixtures import AppContextTestFixture
+
+MOVIES = [
+    {"Title": "Vertigo", "slug": "vertigo", "Year": "1958", "Genre": "Mystery, Thriller"},
+    {"Title": "Rear Window", "slug": "rear-window", "Year": "1954", "Genre": "Mystery"},
+    {"Title": "Ikiru", "slug": "ikiru", "Year": "1952", "Genre": "Drama"},
+]
+
+
+class RandomPoolTest(AppContextTestFixture):
+    """ Test behavior of random movie picks """
+
+    def setUp(self):
+        super().setUp()
+
+        add_movies([dict(movie) for movie in MOVIES])
+
+    def test_pick_with_filters(self):
+        """ Picks should only come from movies matching the genre and year """
+        for _ in range(20):
+            self.assertIn(pick_random_movie(), ("vertigo", "rear-window", "ikiru"))
+            self.assertIn(pick_random_movie(genre="mystery"), ("vertigo", "rear-window"))
+            self.assertEqual(pick_random_movie(genre="Mystery", year=1954), "rear-window")
+            self.assertEqual(pick_random_movie(year=1952), "ikiru")
+
+        self.assertIsNone(pick_random_movie(genre="western"))
+        self.assertIsNone(pick_random_movie(genre="drama", year=1958))
+
+    def test_picks_served_from_pool(self):
+        """ Once sampled, picks shouldn't read the database """
+        get_random_pool()
+
+        with patch("movie_recs.random_pool.get_db") as mock_get_db:
+            for _ in range(10):
+                pick_random_movie(genre="mystery")
+
+        mock_get_db.assert_not_called()
+
+    def test_added_movie_joins_pool(self):
+        """ A movie added after sampling should be pickable without resampling """
+        pool = get_random_pool()
+        add_movie({"Title": "Ran", "slug": "ran", "Year": "1985", "Genre": "Action, Drama"})
+
+        self.assertIs(get_random_pool(), pool)
+        self.assertEqual(pick_random_movie(genre="action"), "ran")
+
+    def test_partial_pool_falls_back_to_database(self):
+        """ A filter missing from a pool that doesn't hold every movie should query the db """
+        self.app.config["RANDOM_POOL_SIZE"] = 1
+        self.app.extensions.pop(EXTENSION_NAME, None)
+
+        pool = get_random_pool()
+
+        missing = next(movie for movie in get_db().movies.find() if movie["slug"] not in pool.slugs)
+        self.assertEqual(pick_random_movie(year=missing["year"]), missing["slug"])
+
+    def test_movie_written_elsewhere_found(self):
+        """ A movie the pool never saw should still be picked, whatever its genre's case """
+        get_random_pool()
+        listeners = self.app.extensions.pop(LISTENERS_EXTENSION_NAME)
+        add_movie({"Title": "Ran", "slug": "ran", "Year": "1985", "Genre": "WAR"})
+        self.app.extensions[LISTENERS_EXTENSION_NAME] = listeners
+
+        self.assertEqual(pick_random_movie(genre="war"), "ran")
+        self.assertEqual(pick_random_movie(genre="War", year=1985), "ran")
+
+    def test_random_view_redirects(self):
+        """ The random view should redirect to a movie without contacting the OMDB """
+        client = self.app.test_client()
+
+        with self.app.test_request_context():
+            url = url_for("movies.random_movie", genre="drama")
+            expected = url_for("movies.movie_details", slug="ikiru")
+
+        response = client.get(url)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(expected))
+        self.assertTrue(response.cache_control.no_store)
+        self.assertEqual(len(responses.calls), 0)
+
+    def test_random_view_without_matches(self):
+        """ Filters matching nothing should send the user back to the list """
+        client = self.app.test_client()
+
+        response = client.get("/movies/random?genre=western", follow_redirects=True)
+
+        self.assertIn(b"No movies match those filters.", response.data)
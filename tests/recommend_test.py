@@ -0,0 +1,216 @@
+""" Test behavior of the recommendation engine """
+import fcntl
+import os
+import threading
+
+import numpy as np
+import scipy.sparse
+from flask import url_for
+from movie_recs.db import add_movie, add_movies, get_db
+from movie_recs.jobs import DONE, PENDING, run_worker
+from movie_recs.recommend import (
+    EXTENSION_NAME, INDEX_FILE, INDEX_MOVIES, LOCK_FILE, build_index, get_index,
+    get_similar_movies,
+)
+
+from fixtures import AppContextTestFixture
+
+MOVIES = [
+    {
+        "Title": "Vertigo", "slug": "vertigo", "Genre": "Mystery, Romance, Thriller",
+        "Director": "Alfred Hitchcock", "Actors": "James Stewart, Kim Novak",
+        "Year": "1958", "Runtime": "128 min",
+        "Plot": "A retired detective with a fear of heights is hired to follow a woman.",
+    },
+    {
+        "Title": "Rear Window", "slug": "rear-window", "Genre": "Mystery, Thriller",
+        "Director": "Alfred Hitchcock", "Actors": "James Stewart, Grace Kelly",
+        "Year": "1954", "Runtime": "112 min",
+        "Plot": "A photographer with a broken leg spies on his neighbors and suspects murder.",
+    },
+    {
+        "Title": "Singin' in the Rain", "slug": "singin-in-the-rain",
+        "Genre": "Comedy, Musical, Romance",
+        "Director": "Stanley Donen, Gene Kelly", "Actors": "Gene Kelly, Donald O'Connor",
+        "Year": "1952", "Runtime": "103 min",
+        "Plot": "A silent film star falls for a chorus girl as Hollywood moves to talkies.",
+    },
+    {
+        "Title": "An American in Paris", "slug": "an-american-in-paris",
+        "Genre": "Drama, Musical, Romance",
+        "Director": "Vincente Minnelli", "Actors": "Gene Kelly, Leslie Caron",
+        "Year": "1951", "Runtime": "114 min",
+        "Plot": "An American painter in Paris falls for a girl while singing and dancing.",
+    },
+]
+
+NEW_MOVIE = {
+    "Title": "North by Northwest", "slug": "north-by-northwest",
+    "Genre": "Adventure, Mystery, Thriller",
+    "Director": "Alfred Hitchcock", "Actors": "Cary Grant, James Stewart",
+    "Year": "1959", "Runtime": "136 min",
+    "Plot": "A man is mistaken for a spy and chased across the country with a woman.",
+}
+
+
+class RecommendTest(AppContextTestFixture):
+    """ Test behavior of the recommendation engine """
+
+    def setUp(self):
+        super().setUp()
+
+        add_movies([dict(movie) for movie in MOVIES])
+        build_index()
+
+    def similar_slugs(self, slug):
+        """ Helper function to get the slugs of the movies similar to slug """
+        return [movie["slug"] for movie in get_similar_movies(slug)]
+
+    def test_similar_movies_ranked_by_features(self):
+        """ Movies sharing a director, actors and genres should rank first """
+        self.assertEqual(self.similar_slugs("vertigo")[0], "rear-window")
+        self.assertEqual(self.similar_slugs("singin-in-the-rain")[0], "an-american-in-paris")
+
+    def test_movie_not_similar_to_itself(self):
+        """ A movie should never be recommended for itself """
+        for movie in MOVIES:
+            with self.subTest(slug=movie["slug"]):
+                self.assertNotIn(movie["slug"], self.similar_slugs(movie["slug"]))
+
+    def test_added_movie_indexed_by_a_job(self):
+        """ With a worker, adding a movie should queue its indexing rather than do it inline """
+        self.app.config["MOVIES_ADD_QUEUED"] = True
+        add_movie(dict(NEW_MOVIE))
+
+        self.assertNotIn("north-by-northwest", get_index().slugs)
+        query = {"type": INDEX_MOVIES, "slugs": "north-by-northwest"}
+        self.assertEqual(get_db().jobs.find_one(query)["status"], PENDING)
+
+        run_worker(burst=True)
+
+        self.assertIn("north-by-northwest", get_index().slugs)
+        job = get_db().jobs.find_one(query)
+        self.assertEqual(job["status"], DONE)
+        self.assertGreater(job["expires_at"], job["updated"])
+
+    def test_added_movie_indexed_incrementally(self):
+        """ Adding a movie should give it neighbours and add it to its neighbours' lists """
+        add_movie(dict(NEW_MOVIE))
+
+        self.assertEqual(get_db().jobs.count_documents({"type": INDEX_MOVIES}), 0)
+
+        self.assertIn("north-by-northwest", get_index().slugs)
+        self.assertIn(self.similar_slugs("north-by-northwest")[0], ("vertigo", "rear-window"))
+        self.assertIn("north-by-northwest", self.similar_slugs("rear-window"))
+
+    def test_approximate_neighbours_for_large_catalogs(self):
+        """ Past the ANN threshold, neighbours should come from the LSH index """
+        self.app.config.from_mapping(RECS_ANN_THRESHOLD=0, RECS_ANN_BITS=4)
+        index = build_index()
+
+        self.assertTrue(index.uses_ann)
+        self.assertEqual(self.similar_slugs("vertigo")[0], "rear-window")
+
+        add_movie(dict(NEW_MOVIE))
+
+        self.assertIn(self.similar_slugs("north-by-northwest")[0], ("vertigo", "rear-window"))
+        self.assertIn("north-by-northwest", self.similar_slugs("rear-window"))
+
+    def test_unbuilt_index_not_built_on_demand(self):
+        """ Without a saved index, get_index and requests shouldn't build one, but a job should """
+        self.app.config["RECS_INDEX_DIR"] = self.instance_path + "/unbuilt"
+
+        self.assertIsNone(get_index())
+
+        add_movie(dict(NEW_MOVIE))
+        self.assertIsNone(get_index())
+
+        self.app.config["MOVIES_ADD_QUEUED"] = True
+        add_movie({**NEW_MOVIE, "Title": "Notorious", "slug": "notorious"})
+        run_worker(burst=True)
+
+        self.assertEqual(len(get_index().slugs), len(MOVIES) + 2)
+
+    def test_stale_index_reopened_before_adding(self):
+        """ A process whose open index is out of date shouldn't save over another's additions """
+        get_index()
+        stale_state = self.app.extensions.pop(EXTENSION_NAME)
+
+        # Another process adds a movie while this one still has the old index open
+        add_movie(dict(NEW_MOVIE))
+
+        self.app.extensions[EXTENSION_NAME] = stale_state
+        add_movie({**MOVIES[0], "Title": "Psycho", "slug": "psycho"})
+
+        self.app.extensions.pop(EXTENSION_NAME)
+        index = get_index()
+        self.assertEqual(index.slugs[-2:], ["north-by-northwest", "psycho"])
+        self.assertEqual(index.vectors.shape[0], len(index.slugs))
+        self.assertEqual(
+            index.vectors[-1].toarray().tolist(),
+            index.vectors[index.slugs.index("vertigo")].toarray().tolist())
+
+    def test_build_waits_for_other_processes(self):
+        """ Building should wait while another process holds the index directory's lock """
+        def build():
+            with self.app.app_context():
+                build_index()
+
+        lock_path = os.path.join(get_index().ann.directory, LOCK_FILE)
+        with open(lock_path, "a", encoding="ascii") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            builder = threading.Thread(target=build)
+            builder.start()
+            builder.join(0.2)
+            self.assertTrue(builder.is_alive())
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        builder.join(5)
+        self.assertFalse(builder.is_alive())
+
+    def test_index_reloaded_from_disk(self):
+        """ A saved index should be loaded instead of rebuilt """
+        index = get_index()
+        self.app.extensions.pop("movie_recs.recommendations")
+
+        reloaded = get_index()
+
+        self.assertEqual(reloaded.slugs, index.slugs)
+        self.assertEqual(reloaded.vocabulary, index.vocabulary)
+        self.assertEqual(reloaded.vectors.toarray().tolist(), index.vectors.toarray().tolist())
+
+    def test_index_stored_sparsely_without_pickles(self):
+        """ Vectors should only store the features a movie has, and the saved file no objects """
+        index = get_index()
+
+        self.assertTrue(scipy.sparse.issparse(index.vectors))
+        self.assertLess(index.vectors.nnz, index.vectors.shape[0] * index.vectors.shape[1])
+        with np.load(os.path.join(index.ann.directory, INDEX_FILE)) as data:
+            for name in data.files:
+                self.assertNotEqual(data[name].dtype, object)
+
+    def test_similar_movies_api(self):
+        """ The JSON api should list similar movies with their scores """
+        client = self.app.test_client()
+
+        with self.app.test_request_context():
+            url = url_for("api.similar_movies", slug="vertigo", limit=1)
+            missing_url = url_for("api.similar_movies", slug="not-a-movie")
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["similar"]), 1)
+        self.assertEqual(response.json["similar"][0]["slug"], "rear-window")
+        self.assertGreater(response.json["similar"][0]["score"], 0)
+
+        self.assertEqual(client.get(missing_url).status_code, 404)
+
+    def test_movie_details_shows_similar_movies(self):
+        """ The movie page should link to similar movies """
+        with self.app.test_request_context():
+            url = url_for("movies.movie_details", slug="vertigo")
+
+        response = self.app.test_client().get(url)
+
+        self.assertIn(b"More like this", response.data)
+        self.assertIn(b"Rear Window", response.data)
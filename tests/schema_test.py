@@ -0,0 +1,70 @@
+""" Test behavior of the typed movie schema """
+import datetime
+
+from movie_recs.db import LIST_PROJECTION, add_movie, get_db, get_movie_by_slug
+from movie_recs.schema import normalize_movie
+
+from fixtures import AppContextTestFixture
+
+OMDB_MOVIE = {
+    "Title": "Vertigo", "Year": "1958", "Rated": "PG", "Released": "22 May 1958",
+    "Runtime": "128 min", "Genre": "Mystery, Romance, Thriller",
+    "Director": "Alfred Hitchcock", "Writer": "Alec Coppel, Samuel A. Taylor",
+    "Actors": "James Stewart, Kim Novak", "Plot": "A retired detective is hired.",
+    "Language": "English", "Country": "United States", "Awards": "N/A",
+    "Ratings": [
+        {"Source": "Internet Movie Database", "Value": "8.3/10"},
+        {"Source": "Rotten Tomatoes", "Value": "94%"},
+        {"Source": "Metacritic", "Value": "100/100"},
+    ],
+    "Metascore": "100", "imdbRating": "8.3", "imdbVotes": "412,345", "imdbID": "tt0052357",
+    "BoxOffice": "$3,200,000", "Response": "True", "slug": "vertigo",
+}
+
+
+class SchemaTest(AppContextTestFixture):
+    """ Test behavior of the typed movie schema """
+
+    def test_normalize_movie(self):
+        """ OMDB strings should be parsed into typed fields and missing values dropped """
+        movie = normalize_movie(OMDB_MOVIE)
+
+        self.assertEqual(movie["year"], 1958)
+        self.assertEqual(movie["runtime_minutes"], 128)
+        self.assertEqual(movie["released"], datetime.datetime(1958, 5, 22))
+        self.assertEqual(movie["genres"], ["Mystery", "Romance", "Thriller"])
+        self.assertEqual(movie["genre_keys"], ["mystery", "romance", "thriller"])
+        self.assertEqual(movie["actors"], ["James Stewart", "Kim Novak"])
+        self.assertEqual(movie["imdb_rating"], 8.3)
+        self.assertEqual(movie["imdb_votes"], 412345)
+        self.assertEqual(movie["box_office"], 3200000)
+        self.assertEqual([rating["score"] for rating in movie["ratings"]], [83.0, 94.0, 100.0])
+        self.assertEqual(movie["Title"], "Vertigo")
+
+        for field in ("Year", "Genre", "imdbVotes", "Awards", "Response"):
+            self.assertNotIn(field, movie)
+
+        self.assertEqual(normalize_movie(movie), movie)
+
+    def test_stored_movies_normalized(self):
+        """ Movies should be stored typed and listed with only their listing fields """
+        add_movie(dict(OMDB_MOVIE))
+
+        self.assertEqual(get_movie_by_slug("vertigo")["year"], 1958)
+
+        listed = get_db().movies.find_one({"genres": "Thriller"}, LIST_PROJECTION)
+        self.assertNotIn("Plot", listed)
+        self.assertNotIn("actors", listed)
+
+    def test_migrate_movies(self):
+        """ Movies stored as raw OMDB records should be converted once """
+        get_db().movies.insert_one(dict(OMDB_MOVIE))
+        runner = self.app.test_cli_runner()
+
+        self.assertIn("Migrated 1 movies", runner.invoke(args=["migrate-movies"]).output)
+        self.assertIn("Migrated 0 movies", runner.invoke(args=["migrate-movies"]).output)
+
+        movie = get_movie_by_slug("vertigo")
+        self.assertEqual(movie["runtime_minutes"], 128)
+        self.assertEqual(movie["genre_keys"], ["mystery", "romance", "thriller"])
+        self.assertNotIn("Runtime", movie)
@@ -0,0 +1,156 @@
+""" Test behavior of movie search """
+
+from flask import url_for
+from movie_recs.db import (
+    LISTENERS_EXTENSION_NAME, add_movie, add_movies, refresh_movies, update_movie,
+)
+from movie_recs.search import SearchIndex, edit_distance, get_search_index, search_movies
+
+from fixtures import AppContextTestFixture
+
+MOVIES = [
+    {"Title": "Vertigo", "slug": "vertigo", "Year": "1958",
+     "Genre": "Mystery, Romance, Thriller", "Director": "Alfred Hitchcock"},
+    {"Title": "Rear Window", "slug": "rear-window", "Year": "1954",
+     "Genre": "Mystery, Thriller", "Director": "Alfred Hitchcock"},
+    {"Title": "Rashômon", "slug": "rashomon", "Year": "1950",
+     "Genre": "Crime, Drama, Mystery", "Director": "Akira Kurosawa"},
+    {"Title": "Seven Samurai", "slug": "seven-samurai", "Year": "1954",
+     "Genre": "Action, Drama", "Director": "Akira Kurosawa"},
+    {"Title": "The Seventh Seal", "slug": "the-seventh-seal", "Year": "1957",
+     "Genre": "Drama, Fantasy", "Director": "Ingmar Bergman"},
+]
+
+
+class SearchTest(AppContextTestFixture):
+    """ Test behavior of movie search """
+
+    def setUp(self):
+        super().setUp()
+
+        add_movies([dict(movie) for movie in MOVIES])
+
+    def search_slugs(self, query, **filters):
+        """ Helper function to get the slugs of the movies matching a search """
+        return search_movies(query, filters).slugs
+
+    def without_listeners(self, write):
+        """ Helper function to change movies the way another process would """
+        listeners = self.app.extensions.pop(LISTENERS_EXTENSION_NAME)
+        write()
+        self.app.extensions[LISTENERS_EXTENSION_NAME] = listeners
+
+    def test_exact_and_prefix_matches(self):
+        """ Whole words should rank above words they're a prefix of """
+        self.assertEqual(self.search_slugs("seven"), ["seven-samurai", "the-seventh-seal"])
+        self.assertEqual(self.search_slugs("rear win"), ["rear-window"])
+
+    def test_typos_and_accents(self):
+        """ Misspelled and unaccented words should still match """
+        self.assertEqual(self.search_slugs("vertgio"), ["vertigo"])
+        self.assertEqual(self.search_slugs("rashomon"), ["rashomon"])
+        self.assertEqual(self.search_slugs("samuria"), ["seven-samurai"])
+
+    def test_short_words_must_match_exactly(self):
+        """ Short words allow no typos, so they don't match everything """
+        self.assertEqual(self.search_slugs("sel"), [])
+
+    def test_facet_filters_and_counts(self):
+        """ Filters should narrow the matches and facets should count them """
+        result = search_movies("", {"director": "akira kurosawa"})
+
+        self.assertEqual(sorted(result.slugs), ["rashomon", "seven-samurai"])
+        self.assertEqual(dict(result.facets["genre"])["Drama"], 2)
+        self.assertEqual(self.search_slugs("", genre="Mystery", year="1954"), ["rear-window"])
+
+    def test_empty_search_lists_every_title(self):
+        """ A search without words or filters should list titles in order and count every movie """
+        result = search_movies("")
+
+        self.assertEqual(
+            result.slugs,
+            ["rashomon", "rear-window", "seven-samurai", "the-seventh-seal", "vertigo"])
+        self.assertEqual(result.total, 5)
+        self.assertEqual(dict(result.facets["genre"])["Drama"], 3)
+        self.assertEqual(dict(result.facets["director"])["Alfred Hitchcock"], 2)
+
+    def test_facets_counted_over_best_matches(self):
+        """ Facets should only count the best facet_matches matches, but the total all of them """
+        index = get_search_index()
+
+        result = index.search("", {"director": "Akira Kurosawa"}, limit=2, facet_matches=1)
+        self.assertEqual(result.slugs, ["rashomon", "seven-samurai"])
+        self.assertEqual(result.total, 2)
+        self.assertEqual(dict(result.facets["genre"]), {"Crime": 1, "Drama": 1, "Mystery": 1})
+
+        result = index.search("seven", limit=1, facet_matches=1)
+        self.assertEqual(result.total, 2)
+        self.assertEqual(dict(result.facets["director"]), {"Akira Kurosawa": 1})
+
+    def test_index_follows_inserts_and_updates(self):
+        """ Movies added or retitled after the index is built should be found """
+        get_search_index()
+
+        add_movie({"Title": "Wild Strawberries", "slug": "wild-strawberries"})
+        update_movie("vertigo", {"Title": "Vertigo (Restored)"})
+
+        self.assertEqual(self.search_slugs("strawberries"), ["wild-strawberries"])
+        self.assertEqual(self.search_slugs("restored"), ["vertigo"])
+
+    def test_index_picks_up_other_processes_changes(self):
+        """ Movies inserted or changed without the listener should be found after refreshing """
+        get_search_index()
+        self.app.config["SEARCH_REFRESH_INTERVAL"] = 0
+
+        self.without_listeners(lambda: (
+            add_movie({"Title": "Wild Strawberries", "slug": "wild-strawberries"}),
+            update_movie("vertigo", {"Title": "Vertigo (Restored)"}),
+            refresh_movies([{"Title": "Rashômon", "slug": "rashomon", "Director": "Kurosawa"}]),
+        ))
+
+        self.assertEqual(self.search_slugs("strawberries"), ["wild-strawberries"])
+        self.assertEqual(self.search_slugs("restored"), ["vertigo"])
+        self.assertEqual(self.search_slugs("", director="Kurosawa"), ["rashomon"])
+
+    def test_searches_dont_wait_for_refresh(self):
+        """ A search should use the index as it is while another one is refreshing it """
+        index = get_search_index()
+        self.app.config["SEARCH_REFRESH_INTERVAL"] = 0
+        self.without_listeners(
+            lambda: add_movie({"Title": "Wild Strawberries", "slug": "wild-strawberries"}))
+
+        with index.loading:
+            self.assertEqual(self.search_slugs("strawberries"), [])
+
+        self.assertEqual(self.search_slugs("strawberries"), ["wild-strawberries"])
+
+    def test_removing_a_repeated_word(self):
+        """ Removing a title that repeats a word should leave the rest of the index intact """
+        index = SearchIndex()
+        index.add({"Title": "Tora! Tora! Tora!", "slug": "tora-tora-tora"})
+        index.add({"Title": "Top Gun", "slug": "top-gun"})
+
+        index.remove("tora-tora-tora")
+
+        self.assertEqual(index.vocabulary, ["gun", "top"])
+        self.assertEqual(index.search("top").slugs, ["top-gun"])
+
+    def test_edit_distance(self):
+        """ Swapping neighbouring letters should count as one edit """
+        self.assertEqual(edit_distance("vertigo", "vertgio", 2), 1)
+        self.assertEqual(edit_distance("kitten", "sitting", 3), 3)
+        self.assertEqual(edit_distance("kitten", "sitting", 1), 2)
+
+    def test_search_page_and_api(self):
+        """ Test the search page and JSON API """
+        with self.app.test_request_context():
+            page_url = url_for("movies.search", q="vertgo")
+            api_url = url_for("api.search_movies_api", q="", director="Alfred Hitchcock", limit=1)
+
+        client = self.app.test_client()
+        self.assertIn(b"Vertigo", client.get(page_url).data)
+
+        data = client.get(api_url).get_json()
+        self.assertEqual(data["total"], 2)
+        self.assertEqual(len(data["results"]), 1)
+        self.assertIn({"value": "Thriller", "count": 2}, data["facets"]["genre"])
@@ -0,0 +1,69 @@
+""" Test behavior of local title resolution """
+
+import responses
+from movie_recs.db import add_movie, get_db
+from movie_recs.titles import add_aliases, index_all_titles, resolve_title, title_key
+
+from fixtures import AuthenticationTestFixture
+
+
+class TitlesTest(AuthenticationTestFixture):
+    """ Test behavior of local title resolution """
+
+    def setUp(self):
+        super().setUp()
+
+        add_movie({"Title": "Rashômon", "slug": "rashomon", "Year": "1950"})
+        add_movie({"Title": "The Imitation Game", "slug": "the-imitation-game", "Year": "2014"})
+
+    def test_title_key(self):
+        """ Keys should ignore case, accents, punctuation and leading articles """
+        self.assertEqual(title_key("Rashômon"), "rashomon")
+        self.assertEqual(title_key("The Imitation Game!"), "imitation-game")
+        self.assertEqual(title_key("A"), "a")
+
+    def test_near_miss_titles_resolve(self):
+        """ Variations of a stored movie's title should resolve to it """
+        titles = ("Rashomon", "RASHÔMON", "rashomon (1950)", "Imitation Game", "the imitation game")
+        for title in titles:
+            with self.subTest(title=title):
+                self.assertIsNotNone(resolve_title(title))
+
+        self.assertIsNone(resolve_title("Ikiru"))
+        self.assertIsNone(resolve_title("Rashomon 1951"))
+
+    def test_aliases_keep_their_first_movie(self):
+        """ An alias shouldn't be taken over by a later movie """
+        add_aliases("rashomon", ["In the Grove"])
+        add_aliases("the-imitation-game", ["In the Grove"])
+
+        self.assertEqual(resolve_title("in the grove"), "rashomon")
+
+    def test_index_all_titles(self):
+        """ Movies stored without registering their titles should be registered """
+        get_db().aliases.delete_many({})
+
+        self.assertEqual(index_all_titles(), 2)
+        self.assertEqual(resolve_title("Imitation Game"), "the-imitation-game")
+
+    def test_known_movie_added_without_omdb_request(self):
+        """ Adding a movie that's already stored shouldn't reach the OMDB """
+        client = self.app.test_client()
+        self.login(client=client)
+
+        response = client.post("/movies/add", data={"movie_title": "Rashomon"})
+
+        self.assertIn("has already been added", response.get_data(as_text=True))
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(self.async_omdb_calls, [])
+
+    def test_added_movie_resolves(self):
+        """ A movie added through the add page should resolve afterwards """
+        client = self.app.test_client()
+        self.login(client=client)
+        get_db().movies.delete_many({"slug": "the-imitation-game"})
+        get_db().aliases.delete_many({"slug": "the-imitation-game"})
+
+        client.post("/movies/add", data={"movie_title": self.test_movie_title})
+
+        self.assertEqual(resolve_title(self.test_movie_title), self.expected_slug)